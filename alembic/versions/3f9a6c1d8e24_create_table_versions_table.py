@@ -0,0 +1,36 @@
+"""create table versions table
+
+Revision ID: 3f9a6c1d8e24
+Revises: e41a5b8c2d67
+Create Date: 2026-10-18 18:12:37.504126
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "3f9a6c1d8e24"
+down_revision: Union[str, None] = "e41a5b8c2d67"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+VERSIONED_TABLES = ["messages", "codes", "annotations"]
+
+
+def upgrade() -> None:
+    table_versions = op.create_table(
+        "table_versions",
+        sa.Column("table_name", sa.String, primary_key=True),
+        sa.Column("version", sa.Integer, nullable=False),
+    )
+    op.bulk_insert(
+        table_versions,
+        [{"table_name": table, "version": 0} for table in VERSIONED_TABLES],
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("table_versions")
@@ -0,0 +1,24 @@
+"""create messages content index
+
+Revision ID: 5c1d0e7f3a92
+Revises: 30a8625b2760
+Create Date: 2026-10-18 15:21:47.918304
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5c1d0e7f3a92"
+down_revision: Union[str, None] = "30a8625b2760"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index("ix_messages_content", "messages", ["content"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_content", table_name="messages")
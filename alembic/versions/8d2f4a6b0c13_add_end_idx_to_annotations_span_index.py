@@ -0,0 +1,36 @@
+"""add end_idx to annotations span index
+
+Revision ID: 8d2f4a6b0c13
+Revises: 3f9a6c1d8e24
+Create Date: 2026-10-18 18:47:05.913382
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "8d2f4a6b0c13"
+down_revision: Union[str, None] = "3f9a6c1d8e24"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_annotations_message_id_start_idx_end_idx",
+        "annotations",
+        ["message_id", "start_idx", "end_idx"],
+    )
+    op.drop_index("ix_annotations_message_id_start_idx", table_name="annotations")
+
+
+def downgrade() -> None:
+    op.create_index(
+        "ix_annotations_message_id_start_idx",
+        "annotations",
+        ["message_id", "start_idx"],
+    )
+    op.drop_index(
+        "ix_annotations_message_id_start_idx_end_idx", table_name="annotations"
+    )
@@ -0,0 +1,34 @@
+"""create changes table
+
+Revision ID: a7c3e5f9b1d4
+Revises: f2b6d9e3a514
+Create Date: 2026-10-18 21:14:37.502198
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "a7c3e5f9b1d4"
+down_revision: Union[str, None] = "f2b6d9e3a514"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "changes",
+        sa.Column("seq", sa.Integer, primary_key=True),
+        sa.Column("table_name", sa.String, nullable=False),
+        sa.Column("operation", sa.String, nullable=False),
+        sa.Column("row_id", sa.Integer),
+        sa.Column("data", sa.JSON),
+        sqlite_autoincrement=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("changes")
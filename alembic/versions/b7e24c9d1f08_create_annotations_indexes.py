@@ -0,0 +1,32 @@
+"""create annotations indexes
+
+Revision ID: b7e24c9d1f08
+Revises: 5c1d0e7f3a92
+Create Date: 2026-10-18 16:02:33.571946
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b7e24c9d1f08"
+down_revision: Union[str, None] = "5c1d0e7f3a92"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index("ix_annotations_message_id", "annotations", ["message_id"])
+    op.create_index("ix_annotations_code_id", "annotations", ["code_id"])
+    op.create_index(
+        "ix_annotations_message_id_start_idx",
+        "annotations",
+        ["message_id", "start_idx"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_annotations_message_id_start_idx", table_name="annotations")
+    op.drop_index("ix_annotations_code_id", table_name="annotations")
+    op.drop_index("ix_annotations_message_id", table_name="annotations")
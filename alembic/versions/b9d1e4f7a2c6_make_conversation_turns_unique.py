@@ -0,0 +1,35 @@
+"""make conversation turns unique
+
+Revision ID: b9d1e4f7a2c6
+Revises: d3a9f7c1e5b8
+Create Date: 2026-10-19 10:12:40.205318
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b9d1e4f7a2c6"
+down_revision: Union[str, None] = "d3a9f7c1e5b8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.drop_index("ix_messages_conversation_id_turn_idx", table_name="messages")
+    op.create_index(
+        "ix_messages_conversation_id_turn_idx",
+        "messages",
+        ["conversation_id", "turn_idx"],
+        unique=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_conversation_id_turn_idx", table_name="messages")
+    op.create_index(
+        "ix_messages_conversation_id_turn_idx",
+        "messages",
+        ["conversation_id", "turn_idx"],
+    )
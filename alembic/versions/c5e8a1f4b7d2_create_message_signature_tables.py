@@ -0,0 +1,62 @@
+"""create message signature tables
+
+Revision ID: c5e8a1f4b7d2
+Revises: 8d2f4a6b0c13
+Create Date: 2026-10-18 19:24:51.207316
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c5e8a1f4b7d2"
+down_revision: Union[str, None] = "8d2f4a6b0c13"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "message_signatures",
+        sa.Column(
+            "message_id",
+            sa.Integer,
+            sa.ForeignKey("messages.id", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("signature", sa.LargeBinary, nullable=False),
+        sa.Column(
+            "duplicate_of_id",
+            sa.Integer,
+            sa.ForeignKey("messages.id", ondelete="SET NULL"),
+        ),
+    )
+    op.create_index(
+        "ix_message_signatures_duplicate_of_id",
+        "message_signatures",
+        ["duplicate_of_id"],
+    )
+    op.create_table(
+        "message_bands",
+        sa.Column("band", sa.Integer, primary_key=True),
+        sa.Column("hash", sa.BigInteger, primary_key=True),
+        sa.Column(
+            "message_id",
+            sa.Integer,
+            sa.ForeignKey("messages.id", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+    )
+    op.create_index("ix_message_bands_message_id", "message_bands", ["message_id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_message_bands_message_id", table_name="message_bands")
+    op.drop_table("message_bands")
+    op.drop_index(
+        "ix_message_signatures_duplicate_of_id", table_name="message_signatures"
+    )
+    op.drop_table("message_signatures")
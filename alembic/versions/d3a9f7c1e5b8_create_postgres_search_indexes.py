@@ -0,0 +1,42 @@
+"""create postgres search indexes
+
+Revision ID: d3a9f7c1e5b8
+Revises: a7c3e5f9b1d4
+Create Date: 2026-10-18 22:03:51.774019
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "d3a9f7c1e5b8"
+down_revision: Union[str, None] = "a7c3e5f9b1d4"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        return  # SQLite searches with its full-text index and binary collation
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index(
+        "ix_messages_content_trgm",
+        "messages",
+        ["content"],
+        postgresql_using="gin",
+        postgresql_ops={"content": "gin_trgm_ops"},
+    )
+    op.create_index(
+        "ix_codes_code_pattern",
+        "codes",
+        ["code"],
+        postgresql_ops={"code": "text_pattern_ops"},
+    )
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    op.drop_index("ix_codes_code_pattern", table_name="codes")
+    op.drop_index("ix_messages_content_trgm", table_name="messages")
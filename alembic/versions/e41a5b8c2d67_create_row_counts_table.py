@@ -0,0 +1,59 @@
+"""create row counts table
+
+Revision ID: e41a5b8c2d67
+Revises: b7e24c9d1f08
+Create Date: 2026-10-18 16:41:09.268410
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e41a5b8c2d67"
+down_revision: Union[str, None] = "b7e24c9d1f08"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+COUNTED_TABLES = ["messages", "codes"]
+
+
+def upgrade() -> None:
+    op.create_table(
+        "row_counts",
+        sa.Column("table_name", sa.String, primary_key=True),
+        sa.Column("count", sa.Integer, nullable=False),
+    )
+    if op.get_bind().dialect.name != "sqlite":
+        return  # Other backends count rows with queries
+    for table in COUNTED_TABLES:
+        op.execute(
+            f"""
+            CREATE TRIGGER {table}_count_insert AFTER INSERT ON {table} BEGIN
+                UPDATE row_counts SET count = count + 1 WHERE table_name = '{table}';
+            END
+            """
+        )
+        op.execute(
+            f"""
+            CREATE TRIGGER {table}_count_delete AFTER DELETE ON {table} BEGIN
+                UPDATE row_counts SET count = count - 1 WHERE table_name = '{table}';
+            END
+            """
+        )
+        op.execute(
+            f"""
+            INSERT INTO row_counts (table_name, count)
+            SELECT '{table}', count(*) FROM {table}
+            """
+        )
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == "sqlite":
+        for table in COUNTED_TABLES:
+            op.execute(f"DROP TRIGGER {table}_count_delete")
+            op.execute(f"DROP TRIGGER {table}_count_insert")
+    op.drop_table("row_counts")
@@ -0,0 +1,29 @@
+"""drop postgres messages content index
+
+Revision ID: e6c2a8d4f1b3
+Revises: b9d1e4f7a2c6
+Create Date: 2026-10-19 14:36:02.518447
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e6c2a8d4f1b3"
+down_revision: Union[str, None] = "b9d1e4f7a2c6"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        return  # SQLite sorts and reads contents through the index
+    # Contents longer than a btree index entry could not be inserted
+    op.drop_index("ix_messages_content", table_name="messages")
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    op.create_index("ix_messages_content", "messages", ["content"])
@@ -0,0 +1,50 @@
+"""create conversations table
+
+Revision ID: f2b6d9e3a514
+Revises: c5e8a1f4b7d2
+Create Date: 2026-10-18 20:02:13.618420
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "f2b6d9e3a514"
+down_revision: Union[str, None] = "c5e8a1f4b7d2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "conversations",
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("name", sa.String),
+    )
+    if op.get_bind().dialect.name == "sqlite":
+        # SQLite can add a column referencing another table, but not a constraint
+        op.execute(
+            "ALTER TABLE messages "
+            "ADD COLUMN conversation_id INTEGER REFERENCES conversations (id)"
+        )
+    else:
+        op.add_column(
+            "messages",
+            sa.Column("conversation_id", sa.Integer, sa.ForeignKey("conversations.id")),
+        )
+    op.add_column("messages", sa.Column("turn_idx", sa.Integer))
+    op.create_index(
+        "ix_messages_conversation_id_turn_idx",
+        "messages",
+        ["conversation_id", "turn_idx"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_conversation_id_turn_idx", table_name="messages")
+    op.drop_column("messages", "turn_idx")
+    op.drop_column("messages", "conversation_id")
+    op.drop_table("conversations")
@@ -0,0 +1,51 @@
+import type { Ref } from 'vue'
+import { API_URL } from '@/main'
+
+interface Change {
+  seq: number,
+  table: string,
+  operation: 'create' | 'update' | 'delete' | 'reload',
+  row_id: number | null,
+  data: Record<string, any> | null,
+}
+
+// Add an item to a list, or replace the item with the same ID
+export function upsertItem<T extends { id: number }>(items: Ref<T[]>, item: T) {
+  const index = items.value.findIndex(other => other.id === item.id);
+  if (index === -1) {
+    items.value.push(item);
+  } else {
+    items.value[index] = Object.assign({}, items.value[index], item);
+  }
+}
+
+function applyChange<T extends { id: number }>(
+  items: Ref<T[]>, change: Change, reload: () => void, showsCreated: () => boolean
+) {
+  const index = items.value.findIndex(item => item.id === change.row_id);
+  if (change.operation === 'reload') {
+    reload();
+  } else if (change.operation === 'delete') {
+    if (index !== -1) items.value.splice(index, 1);
+  } else if (change.operation === 'create') {
+    if (index !== -1 || showsCreated()) upsertItem(items, change.data as T);
+    else reload();
+  } else if (index !== -1) {
+    items.value[index] = Object.assign({}, items.value[index], change.data);
+  }
+}
+
+// Apply the changes made to `table` by any client to the items read from it, rather
+// than reading them again, calling `reload` if the changes cannot be applied. Created
+// items are only added when `showsCreated` says they belong at the end of the items.
+export function followChanges<T extends { id: number }>(
+  table: string, items: Ref<T[]>, reload: () => void, showsCreated: () => boolean
+): EventSource {
+  const source = new EventSource(API_URL + 'changes/stream');
+  source.onmessage = (event: MessageEvent) => {
+    const change: Change = JSON.parse(event.data);
+    if (change.table === table) applyChange(items, change, reload, showsCreated);
+  };
+  source.addEventListener('reload', reload);
+  return source;
+}
@@ -0,0 +1,93 @@
+"""Cache the code hierarchy in memory, as codes are read far more than written."""
+
+import threading
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from .models import Code, TableVersion
+
+
+class CodeNode:
+    """A segment of a code path, which is itself a code if it has an id."""
+
+    __slots__ = ("id", "children")
+
+    def __init__(self) -> None:
+        self.id: Optional[int] = None
+        self.children: Dict[str, CodeNode] = {}
+
+    def walk(self) -> Iterator["CodeNode"]:
+        yield self
+        for child in self.children.values():
+            yield from child.walk()
+
+
+class CodeTrie:
+    """Every code, indexed by id and arranged in a trie keyed by path segment."""
+
+    def __init__(self, codes: Iterable[Tuple[int, str]]) -> None:
+        self.root = CodeNode()
+        self.codes: Dict[int, str] = {}
+        for code_id, code in codes:
+            self.codes[code_id] = code
+            node = self.root
+            for segment in code.split("/"):
+                node = node.children.setdefault(segment, CodeNode())
+            node.id = code_id
+
+    def find(self, code: str) -> Optional[CodeNode]:
+        node: Optional[CodeNode] = self.root
+        for segment in code.split("/"):
+            if node is None:
+                break
+            node = node.children.get(segment)
+        return node
+
+    def subtree(self, code: str) -> Dict[int, str]:
+        """Find `code` and all of its descendants by id."""
+        node = self.find(code)
+        if node is None:
+            return {}
+        return {n.id: self.codes[n.id] for n in node.walk() if n.id is not None}
+
+
+class CodeCache:
+    """Hold a trie of the codes in the database, rebuilt after codes are written.
+
+    Writes made in this process invalidate the cache directly. If `shared`, the
+    version of the codes table is also checked on every read, so that writes made
+    by other worker processes are seen too.
+    """
+
+    def __init__(self, shared: bool = False) -> None:
+        self.shared = shared
+        self._cached: Optional[Tuple[CodeTrie, Optional[int]]] = None
+        self._generation = 0  # Increased to discard tries loaded before a write
+        self._lock = threading.Lock()
+
+    def get(self, session: Session) -> CodeTrie:
+        """Get the trie of codes, loading it with `session` if out of date."""
+        version = self._read_version(session) if self.shared else None
+        cached = self._cached
+        if cached is not None and cached[1] == version:
+            return cached[0]
+        generation = self._generation
+        trie = CodeTrie(session.execute(sa.select(Code.id, Code.code)).tuples())
+        with self._lock:
+            if generation == self._generation:
+                self._cached = (trie, version)
+        return trie
+
+    def invalidate(self) -> None:
+        """Discard the cached codes after they have been written to."""
+        with self._lock:
+            self._generation += 1
+            self._cached = None
+
+    def _read_version(self, session: Session) -> Optional[int]:
+        statement = sa.select(TableVersion.version).where(
+            TableVersion.table_name == Code.__tablename__
+        )
+        return session.execute(statement).scalar_one_or_none()
@@ -0,0 +1,149 @@
+"""Push the changes logged by every write to clients of the change stream.
+
+Rather than each client polling the change log, a single task in each process
+polls it and fans new changes out to every client, so the number of queries made
+does not grow with the number of clients. Clients that fall behind the changes
+held in memory catch up by reading the log themselves.
+"""
+
+import asyncio
+import json
+import logging
+from collections import deque
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Optional,
+)
+
+from sqlalchemy.exc import SQLAlchemyError
+
+logger = logging.getLogger(__name__)
+
+# Reads the feed of up to `limit` changes after `since`, as `crud.read_changes`
+ReadChanges = Callable[[Optional[int], Optional[int]], Awaitable[Dict[str, Any]]]
+
+KEEPALIVE_EVENT = ": keep-alive\n\n"
+
+
+class ChangeBroadcaster:
+    """Poll the change log while any client is subscribed and broadcast the
+    changes read to all of them.
+    """
+
+    def __init__(self, read: ReadChanges, interval: float, buffer_size: int) -> None:
+        self.read = read
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self._buffer: Deque[Dict[str, Any]] = deque()
+        self._buffered_after = 0  # The buffer holds every change after this one
+        self._latest: Optional[int] = None  # Until the log is first polled
+        self._changed = asyncio.Event()
+        self._subscribers = 0
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    async def subscribe(
+        self, since: Optional[int], keepalive: float
+    ) -> AsyncGenerator[Optional[Dict[str, Any]], None]:
+        """Yield feeds of the changes committed after the change numbered `since`,
+        or after the latest change if None, as they are polled.
+
+        None is yielded after `keepalive` seconds without changes.
+        """
+        self._subscribe()
+        try:
+            if since is None:
+                since = (await self.read(None, None))["seq"]
+            async for feed in self._feeds(since, keepalive):
+                yield feed
+        finally:
+            self._unsubscribe()
+
+    async def _feeds(
+        self, since: int, keepalive: float
+    ) -> AsyncGenerator[Optional[Dict[str, Any]], None]:
+        while True:
+            changed = self._changed  # Before reading, so no poll is missed
+            feed = await self._changes_after(since)
+            if feed is not None:
+                since = feed["seq"]
+                yield feed
+            elif not await _wait(changed, keepalive):
+                yield None
+
+    def _subscribe(self) -> None:
+        self._subscribers += 1
+        if self._task is None:
+            self._task = asyncio.create_task(self._poll())
+
+    def _unsubscribe(self) -> None:
+        self._subscribers -= 1
+        if not self._subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._latest = None
+
+    async def _changes_after(self, since: int) -> Optional[Dict[str, Any]]:
+        """Read the changes after `since` from the buffer if it holds them, or
+        from the log, returning None if there are none yet.
+        """
+        latest = self._latest
+        if latest is not None and self._buffered_after <= since <= latest:
+            if since == latest:
+                return None
+            changes = [change for change in self._buffer if change["seq"] > since]
+            return {"changes": changes, "seq": latest, "reload": False}
+        feed = await self.read(since, self.buffer_size)
+        return feed if feed["changes"] or feed["reload"] else None
+
+    async def _poll(self) -> None:
+        self._buffer.clear()
+        self._latest = self._buffered_after = (await self.read(None, None))["seq"]
+        while True:
+            try:
+                self._publish(await self.read(self._latest, self.buffer_size))
+            except SQLAlchemyError:  # Retried on the next poll
+                logger.exception("Failed to poll the change log")
+            await asyncio.sleep(self.interval)
+
+    def _publish(self, feed: Dict[str, Any]) -> None:
+        if feed["reload"]:  # Subscribers read from the log to find they must reload
+            self._buffer.clear()
+            self._buffered_after = feed["seq"]
+        self._buffer.extend(feed["changes"])
+        while len(self._buffer) > self.buffer_size:
+            self._buffered_after = self._buffer.popleft()["seq"]
+        if feed["seq"] != self._latest:
+            self._latest = feed["seq"]
+            self._changed.set()
+            self._changed = asyncio.Event()
+
+
+async def _wait(event: asyncio.Event, timeout: float) -> bool:
+    """Wait for `event` to be set, returning False if it timed out."""
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+def format_events(feed: Optional[Dict[str, Any]]) -> str:
+    """Format a feed of changes as server-sent events, with the number of each
+    change as the id from which a reconnecting client resumes.
+
+    A `reload` event is sent if the changes could not be read, and a comment if
+    the feed is None, to keep the connection open.
+    """
+    if feed is None:
+        return KEEPALIVE_EVENT
+    if feed["reload"]:
+        return f"event: reload\nid: {feed['seq']}\ndata: {{}}\n\n"
+    return "".join(
+        f"id: {change['seq']}\ndata: {json.dumps(change)}\n\n"
+        for change in feed["changes"]
+    )
@@ -0,0 +1,132 @@
+"""Provide command line tools for managing the database.
+
+Run `python -m backend.cli --help` for usage.
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional
+
+from . import crud, dedup, export, ingest
+from . import schemas as sch
+from .config import DEDUP_THRESHOLD, IMPORT_BATCH_SIZE
+from .database import SessionLocal, init_database, write_lock
+
+CHUNK_SIZE = 1 << 16
+
+
+def _read_chunks(file: BinaryIO) -> Iterator[bytes]:
+    while chunk := file.read(CHUNK_SIZE):
+        yield chunk
+
+
+def _open(path: str) -> BinaryIO:
+    return sys.stdin.buffer if path == "-" else open(path, "rb")
+
+
+def import_messages(args: argparse.Namespace) -> None:
+    """Import messages from an NDJSON or CSV file."""
+    format = args.format
+    if format is None:
+        is_csv = Path(args.path).suffix.lower() == ".csv"
+        format = ingest.ImportFormat.CSV if is_csv else ingest.ImportFormat.NDJSON
+    dedup.check_available(args.duplicates)
+    importer = ingest.MessageImporter(
+        format, batch_size=args.batch_size, duplicates=args.duplicates
+    )
+    create_messages = write_lock.locked(crud.create_messages)  # Alongside the API
+    with _open(args.path) as file, SessionLocal() as session:
+        for batch in importer.batches(ingest.iter_lines(_read_chunks(file))):
+            found, errors = create_messages(session, batch, args.duplicates)
+            importer.add_duplicates(found)
+            importer.add_batch_errors(errors)
+    print(importer.result().model_dump_json(indent=2))
+
+
+def import_codes(args: argparse.Namespace) -> None:
+    """Import a codebook from a JSON list or tree of codes, or one code per line."""
+    with _open(args.path) as file:
+        text = file.read().decode()
+    try:
+        codes = json.loads(text)
+    except ValueError:
+        codes = text.splitlines()
+    if isinstance(codes, dict):
+        codebook = sch.ImportCodes(tree=codes)
+    else:
+        codebook = sch.ImportCodes(codes=codes)
+    with SessionLocal() as session:
+        result = write_lock.locked(crud.import_codes)(session, codebook)
+    print(result.model_dump_json(indent=2))
+
+
+def export_dataset(args: argparse.Namespace) -> None:
+    """Export messages with their annotations as NDJSON, JSONL spans or Parquet."""
+    export.check_available(args.format)
+    output = sys.stdout.buffer if args.path == "-" else open(args.path, "wb")
+    with output, SessionLocal() as session:
+        rows = crud.read_dataset(session, args.code)
+        for chunk in export.export(rows, args.format):
+            output.write(chunk)
+
+
+def find_duplicates(args: argparse.Namespace) -> None:
+    """Print clusters of near duplicate messages, one JSON list of ids per line."""
+    with SessionLocal() as session:
+        clusters = write_lock.locked(crud.read_duplicate_clusters)(
+            session, args.threshold
+        )
+    for cluster in clusters:
+        print(json.dumps(cluster))
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m backend.cli")
+    commands = parser.add_subparsers(required=True)
+
+    command = commands.add_parser("import-messages", help=import_messages.__doc__)
+    command.add_argument("path", help="file to import, or - for stdin")
+    command.add_argument(
+        "--format",
+        type=ingest.ImportFormat,
+        help="format of the file (default: inferred from its extension)",
+    )
+    command.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    command.add_argument(
+        "--duplicates",
+        type=dedup.DuplicatePolicy,
+        default=dedup.DuplicatePolicy.ALLOW,
+        help="check for, reject or link near duplicate messages",
+    )
+    command.set_defaults(func=import_messages)
+
+    command = commands.add_parser("import-codes", help=import_codes.__doc__)
+    command.add_argument("path", help="file to import, or - for stdin")
+    command.set_defaults(func=import_codes)
+
+    command = commands.add_parser("export", help=export_dataset.__doc__)
+    command.add_argument("path", help="file to write, or - for stdout")
+    command.add_argument(
+        "--format", type=export.ExportFormat, default=export.ExportFormat.NDJSON
+    )
+    command.add_argument("--code", help="only export annotations in this subtree")
+    command.set_defaults(func=export_dataset)
+
+    command = commands.add_parser("duplicates", help=find_duplicates.__doc__)
+    command.add_argument("--threshold", type=float, default=DEDUP_THRESHOLD)
+    command.set_defaults(func=find_duplicates)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Run the command given by `argv`."""
+    args = _parser().parse_args(argv)
+    init_database()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,329 @@
 """Provide CRUD operations on the database."""
 
-from typing import Any, List, Optional
+import base64
+import json
+from itertools import chain, compress
+from operator import itemgetter
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+)
 
 import sqlalchemy as sa
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, aliased
 
+from . import dedup
 from . import schemas as sch
-from .exceptions import MessageNotFoundError
-from .models import Annotation, Code, Message
+from .cache import CodeCache
+from .config import (
+    CHANGE_LOG_MAX_ROWS,
+    CHANGE_LOG_PRUNE_INTERVAL,
+    CHANGE_LOG_SIZE,
+    CODE_CACHE_SHARED,
+    COPY_MIN_ROWS,
+    DEDUP_THRESHOLD,
+    EXPORT_BATCH_SIZE,
+    IMPORT_BATCH_SIZE,
+)
+from .dedup import DuplicatePolicy
+from .exceptions import (
+    AnnotationNotFoundError,
+    CodeNotFoundError,
+    ConversationNotFoundError,
+    DuplicateMessageError,
+    DuplicateTurnError,
+    InvalidCursorError,
+    InvalidSortColumnError,
+    InvalidSpanError,
+    MessageNotFoundError,
+)
+from .models import (
+    SEARCH_INDEX_MIN_TERM_LENGTH,
+    Annotation,
+    Base,
+    Change,
+    Code,
+    Conversation,
+    Message,
+    MessageBand,
+    MessageSignature,
+    RowCount,
+    TableVersion,
+    message_search,
+)
+from .suggestions import SuggestionIndex, annotation_phrase
+
+if TYPE_CHECKING:
+    from numpy.typing import NDArray
+
+# -----------------------------------------------------------------------
+# Versions
+
+
+def read_table_versions(session: Session, tables: List[str]) -> List[int]:
+    """Read the version of each of `tables`, which every write to them increases."""
+    statement = sa.select(TableVersion.table_name, TableVersion.version).where(
+        TableVersion.table_name.in_(tables)
+    )
+    versions = dict(session.execute(statement).tuples().all())
+    return [versions.get(table, 0) for table in tables]
+
+
+def _bump_versions(session: Session, *models: Type[Base]) -> None:
+    """Increase the versions of the tables of `models` in the current transaction."""
+    tables = [model.__tablename__ for model in models]
+    statement = (
+        sa.update(TableVersion)
+        .where(TableVersion.table_name.in_(tables))
+        .values(version=TableVersion.version + 1)
+    )
+    session.execute(statement)
+
+
+# -----------------------------------------------------------------------
+# Changes
+
+# Identifies the advisory lock held by PostgreSQL transactions logging changes
+CHANGE_LOG_LOCK_KEY = 0x6368616E676573  # "changes"
+
+CHANGE_COLUMNS = (
+    Change.seq,
+    Change.table_name.label("table"),
+    Change.operation,
+    Change.row_id,
+    Change.data,
+)
+
+
+def read_changes(
+    session: Session, since: Optional[int], limit: Optional[int] = None
+) -> Dict[str, Any]:
+    """Read up to `limit` changes committed after the change numbered `since`, or
+    only the number of the latest change if `since` is None.
+
+    If changes after `since` were pruned from the log, or `since` is ahead of the
+    log, they cannot be replayed, so none are read and `reload` is set.
+    """
+    get_latest = sa.select(sa.func.max(Change.seq))
+    latest = session.execute(get_latest).scalar_one() or 0
+    if since is None or not latest - CHANGE_LOG_SIZE <= since <= latest:
+        return {"changes": [], "seq": latest, "reload": since is not None}
+    statement = (
+        sa.select(*CHANGE_COLUMNS)
+        .where(Change.seq > since)
+        .order_by(Change.seq)
+        .limit(limit)
+    )
+    changes = [row._asdict() for row in session.execute(statement)]
+    seq = changes[-1]["seq"] if changes else since
+    return {"changes": changes, "seq": seq, "reload": False}
+
+
+def _log_changes(
+    session: Session,
+    model: Type[Base],
+    operation: sch.ChangeOperation,
+    rows: Sequence[Dict[str, Any]],
+) -> None:
+    """Log a write to each of `rows` of the table of `model` in the current
+    transaction, or a single change to reload the table if there are many.
+    """
+    if len(rows) > CHANGE_LOG_MAX_ROWS:
+        return _log_reloads(session, model)
+    with_data = operation != sch.ChangeOperation.DELETE
+    changes = [
+        {
+            "table_name": model.__tablename__,
+            "operation": operation.value,
+            "row_id": row["id"],
+            "data": row if with_data else None,
+        }
+        for row in rows
+    ]
+    _insert_changes(session, changes)
+
+
+def _log_reloads(session: Session, *models: Type[Base]) -> None:
+    """Log a write to many rows of the tables of `models`."""
+    operation = sch.ChangeOperation.RELOAD.value
+    changes = [
+        {
+            "table_name": model.__tablename__,
+            "operation": operation,
+            "row_id": None,
+            "data": None,
+        }
+        for model in models
+    ]
+    _insert_changes(session, changes)
+
+
+def _insert_changes(session: Session, changes: List[Dict[str, Any]]) -> None:
+    """Insert changes, pruning those too old to keep from the log every
+    `CHANGE_LOG_PRUNE_INTERVAL` changes.
+    """
+    if not changes:
+        return
+    _lock_change_log(session)
+    seqs = session.scalars(sa.insert(Change).returning(Change.seq), changes).all()
+    if any(seq % CHANGE_LOG_PRUNE_INTERVAL == 0 for seq in seqs):
+        prune = sa.delete(Change).where(Change.seq <= max(seqs) - CHANGE_LOG_SIZE)
+        session.execute(prune)
+
+
+def _lock_change_log(session: Session) -> None:
+    """Lock the change log of PostgreSQL until the transaction ends.
+
+    Changes are numbered as they are inserted but read once committed, so
+    without the lock a change could be committed after a later one had been read
+    and be skipped. SQLite transactions already write one at a time.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        lock = sa.func.pg_advisory_xact_lock(CHANGE_LOG_LOCK_KEY)
+        session.execute(sa.select(lock))
+
 
 # -----------------------------------------------------------------------
 # Messages
 
 
-def count_messages(session: Session) -> int:
-    result = session.execute(sa.select(sa.func.count(Message.id)))
+def count_messages(session: Session, search: Optional[str] = None) -> int:
+    if not search:
+        return _count_rows(session, Message)
+    statement = _search_messages(session, sa.select(sa.func.count(Message.id)), search)
+    result = session.execute(statement)
     return int(result.scalar_one())
 
 
-def create_message(session: Session, new_message: sch.CreateMessage) -> Message:
-    message = Message(content=new_message.content)
-    session.add(message)
+def create_message(
+    session: Session,
+    new_message: sch.CreateMessage,
+    duplicates: DuplicatePolicy = DuplicatePolicy.ALLOW,
+) -> sch.CreatedMessage:
+    """Insert a message, checking whether it is a near duplicate of stored messages
+    according to the `duplicates` policy.
+    """
+    dedup.check_available(duplicates)
+    errors = _turn_errors(session, [new_message])
+    if errors:
+        raise errors[0]
+    (row,), (found,) = _create_messages(session, [new_message], duplicates)
+    if row is None:
+        raise DuplicateMessageError(found)
+    return sch.CreatedMessage(**row, duplicates=found)
+
+
+def create_messages(
+    session: Session,
+    new_messages: List[sch.CreateMessage],
+    duplicates: DuplicatePolicy = DuplicatePolicy.ALLOW,
+) -> Tuple[int, Dict[int, str]]:
+    """Insert messages in a single executemany statement and transaction.
+
+    Returns the number of messages which are near duplicates of stored messages
+    or of earlier messages in `new_messages`, and which are not inserted if the
+    `duplicates` policy is to reject them, with the error of each message which
+    could not be added to its conversation by its index.
+    """
+    dedup.check_available(duplicates)
+    errors = _turn_errors(session, new_messages)
+    valid = [message for i, message in enumerate(new_messages) if i not in errors]
+    found: List[List[int]] = []
+    if valid:
+        _, found = _create_messages(session, valid, duplicates)
+    session.commit()  # Releasing the conversations if no message was valid
+    return sum(map(bool, found)), {i: str(error) for i, error in errors.items()}
+
+
+def _create_messages(
+    session: Session, new_messages: List[sch.CreateMessage], policy: DuplicatePolicy
+) -> Tuple[List[Optional[Dict[str, Any]]], List[List[int]]]:
+    """Insert messages and commit, returning the row of each message, or None if
+    it was rejected, and the ids of the messages that it duplicates.
+    """
+    if not dedup.available():
+        rows: List[Optional[Dict[str, Any]]] = []
+        rows += _insert_messages(session, new_messages)
+        session.commit()
+        return rows, [[] for _ in new_messages]
+    signatures = dedup.minhash([message.content for message in new_messages])
+    stored, earlier = _find_duplicates(session, signatures, policy)
+    keep = _messages_to_keep(stored, earlier, policy)
+    inserted = iter(_insert_messages(session, list(compress(new_messages, keep))))
+    rows = [next(inserted) if kept else None for kept in keep]
+    ids = [row["id"] if row else None for row in rows]
+    found = [
+        stored_ids + _inserted_ids(ids, indices)
+        for stored_ids, indices in zip(stored, earlier)
+    ]
+    links = [
+        min(f, default=None) if policy == DuplicatePolicy.LINK else None for f in found
+    ]
+    _index_messages(session, ids, signatures, links)
     session.commit()
-    session.refresh(message)
-    return message
+    return rows, found
+
+
+def _insert_messages(
+    session: Session, new_messages: List[sch.CreateMessage]
+) -> List[Dict[str, Any]]:
+    """Insert messages, returning their rows with the ids they were given."""
+    if not new_messages:
+        return []
+    rows = [message.model_dump() for message in new_messages]
+    _number_turns(session, rows)
+    if _can_copy(session, len(rows)):
+        ids = _copy_messages(session, rows)
+    else:
+        # Ids are assigned in the order rows are inserted, so sorting them matches
+        # them to the rows without returning them one row at a time
+        statement = sa.insert(Message).returning(Message.id)
+        ids = sorted(session.scalars(statement, rows))
+    messages = [{"id": message_id, **row} for message_id, row in zip(ids, rows)]
+    _bump_versions(session, Message)
+    _log_changes(session, Message, sch.ChangeOperation.CREATE, messages)
+    return messages
+
+
+def _can_copy(session: Session, rows: int) -> bool:
+    dialect = session.get_bind().dialect
+    copies = dialect.name == "postgresql" and dialect.driver == "psycopg"
+    return copies and rows >= COPY_MIN_ROWS
+
+
+def _copy_messages(session: Session, rows: List[Dict[str, Any]]) -> List[int]:
+    """Insert messages into PostgreSQL with COPY, returning their ids.
+
+    COPY cannot return the ids it assigns, so they are reserved from the
+    sequence of the table first.
+    """
+    sequence = sa.func.pg_get_serial_sequence(Message.__tablename__, "id")
+    reserve = sa.select(sa.func.nextval(sequence)).select_from(
+        sa.func.generate_series(1, len(rows))
+    )
+    ids = sorted(session.scalars(reserve))
+    columns = ["content", "conversation_id", "turn_idx"]
+    copy_statement = (
+        f"COPY {Message.__tablename__} (id, {', '.join(columns)}) FROM STDIN"
+    )
+    cursor: Any = session.connection().connection.cursor()  # Of psycopg
+    with cursor, cursor.copy(copy_statement) as copy:
+        for message_id, row in zip(ids, rows):
+            copy.write_row([message_id, *(row[column] for column in columns)])
+    return ids
+
+
+def _inserted_ids(ids: List[Optional[int]], indices: List[int]) -> List[int]:
+    inserted = (ids[i] for i in indices)
+    return [message_id for message_id in inserted if message_id is not None]
 
 
 def read_messages(
@@ -33,60 +333,595 @@ def read_messages(
     offset: int = 0,
     sort_by: Optional[str] = None,
     sort_asc: bool = True,
-) -> List[Any]:
-    statement = sa.select(Message)
-    if search is not None:
-        statement = statement.where(Message.content.contains(search))
+) -> List[sa.Row[Any]]:
+    statement = sa.select(Message.id, Message.content)
+    if search:
+        statement = _search_messages(session, statement, search)
     statement = statement.limit(limit).offset(offset)
     if sort_by:
         statement = statement.order_by(
             sa.asc(sort_by) if sort_asc else sa.desc(sort_by)
         )
-    result = session.scalars(statement).all()
+    elif search and _uses_search_index(session, search):
+        statement = statement.order_by(message_search.c.rank)
+    else:
+        statement = statement.order_by(Message.id)
+    result = session.execute(statement).all()
     return list(result)
 
 
+SORTABLE_MESSAGE_COLUMNS: Dict[str, sa.Column[Any]] = {
+    "id": Message.id,
+    "content": Message.content,
+}
+
+
+def read_messages_page(
+    session: Session,
+    search: Optional[str] = None,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    sort_by: str = "id",
+    sort_asc: bool = True,
+) -> Tuple[List[sa.Row[Any]], Optional[str]]:
+    """Read a page of messages following `cursor` and a cursor for the next page.
+
+    Pages are found by seeking past the `(sort_by, id)` key of the last message
+    of the previous page so that deep pages are as cheap as the first one.
+    """
+    column = SORTABLE_MESSAGE_COLUMNS.get(sort_by)
+    if column is None:
+        raise InvalidSortColumnError(sort_by)
+    statement = sa.select(Message.id, Message.content)
+    if search:
+        statement = _search_messages(session, statement, search)
+    if cursor:
+        statement = statement.where(_after_cursor(column, cursor, sort_asc))
+    direction = sa.asc if sort_asc else sa.desc
+    statement = statement.order_by(direction(column), direction(Message.id))
+    messages = list(session.execute(statement.limit(limit + 1)).all())
+    return messages[:limit], _next_cursor(messages, limit, sort_by)
+
+
+def _next_cursor(
+    messages: List[sa.Row[Any]], limit: int, sort_by: str
+) -> Optional[str]:
+    if len(messages) <= limit:
+        return None  # This is the last page
+    last = messages[limit - 1]
+    key = [getattr(last, sort_by), last.id]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+# The types of the values of sortable columns which a cursor may hold
+CURSOR_VALUE_TYPES = (str, int, float, type(None))
+
+
+def _decode_cursor(cursor: str) -> Tuple[Any, int]:
+    try:
+        value, message_id = json.loads(base64.urlsafe_b64decode(cursor))
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError(cursor) from e
+    if not isinstance(message_id, int) or not isinstance(value, CURSOR_VALUE_TYPES):
+        raise InvalidCursorError(cursor)
+    return value, message_id
+
+
+def _after_cursor(
+    column: sa.Column[Any], cursor: str, sort_asc: bool
+) -> sa.ColumnElement[bool]:
+    """Select the rows following the `(column, id)` key encoded in `cursor`."""
+    value, message_id = _decode_cursor(cursor)
+    key: sa.ColumnElement[Any]
+    last_key: sa.ColumnElement[Any]
+    if column is Message.id:
+        key, last_key = Message.id, sa.literal(message_id)
+    else:
+        key = sa.tuple_(column, Message.id)
+        last_key = sa.tuple_(sa.literal(value), sa.literal(message_id))
+    return key > last_key if sort_asc else key < last_key
+
+
+def _uses_search_index(session: Session, search: str) -> bool:
+    dialect = session.get_bind().dialect.name
+    return dialect == "sqlite" and len(search) >= SEARCH_INDEX_MIN_TERM_LENGTH
+
+
+def _search_messages(
+    session: Session, statement: sa.Select[Any], search: str
+) -> sa.Select[Any]:
+    """Filter messages containing `search`, using the full-text index if possible."""
+    if not _uses_search_index(session, search):
+        # PostgreSQL answers case-insensitive searches from its trigram index
+        return statement.where(Message.content.icontains(search))
+    phrase = '"' + search.replace('"', '""') + '"'
+    return statement.join(message_search, message_search.c.rowid == Message.id).where(
+        sa.literal_column(message_search.name).op("MATCH")(phrase)
+    )
+
+
 def update_message(session: Session, message: sch.UpdateMessage) -> None:
+    _check_annotations_fit(session, message)
+    removed = _coded_phrases(session, Annotation.message_id == message.id)
     statement = (
         sa.update(Message)
         .where(Message.id == message.id)
         .values(content=message.content)
+        .returning(Message.id)
     )
-    session.execute(statement)
+    if session.execute(statement).scalar_one_or_none() is None:
+        raise MessageNotFoundError()
+    _reindex_message(session, message)
+    added = _coded_phrases(session, Annotation.message_id == message.id)
+    # The phrases of the message's annotations change with its content
+    models = [Message, Annotation] if removed else [Message]
+    _bump_versions(session, *models)
+    _log_changes(session, Message, sch.ChangeOperation.UPDATE, [message.model_dump()])
     session.commit()
+    if removed:
+        suggestion_index.update(session, added, removed)
+
+
+def _reindex_message(session: Session, message: sch.UpdateMessage) -> None:
+    """Replace the signature of an updated message, keeping its link to the
+    message it duplicates.
+    """
+    get_link = sa.select(MessageSignature.duplicate_of_id).where(
+        MessageSignature.message_id == message.id
+    )
+    link = session.execute(get_link).scalar_one_or_none()
+    _unindex_messages(session, [message.id])
+    if dedup.available():
+        signatures = dedup.minhash([message.content])
+        _index_messages(session, [message.id], signatures, [link])
+
+
+def _check_annotations_fit(session: Session, message: sch.UpdateMessage) -> None:
+    """Check that the spans of the annotations of a message fall within its new
+    content, so that shortening it cannot leave them outside of it.
+    """
+    get_end = sa.select(sa.func.max(Annotation.end_idx)).where(
+        Annotation.message_id == message.id
+    )
+    end = session.execute(get_end).scalar_one()
+    if end is not None and end > len(message.content):
+        raise InvalidSpanError()
 
 
 def delete_message(session: Session, message: sch.DeleteMessage) -> None:
+    removed = _coded_phrases(session, Annotation.message_id == message.id)
+    # Not left to the database, as its foreign keys may not cascade deletes
+    delete_annotations = (
+        sa.delete(Annotation)
+        .where(Annotation.message_id == message.id)
+        .returning(Annotation.id)
+    )
+    annotation_ids = session.scalars(delete_annotations).all()
     statement = sa.delete(Message).where(Message.id == message.id)
     session.execute(statement)
+    _unindex_messages(session, [message.id])
+    unlink = (
+        sa.update(MessageSignature)
+        .where(MessageSignature.duplicate_of_id == message.id)
+        .values(duplicate_of_id=None)
+    )
+    session.execute(unlink)
+    _bump_versions(session, Message, Annotation)
+    _log_changes(session, Message, sch.ChangeOperation.DELETE, [message.model_dump()])
+    deleted = [{"id": annotation_id} for annotation_id in annotation_ids]
+    _log_changes(session, Annotation, sch.ChangeOperation.DELETE, deleted)
+    session.commit()
+    suggestion_index.update(session, [], removed)
+
+
+# -----------------------------------------------------------------------
+# Conversations
+
+
+def create_conversation(
+    session: Session, new_conversation: sch.CreateConversation
+) -> Conversation:
+    conversation = Conversation(name=new_conversation.name)
+    session.add(conversation)
+    session.flush()
+    row = {"id": conversation.id, "name": conversation.name}
+    _log_changes(session, Conversation, sch.ChangeOperation.CREATE, [row])
     session.commit()
+    session.refresh(conversation)
+    return conversation
+
+
+def read_conversations(
+    session: Session, limit: Optional[int] = None, offset: int = 0
+) -> List[sa.Row[Any]]:
+    statement = (
+        sa.select(Conversation.id, Conversation.name)
+        .order_by(Conversation.id)
+        .limit(limit)
+        .offset(offset)
+    )
+    return list(session.execute(statement).all())
+
+
+def _turn_errors(
+    session: Session, new_messages: List[sch.CreateMessage]
+) -> Dict[int, Exception]:
+    """Find the messages which cannot be added to their conversations by index,
+    as the conversation does not exist or the turn given is already taken.
+
+    The conversations are locked until the transaction ends, so that messages
+    appended to them concurrently are not given the same turns.
+    """
+    conversation_ids = {message.conversation_id for message in new_messages} - {None}
+    if not conversation_ids:
+        return {}
+    lock = (
+        sa.select(Conversation.id)
+        .where(Conversation.id.in_(conversation_ids))
+        .order_by(Conversation.id)
+        .with_for_update()
+    )
+    conversations = set(session.scalars(lock))
+    taken = _taken_turns(session, new_messages)
+    errors: Dict[int, Exception] = {}
+    for i, message in enumerate(new_messages):
+        error = _turn_error(message, conversations, taken)
+        if error is not None:
+            errors[i] = error
+    return errors
+
+
+def _taken_turns(
+    session: Session, new_messages: List[sch.CreateMessage]
+) -> Set[Tuple[Optional[int], Optional[int]]]:
+    """Find the stored `(conversation id, turn)` pairs among those given."""
+    conversation_ids = {message.conversation_id for message in new_messages}
+    turns = {message.turn_idx for message in new_messages} - {None}
+    statement = sa.select(Message.conversation_id, Message.turn_idx).where(
+        Message.conversation_id.in_(conversation_ids - {None}),
+        Message.turn_idx.in_(turns),
+    )
+    return set(session.execute(statement).tuples())
+
+
+def _turn_error(
+    message: sch.CreateMessage,
+    conversations: Set[int],
+    taken: Set[Tuple[Optional[int], Optional[int]]],
+) -> Optional[Exception]:
+    """Check that a message can be added to its conversation, taking its turn."""
+    if message.conversation_id is None:
+        return None
+    if message.conversation_id not in conversations:
+        return ConversationNotFoundError("Conversation not found")
+    turn = (message.conversation_id, message.turn_idx)
+    if message.turn_idx is not None and turn in taken:
+        return DuplicateTurnError("Turn is already taken")
+    taken.add(turn)
+    return None
+
+
+def _number_turns(session: Session, rows: List[Dict[str, Any]]) -> None:
+    """Number the turns of messages appended to conversations without one, in
+    order following the last turn of each conversation.
+    """
+    next_turns = _next_turns(session, rows)
+    for row in rows:
+        if row["conversation_id"] is not None and row["turn_idx"] is None:
+            row["turn_idx"] = next_turns[row["conversation_id"]]
+            next_turns[row["conversation_id"]] += 1
+
+
+def _next_turns(session: Session, rows: List[Dict[str, Any]]) -> Dict[int, int]:
+    """Find the turn following the last message of the conversation of each
+    row, including the turns given to the rows.
+    """
+    conversation_ids = {row["conversation_id"] for row in rows} - {None}
+    if not conversation_ids:
+        return {}
+    statement = (
+        sa.select(Message.conversation_id, sa.func.max(Message.turn_idx))
+        .where(Message.conversation_id.in_(conversation_ids))
+        .group_by(Message.conversation_id)
+    )
+    last_turns = dict(session.execute(statement).tuples().all())
+    for row in rows:
+        if row["conversation_id"] is not None and row["turn_idx"] is not None:
+            last = last_turns.get(row["conversation_id"], -1)
+            last_turns[row["conversation_id"]] = max(last, row["turn_idx"])
+    return {
+        conversation_id: last_turns.get(conversation_id, -1) + 1
+        for conversation_id in conversation_ids
+    }
+
+
+TURN_COLUMNS = (Message.id, Message.content, Message.conversation_id, Message.turn_idx)
+
+
+def read_context(session: Session, message_id: int, turns: int) -> List[sa.Row[Any]]:
+    """Read a message with the messages up to `turns` turns before and after it in
+    its conversation, in order.
+
+    The window is read with a single range scan of the index of the turns of each
+    conversation, so its cost depends on `turns` rather than on the corpus.
+    """
+    target = aliased(Message)
+    statement = (
+        sa.select(*TURN_COLUMNS)
+        .join(target, Message.conversation_id == target.conversation_id)
+        .where(
+            target.id == message_id,
+            Message.turn_idx.between(target.turn_idx - turns, target.turn_idx + turns),
+        )
+        .order_by(Message.turn_idx, Message.id)
+    )
+    rows = list(session.execute(statement).all())
+    if rows:
+        return rows
+    # The message is not a numbered turn of a conversation, if it exists at all
+    rows = list(
+        session.execute(sa.select(*TURN_COLUMNS).where(Message.id == message_id))
+    )
+    if not rows:
+        raise MessageNotFoundError()
+    return rows
+
+
+# -----------------------------------------------------------------------
+# Duplicates
+
+# When numpy is installed, the MinHash signature of every message is stored with
+# the hashes of its bands, so that the near duplicates of a message can be found
+# by looking up its band hashes rather than by comparing it with every message.
+
+
+def _find_duplicates(
+    session: Session, signatures: "NDArray[Any]", policy: DuplicatePolicy
+) -> Tuple[List[List[int]], List[List[int]]]:
+    """Find the ids of the stored messages and the indices of the earlier new
+    messages that each of `signatures` duplicates, unless duplicates are allowed.
+    """
+    if policy == DuplicatePolicy.ALLOW:
+        return [[] for _ in signatures], [[] for _ in signatures]
+    candidates = _stored_candidates(session, dedup.band_hashes(signatures))
+    stored = _read_signatures(session, set(chain.from_iterable(candidates)))
+    found = [
+        sorted(
+            message_id
+            for message_id in message_ids
+            if dedup.similarity(signature, stored[message_id]) >= DEDUP_THRESHOLD
+        )
+        for signature, message_ids in zip(signatures, candidates)
+    ]
+    return found, dedup.find_earlier_duplicates(signatures, DEDUP_THRESHOLD)
+
+
+def _stored_candidates(session: Session, hashes: "NDArray[Any]") -> List[Set[int]]:
+    """Find the stored messages sharing a band hash with each row of `hashes`."""
+    candidates: List[Set[int]] = [set() for _ in hashes]
+    for band, band_hashes in enumerate(hashes.T.tolist()):
+        rows = _rows_by_value(band_hashes)
+        statement = sa.select(MessageBand.hash, MessageBand.message_id).where(
+            MessageBand.band == band, MessageBand.hash.in_(rows)
+        )
+        for band_hash, message_id in session.execute(statement).tuples():
+            for row in rows[band_hash]:
+                candidates[row].add(message_id)
+    return candidates
+
+
+def _rows_by_value(values: List[int]) -> Dict[int, List[int]]:
+    rows: Dict[int, List[int]] = {}
+    for row, value in enumerate(values):
+        rows.setdefault(value, []).append(row)
+    return rows
+
+
+def _read_signatures(
+    session: Session, message_ids: Set[int]
+) -> Dict[int, "NDArray[Any]"]:
+    statement = sa.select(
+        MessageSignature.message_id, MessageSignature.signature
+    ).where(MessageSignature.message_id.in_(message_ids))
+    rows = session.execute(statement).tuples()
+    return {message_id: dedup.from_bytes(data) for message_id, data in rows}
+
+
+def _messages_to_keep(
+    stored: List[List[int]], earlier: List[List[int]], policy: DuplicatePolicy
+) -> List[bool]:
+    """Reject messages duplicating a stored message or an earlier kept message."""
+    keep = [True] * len(stored)
+    if policy == DuplicatePolicy.REJECT:
+        for i, (stored_ids, indices) in enumerate(zip(stored, earlier)):
+            keep[i] = not stored_ids and not any(keep[j] for j in indices)
+    return keep
+
+
+def _index_messages(
+    session: Session,
+    ids: Sequence[Optional[int]],
+    signatures: "NDArray[Any]",
+    links: Optional[List[Optional[int]]] = None,
+) -> None:
+    """Store the signatures and band hashes of messages, linking each to the
+    message in `links` that it duplicates. Messages without an id are skipped.
+    """
+    if links is None:
+        links = [None] * len(ids)
+    indexed = [(i, message_id) for i, message_id in enumerate(ids) if message_id]
+    if not indexed:
+        return
+    hashes = dedup.band_hashes(signatures).tolist()
+    signature_rows = [
+        {
+            "message_id": message_id,
+            "signature": dedup.to_bytes(signatures[i]),
+            "duplicate_of_id": links[i],
+        }
+        for i, message_id in indexed
+    ]
+    band_rows = [
+        {"band": band, "hash": band_hash, "message_id": message_id}
+        for i, message_id in indexed
+        for band, band_hash in enumerate(hashes[i])
+    ]
+    # Inserting through the connection skips the ORM's bookkeeping of each row
+    connection = session.connection()
+    connection.execute(sa.insert(MessageSignature), signature_rows)
+    connection.execute(sa.insert(MessageBand), band_rows)
+
+
+def _unindex_messages(session: Session, message_ids: List[int]) -> None:
+    for model in (MessageSignature, MessageBand):
+        session.execute(sa.delete(model).where(model.message_id.in_(message_ids)))
+
+
+def _index_unindexed_messages(session: Session) -> None:
+    """Store the signatures of messages created without them, such as before
+    numpy was installed.
+    """
+    statement = (
+        sa.select(Message.id, Message.content)
+        .outerjoin(MessageSignature, MessageSignature.message_id == Message.id)
+        .where(MessageSignature.message_id.is_(None))
+    )
+    rows = session.execute(statement).tuples().all()
+    for start in range(0, len(rows), IMPORT_BATCH_SIZE):
+        ids, contents = zip(*rows[start : start + IMPORT_BATCH_SIZE])
+        _index_messages(session, ids, dedup.minhash(contents))
+    session.commit()
+
+
+def read_duplicate_clusters(
+    session: Session, threshold: float = DEDUP_THRESHOLD
+) -> List[List[int]]:
+    """Group the ids of messages into clusters of near duplicates.
+
+    Only messages sharing the hash of a band with another message can be near
+    duplicates, so these candidates are found from the band index and their
+    signatures compared, rather than comparing every pair of messages.
+    """
+    dedup.check_available(DuplicatePolicy.CHECK)
+    _index_unindexed_messages(session)
+    shared = (
+        sa.select(MessageBand.band, MessageBand.hash)
+        .group_by(MessageBand.band, MessageBand.hash)
+        .having(sa.func.count() > 1)
+        .subquery()
+    )
+    candidates = sa.select(MessageBand.message_id).join(
+        shared,
+        (MessageBand.band == shared.c.band) & (MessageBand.hash == shared.c.hash),
+    )
+    statement = (
+        sa.select(MessageSignature.message_id, MessageSignature.signature)
+        .where(MessageSignature.message_id.in_(candidates))
+        .order_by(MessageSignature.message_id)
+    )
+    rows = session.execute(statement).tuples().all()
+    if not rows:
+        return []
+    ids, data = zip(*rows)
+    signatures = dedup.from_bytes(b"".join(data)).reshape(len(ids), -1)
+    return dedup.find_clusters(ids, signatures, threshold)
 
 
 # -----------------------------------------------------------------------
 # Codes
 
+# Codes are read from memory, so every write to them must invalidate the cache
+code_cache = CodeCache(shared=CODE_CACHE_SHARED)
+
 
 def count_codes(session: Session) -> int:
-    result = session.execute(sa.select(sa.func.count(Code.id)))
+    return _count_rows(session, Code)
+
+
+def _count_rows(session: Session, model: Type[Base]) -> int:
+    """Count the rows of a table, using the maintained row count if possible."""
+    if session.get_bind().dialect.name == "sqlite":
+        get_count = sa.select(RowCount.count).where(
+            RowCount.table_name == model.__tablename__
+        )
+        count = session.execute(get_count).scalar_one_or_none()
+        if count is not None:
+            return int(count)
+    result = session.execute(sa.select(sa.func.count()).select_from(model))
     return int(result.scalar_one())
 
 
 def create_code(session: Session, new_code: sch.CreateCode) -> Optional[Code]:
-    parts = new_code.code.split("/")
-    current_code_string = ""
-    current_code = None
-    for part in parts:
-        if not part:
-            continue  # Skip empty string if new_code.code starts with '/'
-        current_code_string += "/" + part
-        check_if_exists = sa.select(Code).where(Code.code == current_code_string)
-        code = session.execute(check_if_exists).scalar_one_or_none()
-        if not code:
-            current_code = Code(code=current_code_string)
-            session.add(current_code)
+    """Create a code and any of its missing ancestors.
+
+    Returns the new code, or None if it already existed.
+    """
+    paths = _code_paths([new_code.code])
+    new_codes = [Code(code=path) for path in _missing_code_paths(session, paths)]
+    session.add_all(new_codes)
+    session.flush()
+    rows = [{"id": code.id, "code": code.code} for code in new_codes]
+    _bump_versions(session, Code)
+    _log_changes(session, Code, sch.ChangeOperation.CREATE, rows)
     session.commit()
-    session.refresh(current_code)
-    return current_code  # Return only the original
+    code_cache.invalidate()
+    if not new_codes or new_codes[-1].code != paths[-1]:
+        return None
+    session.refresh(new_codes[-1])
+    return new_codes[-1]  # Return only the original
+
+
+def import_codes(session: Session, codebook: sch.ImportCodes) -> sch.ImportCodesResult:
+    """Create every code in `codebook` and any of their missing ancestors at once."""
+    paths = _code_paths([*codebook.codes, *_flatten_code_tree(codebook.tree)])
+    missing = _missing_code_paths(session, paths)
+    if missing:
+        insert = sa.insert(Code).returning(Code.id, Code.code)
+        rows = session.execute(insert, [{"code": path} for path in missing])
+        created = [row._asdict() for row in rows]
+        _bump_versions(session, Code)
+        _log_changes(session, Code, sch.ChangeOperation.CREATE, created)
+    session.commit()
+    code_cache.invalidate()
+    return sch.ImportCodesResult(
+        created=len(missing), existing=len(paths) - len(missing)
+    )
+
+
+def _code_paths(codes: List[str]) -> List[str]:
+    """List the unique paths of `codes` and their ancestors, parents first."""
+    paths: Dict[str, None] = {}
+    for code in codes:
+        parts = [part for part in code.split("/") if part]
+        for i in range(1, len(parts) + 1):
+            paths["/" + "/".join(parts[:i])] = None
+    return list(paths)
+
+
+def _missing_code_paths(session: Session, paths: List[str]) -> List[str]:
+    """Find which of `paths` are not yet codes with a query per batch of them,
+    keeping within the number of parameters a query can bind.
+    """
+    existing: Set[str] = set()
+    for start in range(0, len(paths), IMPORT_BATCH_SIZE):
+        batch = paths[start : start + IMPORT_BATCH_SIZE]
+        existing.update(
+            session.scalars(sa.select(Code.code).where(Code.code.in_(batch)))
+        )
+    return [path for path in paths if path not in existing]
+
+
+def _flatten_code_tree(tree: Dict[str, Any], prefix: str = "") -> List[str]:
+    """List the leaf codes of a tree of nested code segments."""
+    codes = []
+    for segment, children in tree.items():
+        code = f"{prefix}/{segment}"
+        is_leaf = not isinstance(children, dict) or not children
+        codes += [code] if is_leaf else _flatten_code_tree(children, code)
+    return codes
+
+
+SORTABLE_CODE_COLUMNS = ("id", "code")
 
 
 def read_codes(
@@ -94,39 +929,92 @@ def read_codes(
     search: Optional[str] = None,
     sort_by: Optional[str] = None,
     sort_asc: bool = True,
-) -> List[Any]:
-    statement = sa.select(Code)
-    if search is not None:
-        statement = statement.where(Code.code.contains(search))
-    column = sort_by if sort_by is not None else "code"
-    ordering: sa.UnaryExpression[Any] = (
-        sa.asc(column) if sort_by is None or sort_asc else sa.desc(column)
-    )
-    statement = statement.order_by(ordering)
-    result = session.scalars(statement).all()
-    return list(result)
+) -> List[Dict[str, Any]]:
+    """Read codes from the cache, matching `search` case insensitively like SQL."""
+    if sort_by is not None and sort_by not in SORTABLE_CODE_COLUMNS:
+        raise InvalidSortColumnError()
+    codes = [
+        {"id": code_id, "code": code}
+        for code_id, code in code_cache.get(session).codes.items()
+        if search is None or search.lower() in code.lower()
+    ]
+    # Codes are always in ascending order unless sorted explicitly
+    descending = sort_by is not None and not sort_asc
+    codes.sort(key=itemgetter(sort_by or "code"), reverse=descending)
+    return codes
 
 
 def update_code(session: Session, new_code: sch.UpdateCode) -> None:
-    get_old_code = sa.select(Code).where(Code.id == new_code.id)
+    """Rename a code and all of its descendants in a single statement."""
+    get_old_code = sa.select(Code.code).where(Code.id == new_code.id)
     old_code = session.execute(get_old_code).scalar_one()
-    get_subcodes = sa.select(Code).where(Code.code.contains(old_code.code))
-    subcodes = session.execute(get_subcodes).scalars()
-    old_code_length = len(old_code.code)
-    for subcode in subcodes:
-        subcode.code = new_code.code + subcode.code[old_code_length:]  # type: ignore
+    suffix = sa.func.substr(Code.code, len(old_code) + 1)
+    statement = (
+        sa.update(Code)
+        .where(_code_subtree(session, old_code))
+        .values(code=sa.literal(new_code.code, sa.String) + suffix)
+        .execution_options(synchronize_session=False)
+    )
+    session.execute(statement)
+    _bump_versions(session, Code)
+    _log_reloads(session, Code)
     session.commit()
+    code_cache.invalidate()
 
 
 def delete_code(session: Session, code: sch.DeleteCode) -> None:
-    statement = sa.delete(Code).where(Code.code.contains(code.code))
-    session.execute(statement)
+    """Delete a code, all of its descendants and their annotations."""
+    subtree_ids = sa.select(Code.id).where(_code_subtree(session, code.code))
+    delete_annotations = sa.delete(Annotation).where(
+        Annotation.code_id.in_(subtree_ids)
+    )
+    session.execute(
+        delete_annotations, execution_options={"synchronize_session": False}
+    )
+    session.execute(sa.delete(Code).where(_code_subtree(session, code.code)))
+    _bump_versions(session, Code, Annotation)
+    _log_reloads(session, Code, Annotation)
     session.commit()
+    code_cache.invalidate()
+    suggestion_index.invalidate()
+
+
+def _code_subtree(session: Session, code: str) -> sa.ColumnElement[bool]:
+    """Match `code` and its descendants using range scans of the code index.
+
+    Descendants of `/a` are the codes between `/a/` inclusive and `/a0` exclusive,
+    as `0` is the character following `/`. PostgreSQL compares text by its
+    locale rather than character by character, so matches them by prefix instead.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        # Escaped with backslashes, the default escape character of LIKE
+        escaped = code.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return sa.or_(Code.code == code, Code.code.like(escaped + "/%"))
+    return sa.or_(
+        Code.code == code,
+        sa.and_(Code.code >= code + "/", Code.code < code + "0"),
+    )
 
 
 # -----------------------------------------------------------------------
 # Annotations
 
+# Coded phrases are indexed in memory to suggest annotations, so every write to
+# annotations must update the index
+suggestion_index = SuggestionIndex(shared=CODE_CACHE_SHARED)
+
+
+def _coded_phrases(
+    session: Session, condition: sa.ColumnElement[bool]
+) -> List[Tuple[str, int]]:
+    """Read the phrase and code id of each annotation matching `condition`."""
+    statement = (
+        sa.select(annotation_phrase, Annotation.code_id)
+        .join(Message, Message.id == Annotation.message_id)
+        .where(condition)
+    )
+    return list(session.execute(statement).tuples())
+
 
 def create_annotation(
     session: Session, new_annotation: sch.CreateAnnotation
@@ -135,6 +1023,10 @@ def create_annotation(
     message = session.execute(get_message).scalar_one_or_none()
     if message is None:
         raise MessageNotFoundError()
+    if message.content is not None and not _span_fits(
+        new_annotation, len(message.content)
+    ):
+        raise InvalidSpanError()
     annotation = Annotation(
         code_id=new_annotation.code_id,
         start_idx=new_annotation.start_idx,
@@ -143,28 +1035,132 @@ def create_annotation(
     )
     session.add(annotation)
     message.annotations.append(annotation)
+    content = str(message.content or "")
+    phrase = content[new_annotation.start_idx : new_annotation.end_idx]
+    session.flush()
+    row = {"id": annotation.id, **new_annotation.model_dump()}
+    _bump_versions(session, Annotation)
+    _log_changes(session, Annotation, sch.ChangeOperation.CREATE, [row])
     session.commit()
+    suggestion_index.update(session, [(phrase, new_annotation.code_id)])
     session.refresh(annotation)
     return annotation
 
 
-def read_annotations(session: Session, message_id: int) -> List[sch.AnnotationResponse]:
-    get_message = sa.select(Message).where(Message.id == message_id)
-    message: Message | None = session.execute(get_message).scalar_one_or_none()
-    if message is None:
+ANNOTATION_COLUMNS = (
+    Annotation.id,
+    Annotation.message_id,
+    Annotation.code_id,
+    Annotation.start_idx,
+    Annotation.end_idx,
+)
+
+
+def read_annotations(
+    session: Session,
+    message_id: int,
+    overlaps: Optional[Tuple[int, int]] = None,
+    covers: Optional[Tuple[int, int]] = None,
+) -> List[Dict[str, Any]]:
+    """Read the annotations of a message in a single query, with cached codes.
+
+    If given, only annotations overlapping the span `overlaps` and covering the
+    span `covers` are read, using the index of annotation spans of each message.
+    """
+    spans = _span_conditions(overlaps, covers)
+    statement: sa.Select[Any] = (
+        sa.select(Message.id.label("found_message_id"), *ANNOTATION_COLUMNS)
+        .outerjoin(Annotation, sa.and_(Annotation.message_id == Message.id, *spans))
+        .where(Message.id == message_id)
+        .order_by(Annotation.id)
+    )
+    rows = session.execute(statement).all()
+    if not rows:
         raise MessageNotFoundError()
+    return _annotation_responses(session, rows)
+
+
+def _span_conditions(
+    overlaps: Optional[Tuple[int, int]], covers: Optional[Tuple[int, int]]
+) -> List[sa.ColumnElement[bool]]:
+    conditions = []
+    if overlaps is not None:
+        start, end = overlaps
+        conditions += [Annotation.start_idx < end, Annotation.end_idx > start]
+    if covers is not None:
+        start, end = covers
+        conditions += [Annotation.start_idx <= start, Annotation.end_idx >= end]
+    return conditions
+
+
+def read_annotations_for_messages(
+    session: Session, message_ids: List[int]
+) -> List[Dict[str, Any]]:
+    """Read the annotations of many messages in a single query, with cached codes."""
+    statement: sa.Select[Any] = (
+        sa.select(*ANNOTATION_COLUMNS)
+        .where(Annotation.message_id.in_(message_ids))
+        .order_by(Annotation.message_id, Annotation.id)
+    )
+    return _annotation_responses(session, session.execute(statement).all())
+
+
+def _annotation_responses(
+    session: Session, rows: Sequence[sa.Row[Any]]
+) -> List[Dict[str, Any]]:
+    """Build the serialised form of `sch.AnnotationResponse` for each annotation
+    in `rows` with an existing code.
+    """
+    codes = code_cache.get(session).codes
     return [
-        sch.AnnotationResponse(
-            result=(
-                sch.Annotation.model_validate(annotation),
-                sch.Code.model_validate(annotation.code),
-            )
-        )
-        for annotation in message.annotations
+        _annotation_response(row, codes[row.code_id])
+        for row in rows
+        if row.code_id in codes
+    ]
+
+
+def _annotation_response(row: sa.Row[Any], code: str) -> Dict[str, Any]:
+    annotation = {
+        "code_id": row.code_id,
+        "start_idx": row.start_idx,
+        "end_idx": row.end_idx,
+        "id": row.id,
+        "message_id": row.message_id,
+    }
+    return {"result": [annotation, {"code": code, "id": row.code_id}]}
+
+
+def read_suggestions(session: Session, message_id: int) -> List[Dict[str, Any]]:
+    """Suggest annotations of a message where its content contains a phrase
+    annotated in any message, with the number of times each code was applied.
+
+    Spans already annotated with the same code are not suggested.
+    """
+    get_content = sa.select(Message.content).where(Message.id == message_id)
+    content = session.execute(get_content).scalar_one_or_none()
+    if content is None:
+        raise MessageNotFoundError()
+    get_annotated = sa.select(
+        Annotation.start_idx, Annotation.end_idx, Annotation.code_id
+    ).where(Annotation.message_id == message_id)
+    annotated = set(session.execute(get_annotated).tuples())
+    codes = code_cache.get(session).codes
+    return [
+        {
+            "start_idx": start,
+            "end_idx": end,
+            "code_id": code_id,
+            "code": codes[code_id],
+            "count": count,
+        }
+        for start, end, code_id, count in suggestion_index.suggest(session, content)
+        if code_id in codes and (start, end, code_id) not in annotated
     ]
 
 
 def update_annotation(session: Session, annotation: sch.UpdateAnnotation) -> None:
+    _check_spans(session, [], [annotation])
+    removed = _coded_phrases(session, Annotation.id == annotation.id)
     statement = (
         sa.update(Annotation)
         .where(Annotation.id == annotation.id)
@@ -175,10 +1171,238 @@ def update_annotation(session: Session, annotation: sch.UpdateAnnotation) -> Non
         )
     )
     session.execute(statement)
+    added = _coded_phrases(session, Annotation.id == annotation.id)
+    _bump_versions(session, Annotation)
+    _log_changes(
+        session, Annotation, sch.ChangeOperation.UPDATE, [annotation.model_dump()]
+    )
     session.commit()
+    suggestion_index.update(session, added, removed)
 
 
 def delete_annotation(session: Session, annotation: sch.DeleteAnnotation) -> None:
+    removed = _coded_phrases(session, Annotation.id == annotation.id)
     statement = sa.delete(Annotation).where(Annotation.id == annotation.id)
     session.execute(statement)
+    _bump_versions(session, Annotation)
+    _log_changes(
+        session, Annotation, sch.ChangeOperation.DELETE, [annotation.model_dump()]
+    )
     session.commit()
+    suggestion_index.update(session, [], removed)
+
+
+def apply_annotation_batch(
+    session: Session, batch: sch.AnnotationBatch
+) -> sch.AnnotationBatchResult:
+    """Create, update and delete annotations in a single transaction."""
+    _check_annotation_references(session, batch)
+    _check_spans(session, batch.create, batch.update)
+    updated_ids = [annotation.id for annotation in batch.update]
+    deleted_ids = [annotation.id for annotation in batch.delete]
+    removed = _coded_phrases(session, Annotation.id.in_([*updated_ids, *deleted_ids]))
+    created: List[int] = []
+    if batch.create:
+        rows = [annotation.model_dump() for annotation in batch.create]
+        created = sorted(
+            session.scalars(sa.insert(Annotation).returning(Annotation.id), rows)
+        )
+    if batch.update:
+        rows = [annotation.model_dump() for annotation in batch.update]
+        session.execute(sa.update(Annotation), rows)
+    if batch.delete:
+        session.execute(sa.delete(Annotation).where(Annotation.id.in_(deleted_ids)))
+    added = _coded_phrases(session, Annotation.id.in_([*created, *updated_ids]))
+    _bump_versions(session, Annotation)
+    _log_annotation_batch(session, batch, created)
+    session.commit()
+    suggestion_index.update(session, added, removed)
+    return sch.AnnotationBatchResult(
+        created=created, updated=len(set(updated_ids)), deleted=len(set(deleted_ids))
+    )
+
+
+def _log_annotation_batch(
+    session: Session, batch: sch.AnnotationBatch, created: List[int]
+) -> None:
+    created_rows = [
+        {"id": annotation_id, **annotation.model_dump()}
+        for annotation_id, annotation in zip(created, batch.create)
+    ]
+    updated_rows = [annotation.model_dump() for annotation in batch.update]
+    deleted_rows = [annotation.model_dump() for annotation in batch.delete]
+    _log_changes(session, Annotation, sch.ChangeOperation.CREATE, created_rows)
+    _log_changes(session, Annotation, sch.ChangeOperation.UPDATE, updated_rows)
+    _log_changes(session, Annotation, sch.ChangeOperation.DELETE, deleted_rows)
+
+
+def _check_annotation_references(session: Session, batch: sch.AnnotationBatch) -> None:
+    """Check that every message, code and annotation referenced by `batch` exists."""
+    message_ids = {annotation.message_id for annotation in batch.create}
+    code_ids = {annotation.code_id for annotation in [*batch.create, *batch.update]}
+    annotation_ids = {annotation.id for annotation in batch.update}
+    annotation_ids.update(annotation.id for annotation in batch.delete)
+    statement: sa.CompoundSelect = sa.union_all(
+        sa.select(sa.literal("message"), Message.id).where(Message.id.in_(message_ids)),
+        sa.select(sa.literal("code"), Code.id).where(Code.id.in_(code_ids)),
+        sa.select(sa.literal("annotation"), Annotation.id).where(
+            Annotation.id.in_(annotation_ids)
+        ),
+    )
+    found = {(table, row_id) for table, row_id in session.execute(statement)}
+    if any(("message", row_id) not in found for row_id in message_ids):
+        raise MessageNotFoundError()
+    if any(("code", row_id) not in found for row_id in code_ids):
+        raise CodeNotFoundError()
+    if any(("annotation", row_id) not in found for row_id in annotation_ids):
+        raise AnnotationNotFoundError()
+
+
+def _check_spans(
+    session: Session,
+    new_annotations: List[sch.CreateAnnotation],
+    annotations: List[sch.UpdateAnnotation],
+) -> None:
+    """Check that the spans of annotations fall within the content of their
+    messages, which are found by message id or annotation id respectively.
+    """
+    length = sa.func.length(Message.content)
+    message_ids = {annotation.message_id for annotation in new_annotations}
+    get_message_lengths = sa.select(Message.id, length).where(
+        Message.id.in_(message_ids)
+    )
+    message_lengths = dict(session.execute(get_message_lengths).tuples().all())
+    annotation_ids = {annotation.id for annotation in annotations}
+    get_annotation_lengths = (
+        sa.select(Annotation.id, length)
+        .join(Message, Message.id == Annotation.message_id)
+        .where(Annotation.id.in_(annotation_ids))
+    )
+    annotation_lengths = dict(session.execute(get_annotation_lengths).tuples().all())
+    spans = [
+        *((a, message_lengths.get(a.message_id)) for a in new_annotations),
+        *((a, annotation_lengths.get(a.id)) for a in annotations),
+    ]
+    if not all(_span_fits(annotation, length) for annotation, length in spans):
+        raise InvalidSpanError()
+
+
+def _span_fits(annotation: sch.AnnotationBase, length: Optional[int]) -> bool:
+    """Check that a span is within content of `length`, if the content exists."""
+    return length is None or 0 <= annotation.start_idx <= annotation.end_idx <= length
+
+
+# -----------------------------------------------------------------------
+# Dataset
+
+
+def read_dataset(
+    session: Session, code: Optional[str] = None, batch_size: int = EXPORT_BATCH_SIZE
+) -> Iterator[sa.Row[Any]]:
+    """Stream every message with its annotations and their codes, one row each.
+
+    Rows are ordered by message and fetched `batch_size` at a time. If `code` is
+    given, only annotations in its subtree and the messages they annotate are read.
+    """
+    statement = sa.select(
+        Message.id.label("message_id"),
+        Message.content,
+        Annotation.id.label("annotation_id"),
+        Code.code,
+        Annotation.start_idx,
+        Annotation.end_idx,
+    )
+    if code is None:
+        statement = statement.outerjoin(
+            Annotation, Annotation.message_id == Message.id
+        ).outerjoin(Code, Code.id == Annotation.code_id)
+    else:
+        statement = (
+            statement.join(Annotation, Annotation.message_id == Message.id)
+            .join(Code, Code.id == Annotation.code_id)
+            .where(_code_subtree(session, code))
+        )
+    statement = statement.order_by(Message.id, Annotation.id)
+    yield from session.execute(statement.execution_options(yield_per=batch_size))
+
+
+# -----------------------------------------------------------------------
+# Analytics
+
+
+def read_code_frequencies(session: Session) -> List[Dict[str, Any]]:
+    """Count the annotations of each code, and of each code and its descendants.
+
+    Annotations are counted per code in SQL from the code index, then rolled up
+    the hierarchy in memory, as there are far fewer codes than annotations.
+    """
+    statement = sa.select(Annotation.code_id, sa.func.count()).group_by(
+        Annotation.code_id
+    )
+    counts: Dict[int, int] = dict(session.execute(statement).tuples().all())
+    codes = sorted(code_cache.get(session).codes.items(), key=itemgetter(1))
+    totals = dict.fromkeys((code for _, code in codes), 0)
+    for code_id, code in codes:
+        for path in _code_paths([code]):
+            totals[path] = totals.get(path, 0) + counts.get(code_id, 0)
+    return [
+        {
+            "id": code_id,
+            "code": code,
+            "count": counts.get(code_id, 0),
+            "total": totals[code],
+        }
+        for code_id, code in codes
+    ]
+
+
+def read_code_cooccurrences(
+    session: Session, min_count: int = 1
+) -> List[Dict[str, Any]]:
+    """Count the messages in which each pair of codes are both used."""
+    pairs = sa.select(Annotation.message_id, Annotation.code_id).distinct().subquery()
+    other_pairs = pairs.alias()
+    count = sa.func.count().label("count")
+    cooccurrences = (
+        sa.select(pairs.c.code_id, other_pairs.c.code_id.label("other_code_id"), count)
+        .join(
+            other_pairs,
+            sa.and_(
+                other_pairs.c.message_id == pairs.c.message_id,
+                other_pairs.c.code_id > pairs.c.code_id,
+            ),
+        )
+        .group_by(pairs.c.code_id, other_pairs.c.code_id)
+        .having(count >= min_count)
+        .subquery()
+    )
+    code, other_code = aliased(Code), aliased(Code)
+    statement = (
+        sa.select(code.code, other_code.code.label("other_code"), cooccurrences.c.count)
+        .join(code, code.id == cooccurrences.c.code_id)
+        .join(other_code, other_code.id == cooccurrences.c.other_code_id)
+        .order_by(cooccurrences.c.count.desc(), code.code, other_code.code)
+    )
+    return [row._asdict() for row in session.execute(statement)]
+
+
+def read_span_lengths(
+    session: Session, bin_width: int = 1, code: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """Count annotations by the length of their spans in bins of `bin_width`.
+
+    If `code` is given, only annotations in its subtree are counted.
+    """
+    length_bin = ((Annotation.end_idx - Annotation.start_idx) // bin_width).label("bin")
+    statement = sa.select(length_bin, sa.func.count()).group_by(length_bin)
+    if code is not None:
+        subtree_ids = code_cache.get(session).subtree(code)
+        statement = statement.where(Annotation.code_id.in_(list(subtree_ids)))
+    return [
+        {
+            "min_length": index * bin_width,
+            "max_length": (index + 1) * bin_width - 1,
+            "count": count,
+        }
+        for index, count in session.execute(statement.order_by(length_bin))
+    ]
@@ -1,12 +1,262 @@
 """Set up the database components."""
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from functools import wraps
+from typing import (
+    IO,
+    Any,
+    AsyncIterator,
+    Callable,
+    Concatenate,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    ParamSpec,
+    Type,
+    TypeVar,
+    Union,
+)
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import (
+    AsyncAdaptedQueuePool,
+    Connection,
+    Engine,
+    Pool,
+    QueuePool,
+    create_engine,
+    event,
+    inspect,
+    make_url,
+)
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+from sqlalchemy.orm import Session, sessionmaker
 
-from .config import DATABASE_URL
+from . import models
 
-engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}  # Required for sqlite3
+try:
+    import fcntl
+except ImportError:  # File locks are only available on Unix
+    fcntl = None  # type: ignore[assignment]
+
+from .config import (
+    ASYNC_DATABASE_URL,
+    DATABASE_ASYNC,
+    DATABASE_MAX_OVERFLOW,
+    DATABASE_POOL_SIZE,
+    DATABASE_POOL_TIMEOUT,
+    DATABASE_URL,
+    SQLITE_PRAGMAS,
 )
 
+
+def _engine_options(url: str, poolclass: Type[Pool]) -> Dict[str, Any]:
+    options: Dict[str, Any] = {}
+    database_url = make_url(url)
+    if database_url.get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}  # Required for sqlite3
+        if database_url.database in (None, "", ":memory:"):
+            return options  # Each pooled connection would be a separate database
+    options["poolclass"] = poolclass
+    options["pool_size"] = DATABASE_POOL_SIZE
+    options["max_overflow"] = DATABASE_MAX_OVERFLOW
+    options["pool_timeout"] = DATABASE_POOL_TIMEOUT
+    options["pool_pre_ping"] = True
+    return options
+
+
+def _set_sqlite_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def _configure(engine: Engine) -> Engine:
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+def create_database_engine(url: str) -> Engine:
+    """Create a pooled engine, tuning connections for concurrent use of SQLite."""
+    return _configure(create_engine(url, **_engine_options(url, QueuePool)))
+
+
+def create_async_database_engine(url: str) -> AsyncEngine:
+    """Create a pooled asynchronous engine, tuned like `create_database_engine`."""
+    async_engine = create_async_engine(
+        url, **_engine_options(url, AsyncAdaptedQueuePool)
+    )
+    _configure(async_engine.sync_engine)
+    return async_engine
+
+
+logger = logging.getLogger(__name__)
+
+engine = create_database_engine(DATABASE_URL)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Only created when enabled as the asynchronous drivers are optional dependencies
+async_engine: Optional[AsyncEngine] = (
+    create_async_database_engine(ASYNC_DATABASE_URL) if DATABASE_ASYNC else None
+)
+
+# Objects are used after commit to build responses, outside of any greenlet
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
+
+AnySession = Union[Session, AsyncSession]
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+async def run(
+    session: AnySession,
+    function: Callable[Concatenate[Session, P], T],
+    *args: P.args,
+    **kwargs: P.kwargs,
+) -> T:
+    """Call a synchronous CRUD `function` with `session` without blocking.
+
+    Asynchronous sessions run the function with non-blocking database IO on the
+    event loop, while synchronous sessions run it in the threadpool.
+    """
+    if isinstance(session, AsyncSession):
+        return await session.run_sync(function, *args, **kwargs)
+    return await run_in_threadpool(function, session, *args, **kwargs)
+
+
+class WriteLock:
+    """Let a single transaction at a time write to an SQLite database.
+
+    Writers queue for the lock rather than contending for the database lock,
+    which SQLite only retries until its busy timeout. The lock is held across
+    threads, and across processes using a lock file next to the database if
+    `path` is given. A disabled lock is never waited for, as databases such as
+    PostgreSQL handle concurrent writes themselves.
+    """
+
+    def __init__(self, path: Optional[str] = None, enabled: bool = True) -> None:
+        self.path = path
+        self.enabled = enabled
+        self._thread_lock = threading.Lock()
+        self._async_lock = asyncio.Lock()
+
+    @contextmanager
+    def hold(self) -> Iterator[None]:
+        """Hold the lock, blocking the thread until it is free."""
+        if not self.enabled:
+            yield
+            return
+        with self._thread_lock, self._lock_file() as file:
+            if file is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            yield  # The file lock is released when the file is closed
+
+    @asynccontextmanager
+    async def hold_async(self) -> AsyncIterator[None]:
+        """Hold the lock without blocking the event loop while waiting for it."""
+        if not self.enabled:
+            yield
+            return
+        lock = self.hold()
+        held = False
+
+        def acquire() -> None:
+            nonlocal held
+            lock.__enter__()
+            held = True
+
+        async with self._async_lock:
+            try:
+                await run_in_threadpool(acquire)
+                yield
+            finally:
+                if held:  # Even if cancelled while waiting for the lock
+                    lock.__exit__(None, None, None)
+
+    def locked(self, function: Callable[P, T]) -> Callable[P, T]:
+        """Wrap `function` to hold the lock while it is called."""
+
+        @wraps(function)
+        def call(*args: P.args, **kwargs: P.kwargs) -> T:
+            with self.hold():
+                return function(*args, **kwargs)
+
+        return call
+
+    def _lock_file(self) -> ContextManager[Optional[IO[str]]]:
+        if self.path is None or fcntl is None:
+            return nullcontext()
+        return open(self.path, "a")
+
+
+def _write_lock_for(engine: Engine) -> WriteLock:
+    url = engine.url
+    if url.get_backend_name() != "sqlite":
+        return WriteLock(enabled=False)  # Concurrent writes are handled by it
+    if url.database in (None, "", ":memory:"):
+        return WriteLock()
+    return WriteLock(f"{url.database}.write-lock")
+
+
+write_lock = _write_lock_for(engine)
+
+
+async def run_write(
+    session: AnySession,
+    function: Callable[Concatenate[Session, P], T],
+    *args: P.args,
+    **kwargs: P.kwargs,
+) -> T:
+    """Call a synchronous CRUD `function` which writes to the database, like
+    `run`, once no other thread or process is writing.
+    """
+    if isinstance(session, AsyncSession):
+        async with write_lock.hold_async():
+            return await session.run_sync(function, *args, **kwargs)
+    locked_function = write_lock.locked(function)
+    return await run_in_threadpool(locked_function, session, *args, **kwargs)
+
+
+def find_missing_indexes(connection: Connection) -> List[str]:
+    """Find the names of indexes in the data model missing from the database."""
+    inspector = inspect(connection)
+    dialect = connection.dialect.name
+    missing = []
+    for table in models.Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        missing += [
+            str(index.name)
+            for index in table.indexes
+            if index.name not in existing
+            if index.info.get("dialect", dialect) == dialect
+        ]
+    return missing
+
+
+def init_database() -> None:
+    """Create any tables and indexes missing from the database."""
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        models.create_search_index(connection)  # Databases created before the index
+        missing_indexes = find_missing_indexes(connection)
+    if missing_indexes:
+        logger.warning(
+            "Database is missing indexes %s, run `alembic upgrade head` to add them",
+            ", ".join(missing_indexes),
+        )
@@ -0,0 +1,218 @@
+"""Detect near-duplicate messages with MinHash signatures and banded LSH.
+
+The MinHash signature of a message estimates the Jaccard similarity between
+its set of character shingles and those of other messages. Signatures are cut
+into bands which are hashed, so that messages sharing the hash of any band are
+candidate duplicates, confirmed by comparing their whole signatures. With 16
+bands of 8 rows, messages at least 80% similar are candidates with a
+probability of over 0.99.
+"""
+
+from enum import Enum
+from functools import cache
+from typing import TYPE_CHECKING, Dict, Iterator, List, Sequence, Tuple
+
+from .exceptions import DedupUnavailableError
+
+try:
+    import numpy as np
+except ImportError:  # Duplicate detection is an optional dependency
+    np = None  # type: ignore[assignment]
+
+if TYPE_CHECKING:
+    from numpy.typing import NDArray
+
+SHINGLE_LENGTH = 5
+BANDS = 16
+ROWS_PER_BAND = 8
+PERMUTATIONS = BANDS * ROWS_PER_BAND
+MINHASH_BATCH_CHARACTERS = 1 << 16  # Of the messages whose shingles are hashed at once
+MINHASH_CHUNK_SHINGLES = 1 << 13  # Permuted at once, in arrays of 8 MiB
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+class DuplicatePolicy(str, Enum):
+    ALLOW = "allow"  # Insert messages without checking for duplicates
+    CHECK = "check"  # Insert messages and report their duplicates
+    REJECT = "reject"  # Don't insert messages with duplicates
+    LINK = "link"  # Insert messages, linked to the first message they duplicate
+
+
+def available() -> bool:
+    return np is not None
+
+
+def check_available(policy: DuplicatePolicy) -> None:
+    """Raise an error if `policy` needs duplicate detection but it isn't installed."""
+    if policy != DuplicatePolicy.ALLOW and np is None:
+        raise DedupUnavailableError("Duplicate detection requires numpy")
+
+
+@cache
+def _constants() -> Tuple["NDArray[np.uint64]", ...]:
+    # Seeded so that signatures stay comparable with those already persisted
+    rng = np.random.default_rng(0)
+    # Coefficients below 2**32 keep a * x + b within 64 bits for 32 bit shingles
+    a = rng.integers(1, _MAX_HASH, PERMUTATIONS, dtype=np.uint64)
+    b = rng.integers(0, _MAX_HASH, PERMUTATIONS, dtype=np.uint64)
+    shingle_weights = rng.integers(1, _MAX_HASH, SHINGLE_LENGTH, dtype=np.uint64)
+    band_weights = rng.integers(1, _MAX_HASH, ROWS_PER_BAND, dtype=np.uint64)
+    return a, b, shingle_weights, band_weights
+
+
+def minhash(contents: Sequence[str]) -> "NDArray[np.uint32]":
+    """Compute the MinHash signature of each of `contents`, one per row.
+
+    The shingles of a batch of messages are permuted together, so that the loop
+    over messages is run by numpy rather than by Python. They are permuted in
+    chunks of a bounded size, however long the messages are.
+    """
+    rows = np.empty((len(contents), PERMUTATIONS), dtype=np.uint32)
+    for start, stop in _batches(contents):
+        rows[start:stop] = _minhash_batch(contents[start:stop])
+    return rows
+
+
+def _batches(contents: Sequence[str]) -> Iterator[Tuple[int, int]]:
+    """Split `contents` into runs of about `MINHASH_BATCH_CHARACTERS` characters."""
+    start = size = 0
+    for stop, content in enumerate(contents, start=1):
+        size += len(content)
+        if size >= MINHASH_BATCH_CHARACTERS:
+            yield start, stop
+            start, size = stop, 0
+    if start < len(contents):
+        yield start, len(contents)
+
+
+def _minhash_batch(contents: Sequence[str]) -> "NDArray[np.uint64]":
+    shingles, offsets = _shingle_hashes(contents)
+    owners = np.repeat(np.arange(len(contents)), np.diff(offsets, append=len(shingles)))
+    signatures = np.full((len(contents), PERMUTATIONS), _MAX_HASH, dtype=np.uint64)
+    for start in range(0, len(shingles), MINHASH_CHUNK_SHINGLES):
+        chunk = slice(start, start + MINHASH_CHUNK_SHINGLES)
+        _permute_chunk(signatures, shingles[chunk], owners[chunk])
+    return signatures
+
+
+def _permute_chunk(
+    signatures: "NDArray[np.uint64]",
+    shingles: "NDArray[np.uint64]",
+    owners: "NDArray[np.int64]",
+) -> None:
+    """Lower the signature of each message owning some of `shingles` to the
+    minimum of their permuted hashes.
+    """
+    a, b = _constants()[:2]
+    permuted = ((np.outer(shingles, a) + b) % _MERSENNE_PRIME) & _MAX_HASH
+    # The shingles of each message are contiguous, and start a run of owners
+    starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+    owned = owners[starts]
+    minimums = np.minimum.reduceat(permuted, starts, axis=0)
+    signatures[owned] = np.minimum(signatures[owned], minimums)
+
+
+def _shingle_hashes(
+    contents: Sequence[str],
+) -> Tuple["NDArray[np.uint64]", "NDArray[np.int64]"]:
+    """Hash each overlapping run of characters of each of the normalised
+    `contents`, returning the hashes and the offset of the first of each message.
+    """
+    texts = [" ".join(c.lower().split()).ljust(SHINGLE_LENGTH) for c in contents]
+    lengths = np.array([len(text) for text in texts])
+    text = "".join(texts).encode("utf-32-le")
+    characters = np.frombuffer(text, dtype=np.uint32).astype(np.uint64)
+    windows = np.lib.stride_tricks.sliding_window_view(characters, SHINGLE_LENGTH)
+    hashes = (windows * _constants()[2]).sum(axis=1) & _MAX_HASH
+    # Skip the windows spanning the end of one message and the start of the next
+    counts = lengths - SHINGLE_LENGTH + 1
+    offsets = np.cumsum(counts) - counts
+    starts = np.cumsum(lengths) - lengths
+    within = np.arange(counts.sum()) - np.repeat(offsets, counts)
+    return hashes[np.repeat(starts, counts) + within], offsets
+
+
+def band_hashes(signatures: "NDArray[np.uint32]") -> "NDArray[np.int64]":
+    """Hash each band of each signature, as signed integers to suit SQL."""
+    bands = signatures.astype(np.uint64).reshape(-1, BANDS, ROWS_PER_BAND)
+    band_weights = _constants()[3]
+    hashes: "NDArray[np.int64]" = (bands * band_weights).sum(axis=2).view(np.int64)
+    return hashes
+
+
+def similarity(signature: "NDArray[np.uint32]", others: "NDArray[np.uint32]") -> float:
+    """Estimate the Jaccard similarity of the messages of two signatures."""
+    return float((signature == others).mean())
+
+
+def to_bytes(signature: "NDArray[np.uint32]") -> bytes:
+    return signature.astype("<u4").tobytes()
+
+
+def from_bytes(data: bytes) -> "NDArray[np.uint32]":
+    return np.frombuffer(data, dtype="<u4").astype(np.uint32)
+
+
+def find_earlier_duplicates(
+    signatures: "NDArray[np.uint32]", threshold: float
+) -> List[List[int]]:
+    """Find the indices of earlier signatures that each signature duplicates."""
+    buckets: Dict[Tuple[int, int], List[int]] = {}
+    duplicates: List[List[int]] = []
+    for index, hashes in enumerate(band_hashes(signatures).tolist()):
+        candidates = set()
+        for band, band_hash in enumerate(hashes):
+            bucket = buckets.setdefault((band, band_hash), [])
+            candidates.update(bucket)
+            bucket.append(index)
+        duplicates.append(
+            [
+                other
+                for other in sorted(candidates)
+                if similarity(signatures[index], signatures[other]) >= threshold
+            ]
+        )
+    return duplicates
+
+
+def find_clusters(
+    ids: Sequence[int], signatures: "NDArray[np.uint32]", threshold: float
+) -> List[List[int]]:
+    """Group the ids of signatures into clusters of near duplicates.
+
+    Messages sharing a band hash are compared with the first message with that
+    hash, rather than with each other, so that the work done grows linearly with
+    the number of messages rather than quadratically with the size of buckets.
+    """
+    parents = list(range(len(ids)))
+    for band in band_hashes(signatures).T:
+        for index, first in _bucket_pairs(band):
+            if similarity(signatures[index], signatures[first]) >= threshold:
+                parents[_root(parents, index)] = _root(parents, first)
+    return _clusters(ids, parents)
+
+
+def _bucket_pairs(band: "NDArray[np.int64]") -> List[Tuple[int, int]]:
+    """Pair the index of each hash in `band` with the first index of that hash."""
+    order = np.argsort(band, kind="stable")
+    ordered = band[order]
+    starts = np.r_[True, ordered[1:] != ordered[:-1]]
+    firsts = order[starts][np.cumsum(starts) - 1]
+    pairs = order != firsts
+    return list(zip(order[pairs].tolist(), firsts[pairs].tolist()))
+
+
+def _clusters(ids: Sequence[int], parents: List[int]) -> List[List[int]]:
+    clusters: Dict[int, List[int]] = {}
+    for index, message_id in enumerate(ids):
+        clusters.setdefault(_root(parents, index), []).append(message_id)
+    return sorted(sorted(c) for c in clusters.values() if len(c) > 1)
+
+
+def _root(parents: List[int], index: int) -> int:
+    while parents[index] != index:
+        parents[index] = parents[parents[index]]  # Halve the path to the root
+        index = parents[index]
+    return index
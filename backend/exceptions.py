@@ -1,2 +1,46 @@
 class MessageNotFoundError(RuntimeError):
     pass
+
+
+class CodeNotFoundError(RuntimeError):
+    pass
+
+
+class ConversationNotFoundError(RuntimeError):
+    pass
+
+
+class AnnotationNotFoundError(RuntimeError):
+    pass
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+class InvalidSortColumnError(ValueError):
+    pass
+
+
+class InvalidSpanError(ValueError):
+    pass
+
+
+class InvalidImportError(ValueError):
+    pass
+
+
+class ExportUnavailableError(RuntimeError):
+    pass
+
+
+class DuplicateMessageError(ValueError):
+    pass
+
+
+class DuplicateTurnError(ValueError):
+    pass
+
+
+class DedupUnavailableError(RuntimeError):
+    pass
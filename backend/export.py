@@ -0,0 +1,141 @@
+"""Serialise the curated dataset of messages and annotations for export."""
+
+import io
+import json
+from enum import Enum
+from itertools import groupby
+from operator import attrgetter
+from typing import Any, Dict, Iterable, Iterator, List
+
+import sqlalchemy as sa
+
+from .config import EXPORT_BATCH_SIZE
+from .exceptions import ExportUnavailableError
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is an optional dependency
+    pa = None
+
+CHUNK_SIZE = 1 << 16
+
+
+class ExportFormat(str, Enum):
+    NDJSON = "ndjson"  # One message per line with its annotations
+    SPANS = "spans"  # One annotated span of a message per line
+    PARQUET = "parquet"  # One row per message and annotation pair
+
+
+MEDIA_TYPES = {
+    ExportFormat.NDJSON: "application/x-ndjson",
+    ExportFormat.SPANS: "application/x-ndjson",
+    ExportFormat.PARQUET: "application/vnd.apache.parquet",
+}
+
+
+def export(rows: Iterable[sa.Row[Any]], format: ExportFormat) -> Iterator[bytes]:
+    """Serialise rows of `crud.read_dataset` in chunks of bytes."""
+    if format == ExportFormat.PARQUET:
+        return _to_parquet(rows)
+    lines = _to_ndjson(rows) if format == ExportFormat.NDJSON else _to_spans(rows)
+    return _chunked(lines)
+
+
+def check_available(format: ExportFormat) -> None:
+    """Raise an error if the dependencies needed by `format` are not installed."""
+    if format == ExportFormat.PARQUET and pa is None:
+        raise ExportUnavailableError("Parquet export requires pyarrow")
+
+
+def _to_ndjson(rows: Iterable[sa.Row[Any]]) -> Iterator[str]:
+    for _, group in groupby(rows, key=attrgetter("message_id")):
+        message_rows = list(group)  # Holds only the annotations of one message
+        annotations: List[Dict[str, Any]] = [
+            {
+                "id": row.annotation_id,
+                "code": row.code,
+                "start_idx": row.start_idx,
+                "end_idx": row.end_idx,
+            }
+            for row in message_rows
+            if row.code is not None
+        ]
+        message = {"id": message_rows[0].message_id, "content": message_rows[0].content}
+        yield json.dumps({**message, "annotations": annotations}) + "\n"
+
+
+def _to_spans(rows: Iterable[sa.Row[Any]]) -> Iterator[str]:
+    for row in rows:
+        if row.code is None:
+            continue
+        span = {
+            "message_id": row.message_id,
+            "annotation_id": row.annotation_id,
+            "code": row.code,
+            "start_idx": row.start_idx,
+            "end_idx": row.end_idx,
+            "text": (row.content or "")[row.start_idx : row.end_idx],
+        }
+        yield json.dumps(span) + "\n"
+
+
+def _chunked(lines: Iterable[str]) -> Iterator[bytes]:
+    """Join lines into chunks to avoid sending each one separately."""
+    chunk = io.StringIO()
+    for line in lines:
+        chunk.write(line)
+        if chunk.tell() >= CHUNK_SIZE:
+            yield chunk.getvalue().encode()
+            chunk = io.StringIO()
+    if chunk.tell():
+        yield chunk.getvalue().encode()
+
+
+class _ParquetSink(io.RawIOBase):
+    """Collect bytes written by a Parquet writer so they can be streamed."""
+
+    def __init__(self) -> None:
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def _to_parquet(rows: Iterable[sa.Row[Any]]) -> Iterator[bytes]:
+    """Write rows to Parquet one row group at a time."""
+    check_available(ExportFormat.PARQUET)
+    schema = pa.schema(
+        [
+            ("message_id", pa.int64()),
+            ("content", pa.string()),
+            ("annotation_id", pa.int64()),
+            ("code", pa.string()),
+            ("start_idx", pa.int64()),
+            ("end_idx", pa.int64()),
+        ]
+    )
+    sink = _ParquetSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        batch: List[Dict[str, Any]] = []
+        for row in rows:
+            batch.append(row._asdict())
+            if len(batch) == EXPORT_BATCH_SIZE:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                batch = []
+                yield sink.drain()
+        writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+    yield sink.drain()
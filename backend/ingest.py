@@ -0,0 +1,214 @@
+"""Parse streamed bulk imports of messages into batches."""
+
+import csv
+import json
+import re
+import time
+from enum import Enum
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+)
+
+from pydantic import ValidationError
+
+from . import schemas as sch
+from .config import IMPORT_BATCH_SIZE, IMPORT_MAX_REPORTED_ERRORS
+from .dedup import DuplicatePolicy
+from .exceptions import InvalidImportError
+
+# The characters that bytes which are not valid UTF-8 are decoded as
+UNDECODED_BYTES = re.compile("[\udc80-\udcff]")
+
+
+class ImportFormat(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+
+class MessageImporter:
+    """Parse lines of an NDJSON or CSV import into batches of messages.
+
+    Lines are fed in one at a time so that an import can be streamed without
+    holding it all in memory. NDJSON lines must be objects with a `content` key
+    and CSV imports must have a header row containing a `content` column.
+    """
+
+    def __init__(
+        self,
+        format: ImportFormat,
+        batch_size: int = IMPORT_BATCH_SIZE,
+        duplicates: DuplicatePolicy = DuplicatePolicy.ALLOW,
+    ):
+        self.format = format
+        self.batch_size = batch_size
+        self.duplicate_policy = duplicates
+        self.inserted = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.errors: List[sch.ImportRowError] = []
+        self._batch: List[sch.CreateMessage] = []
+        self._batch_lines: List[int] = []  # The line of each message of the batch
+        self._taken_lines: List[int] = []  # Of the batch last returned
+        self._line_number = 0
+        self._record = ""  # CSV record spanning multiple lines
+        self._record_start = 0
+        self._content_column: Optional[int] = None
+        self._start_time = time.perf_counter()
+
+    def feed(self, line: str) -> List[sch.CreateMessage]:
+        """Parse a line and return a batch of messages if one has been filled."""
+        self._line_number += 1
+        if UNDECODED_BYTES.search(line):
+            self._add_error(self._line_number, "Line is not valid UTF-8")
+        elif self.format == ImportFormat.NDJSON:
+            self._parse_ndjson(line)
+        else:
+            self._parse_csv(line)
+        if len(self._batch) < self.batch_size:
+            return []
+        return self._take_batch()
+
+    def finish(self) -> List[sch.CreateMessage]:
+        """Return the final partial batch of messages."""
+        if self._record:
+            self._add_error(self._record_start, "Unterminated quoted field")
+        return self._take_batch()
+
+    def batches(self, lines: Iterable[str]) -> Iterator[List[sch.CreateMessage]]:
+        """Parse `lines` into batches of messages."""
+        for line in lines:
+            batch = self.feed(line)
+            if batch:
+                yield batch
+        yield self.finish()
+
+    async def abatches(
+        self, lines: AsyncIterable[str]
+    ) -> AsyncIterator[List[sch.CreateMessage]]:
+        """Parse an asynchronous stream of `lines` into batches of messages."""
+        async for line in lines:
+            batch = self.feed(line)
+            if batch:
+                yield batch
+        yield self.finish()
+
+    def result(self) -> sch.ImportResult:
+        """Summarise the import so far."""
+        seconds = time.perf_counter() - self._start_time
+        return sch.ImportResult(
+            inserted=self.inserted,
+            failed=self.failed,
+            duplicates=self.duplicates,
+            errors=sorted(self.errors, key=lambda error: error.line),
+            seconds=seconds,
+            rows_per_second=self.inserted / seconds if seconds else 0.0,
+        )
+
+    def add_duplicates(self, count: int) -> None:
+        """Record that `count` messages of a batch were found to be duplicates."""
+        self.duplicates += count
+        if self.duplicate_policy == DuplicatePolicy.REJECT:
+            self.inserted -= count
+
+    def add_batch_errors(self, errors: Dict[int, str]) -> None:
+        """Record that the messages of the last batch at the indices of `errors`
+        could not be inserted.
+        """
+        for index, error in sorted(errors.items()):
+            self.inserted -= 1
+            self._add_error(self._taken_lines[index], error)
+
+    def _take_batch(self) -> List[sch.CreateMessage]:
+        batch, self._batch = self._batch, []
+        self._taken_lines, self._batch_lines = self._batch_lines, []
+        self.inserted += len(batch)
+        return batch
+
+    def _add_error(self, line_number: int, error: str) -> None:
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_REPORTED_ERRORS:
+            self.errors.append(sch.ImportRowError(line=line_number, error=error))
+
+    def _parse_ndjson(self, line: str) -> None:
+        if not line.strip():
+            return
+        try:
+            message = sch.CreateMessage.model_validate(json.loads(line))
+        except (ValueError, ValidationError) as e:
+            self._add_error(self._line_number, str(e))
+            return
+        self._batch.append(message)
+        self._batch_lines.append(self._line_number)
+
+    def _parse_csv(self, line: str) -> None:
+        if not self._record:
+            self._record_start = self._line_number
+        self._record += line
+        if self._record.count('"') % 2:
+            return  # A quoted field continues on the next line
+        record, self._record = self._record, ""
+        if record.strip():
+            self._parse_csv_record(next(csv.reader([record])))
+
+    def _parse_csv_record(self, fields: List[str]) -> None:
+        if self._content_column is None:
+            self._read_header(fields)
+        elif len(fields) <= self._content_column:
+            self._add_error(self._record_start, "Missing content column")
+        else:
+            self._batch.append(sch.CreateMessage(content=fields[self._content_column]))
+            self._batch_lines.append(self._record_start)
+
+    def _read_header(self, fields: List[str]) -> None:
+        try:
+            self._content_column = fields.index("content")
+        except ValueError:
+            raise InvalidImportError("CSV header must contain a 'content' column")
+
+
+class _LineDecoder:
+    """Split UTF-8 chunks of bytes into lines ending with their newline.
+
+    Bytes which are not valid UTF-8 are decoded as the lone surrogates matched
+    by `UNDECODED_BYTES`, so that their lines are reported as errors rather
+    than failing the whole import.
+    """
+
+    def __init__(self) -> None:
+        self._pending = b""
+
+    def decode(self, chunk: bytes) -> List[str]:
+        # A newline byte is never part of a multi-byte UTF-8 character
+        *lines, self._pending = (self._pending + chunk).split(b"\n")
+        return [_decode_line(line + b"\n") for line in lines]
+
+    def flush(self) -> List[str]:
+        return [_decode_line(self._pending)] if self._pending else []
+
+
+def _decode_line(line: bytes) -> str:
+    return line.decode("utf-8", errors="surrogateescape")
+
+
+def iter_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Decode UTF-8 chunks of bytes into lines."""
+    decoder = _LineDecoder()
+    for chunk in chunks:
+        yield from decoder.decode(chunk)
+    yield from decoder.flush()
+
+
+async def aiter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """Decode an asynchronous stream of UTF-8 chunks of bytes into lines."""
+    decoder = _LineDecoder()
+    async for chunk in chunks:
+        for line in decoder.decode(chunk):
+            yield line
+    for line in decoder.flush():
+        yield line
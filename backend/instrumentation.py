@@ -0,0 +1,229 @@
+"""Measure the database queries, serialisation and latency of each request.
+
+Queries are timed with SQLAlchemy cursor events on every engine and attributed
+to the request being served through a context variable set by the middleware.
+Measurements are logged for each request, slow queries are logged with their
+query plan and histograms of each route are exposed in the Prometheus format.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import Connection, Engine, event
+from sqlalchemy.engine.interfaces import (
+    DBAPICursor,
+    ExceptionContext,
+    ExecutionContext,
+)
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import SLOW_QUERY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class RequestStats:
+    """Measurements of the request being served."""
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.status = 500  # Until a response is started
+
+
+_current_request: ContextVar[Optional[RequestStats]] = ContextVar(
+    "current_request", default=None
+)
+
+
+def record_serialization(seconds: float) -> None:
+    """Add time spent serialising a response to the current request."""
+    stats = _current_request.get()
+    if stats is not None:
+        stats.serialization_seconds += seconds
+
+
+# -----------------------------------------------------------------------
+# Queries
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query(
+    conn: Connection,
+    cursor: DBAPICursor,
+    statement: str,
+    parameters: Any,
+    context: Optional[ExecutionContext],
+    executemany: bool,
+) -> None:
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_query(
+    conn: Connection,
+    cursor: DBAPICursor,
+    statement: str,
+    parameters: Any,
+    context: Optional[ExecutionContext],
+    executemany: bool,
+) -> None:
+    seconds = time.perf_counter() - conn.info["query_start_time"].pop()
+    stats = _current_request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.sql_seconds += seconds
+    if seconds >= SLOW_QUERY_SECONDS:
+        plan = "" if executemany else _explain(conn, statement, parameters)
+        logger.warning("Slow query took %.1f ms: %s%s", seconds * 1000, statement, plan)
+
+
+@event.listens_for(Engine, "handle_error")
+def _fail_query(context: ExceptionContext) -> None:
+    """Discard the start time of a query that raised instead of ending."""
+    if context.connection is None or context.execution_context is None:
+        return  # Failed before the query was started
+    start_times = context.connection.info.get("query_start_time")
+    if start_times:
+        start_times.pop()
+
+
+# Statements which can be explained, unlike DDL or transaction control
+EXPLAINABLE_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE")
+
+
+def _explain(conn: Connection, statement: str, parameters: Any) -> str:
+    """Find the plan of a query, bypassing the events so it is not timed itself.
+
+    The query is explained within a savepoint, as on PostgreSQL a failure would
+    otherwise abort the whole transaction.
+    """
+    if not statement.lstrip().upper().startswith(EXPLAINABLE_STATEMENTS):
+        return ""
+    explain = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    cursor = conn.connection.cursor()
+    try:
+        with conn.begin_nested():
+            cursor.execute(explain + statement, parameters)
+            return "".join(f"\n    {row[-1]}" for row in cursor.fetchall())
+    except Exception:  # Not every statement can be explained
+        return ""
+    finally:
+        cursor.close()
+
+
+# -----------------------------------------------------------------------
+# Metrics
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+class Histogram:
+    """Count observations of each route in buckets, as a Prometheus histogram."""
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...]) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series: Dict[Tuple[str, str], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, method: str, route: str, value: float) -> None:
+        with self._lock:
+            series = self._series.get((method, route))
+            if series is None:
+                # Counts of each bucket and of +Inf, followed by the sum of values
+                series = self._series[method, route] = [0.0] * (len(self.buckets) + 2)
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for (method, route), values in sorted(series.items()):
+            labels = f'method="{method}",route="{route}"'
+            bounds = [*map(str, self.buckets), "+Inf"]
+            total = 0.0
+            for bound, count in zip(bounds, values):
+                total += count
+                yield f'{self.name}_bucket{{{labels},le="{bound}"}} {total:g}'
+            yield f"{self.name}_sum{{{labels}}} {values[-1]}"
+            yield f"{self.name}_count{{{labels}}} {total:g}"
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Total latency of requests.", LATENCY_BUCKETS
+)
+SQL_SECONDS = Histogram(
+    "http_request_sql_seconds", "Time spent executing SQL.", LATENCY_BUCKETS
+)
+SERIALIZATION_SECONDS = Histogram(
+    "http_request_serialization_seconds",
+    "Time spent serialising responses.",
+    LATENCY_BUCKETS,
+)
+QUERIES = Histogram(
+    "http_request_queries", "SQL statements executed.", QUERY_COUNT_BUCKETS
+)
+HISTOGRAMS = (REQUEST_SECONDS, SQL_SECONDS, SERIALIZATION_SECONDS, QUERIES)
+
+
+def render_metrics() -> str:
+    """Render every histogram in the Prometheus text format."""
+    return "".join(line + "\n" for h in HISTOGRAMS for line in h.render())
+
+
+def _record(method: str, route: str, stats: RequestStats) -> None:
+    seconds = time.perf_counter() - stats.start
+    REQUEST_SECONDS.observe(method, route, seconds)
+    SQL_SECONDS.observe(method, route, stats.sql_seconds)
+    SERIALIZATION_SECONDS.observe(method, route, stats.serialization_seconds)
+    QUERIES.observe(method, route, stats.queries)
+    logger.debug(
+        "%s %s %d in %.1f ms: %d queries in %.1f ms, serialised in %.1f ms",
+        method,
+        route,
+        stats.status,
+        seconds * 1000,
+        stats.queries,
+        stats.sql_seconds * 1000,
+        stats.serialization_seconds * 1000,
+    )
+
+
+class InstrumentationMiddleware:
+    """Measure each HTTP request, labelled by the path of the route it matched."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = _current_request.set(stats)
+        try:
+            await self.app(scope, receive, _capture_status(send, stats))
+        finally:
+            _current_request.reset(token)
+            # Unmatched paths share a label to keep the number of series bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            _record(scope["method"], route, stats)
+
+
+def _capture_status(send: Send, stats: RequestStats) -> Send:
+    async def send_with_status(message: Message) -> None:
+        if message["type"] == "http.response.start":
+            stats.status = message["status"]
+        await send(message)
+
+    return send_with_status
@@ -1,18 +1,83 @@
 """Provide an API to allow access to the database."""
-from typing import Generator, Optional
+from contextlib import asynccontextmanager
+from typing import (
+    Annotated,
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
 
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from . import crud, models
+from . import changes, crud, export, ingest, instrumentation, models
 from . import schemas as sch
-from .database import SessionLocal, engine
-from .exceptions import MessageNotFoundError
+from .config import (
+    CHANGE_BUFFER_SIZE,
+    CHANGE_KEEPALIVE_SECONDS,
+    CHANGE_POLL_SECONDS,
+    DATABASE_ASYNC,
+    DATABASE_INIT,
+    DEDUP_THRESHOLD,
+    GZIP_COMPRESS_LEVEL,
+    GZIP_MINIMUM_SIZE,
+)
+from .database import (
+    AnySession,
+    AsyncSessionLocal,
+    SessionLocal,
+    async_engine,
+    engine,
+    init_database,
+    run,
+    run_write,
+)
+from .dedup import DuplicatePolicy
+from .exceptions import (
+    AnnotationNotFoundError,
+    CodeNotFoundError,
+    ConversationNotFoundError,
+    DedupUnavailableError,
+    DuplicateMessageError,
+    DuplicateTurnError,
+    ExportUnavailableError,
+    InvalidCursorError,
+    InvalidImportError,
+    InvalidSortColumnError,
+    InvalidSpanError,
+    MessageNotFoundError,
+)
+from .responses import RowsJSONResponse, cache_headers, etag_matches, make_etag
 
-models.Base.metadata.create_all(bind=engine)
+if DATABASE_INIT:
+    init_database()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Close pooled database connections when the app shuts down."""
+    yield
+    if async_engine is not None:
+        await async_engine.dispose()
+    engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Needed to allow same-origin CORS requests between the web app and API when run locally
 # WARNING: This opens the app up to cross-site scripting attacks
@@ -24,6 +89,39 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE, compresslevel=GZIP_COMPRESS_LEVEL
+)
+# Added last to be outermost, so that the latency measured includes compression
+app.add_middleware(instrumentation.InstrumentationMiddleware)
+
+
+@app.exception_handler(InvalidSpanError)
+async def invalid_span_handler(request: Request, exc: InvalidSpanError) -> Response:
+    """Reject annotations with spans outside of their message from any endpoint."""
+    return JSONResponse({"detail": "Span is outside of message"}, status_code=400)
+
+
+@app.exception_handler(ConversationNotFoundError)
+async def conversation_not_found_handler(
+    request: Request, exc: ConversationNotFoundError
+) -> Response:
+    """Reject messages added to conversations that do not exist from any endpoint."""
+    return JSONResponse({"detail": "Conversation not found"}, status_code=404)
+
+
+@app.exception_handler(DuplicateTurnError)
+async def duplicate_turn_handler(request: Request, exc: DuplicateTurnError) -> Response:
+    """Reject messages taking a turn of a conversation that is already taken."""
+    return JSONResponse({"detail": "Turn is already taken"}, status_code=409)
+
+
+@app.exception_handler(AnnotationNotFoundError)
+async def annotation_not_found_handler(
+    request: Request, exc: AnnotationNotFoundError
+) -> Response:
+    """Reject changes to annotations that do not exist from any endpoint."""
+    return JSONResponse({"detail": "Annotation not found"}, status_code=404)
 
 
 def get_session() -> Generator[Session, None, None]:
@@ -35,7 +133,39 @@ def get_session() -> Generator[Session, None, None]:
         session.close()
 
 
-session_dependency = Depends(get_session)
+async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
+    """Provide an asynchronous database session dependency to API endpoints."""
+    async with AsyncSessionLocal() as session:
+        yield session
+
+
+# Endpoints run CRUD functions through `run` so they work with either session
+session_dependency = Depends(get_async_session if DATABASE_ASYNC else get_session)
+sync_session_dependency = Depends(get_session)
+
+
+def etag_dependency(*tables: Type[models.Base]) -> Any:
+    """Make a dependency providing the ETag of data read from `tables`.
+
+    If the client already has the current data, the request is answered with 304
+    Not Modified without reading it again.
+    """
+    table_names = [table.__tablename__ for table in tables]
+
+    async def get_etag(
+        request: Request, session: AnySession = session_dependency
+    ) -> str:
+        etag = make_etag(await run(session, crud.read_table_versions, table_names))
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            raise HTTPException(status_code=304, headers=cache_headers(etag))
+        return etag
+
+    return Depends(get_etag)
+
+
+messages_etag = etag_dependency(models.Message)
+codes_etag = etag_dependency(models.Code)
+annotations_etag = etag_dependency(models.Message, models.Code, models.Annotation)
 
 
 # -----------------------------------------------------------------------
@@ -43,55 +173,194 @@ session_dependency = Depends(get_session)
 
 
 @app.get("/messages/", response_model=list[sch.Message])
-def read_messages(
+async def read_messages(
     search: Optional[str] = None,
     limit: Optional[int] = None,
     offset: int = 0,
     sort_by: Optional[str] = None,
     sort_asc: bool = True,
-    session: Session = session_dependency,
-) -> list[models.Message]:
+    session: AnySession = session_dependency,
+    etag: str = messages_etag,
+) -> Response:
     """Read `limit` messages from the database starting from `offset` containing
     `search` ordered by column `sort_by` in direction `sort_asc`.
     """
-    return crud.read_messages(
-        session=session,
+    messages = await run(
+        session,
+        crud.read_messages,
         search=search,
         limit=limit,
         offset=offset,
         sort_by=sort_by,
         sort_asc=sort_asc,
     )
+    items = [message._asdict() for message in messages]
+    return RowsJSONResponse(items, headers=cache_headers(etag))
 
 
-@app.post("/messages/create/", response_model=sch.Message)
-def create_message(
-    message: sch.CreateMessage, session: Session = session_dependency
-) -> models.Message:
-    """Create a new message in the database."""
-    return crud.create_message(session, message)
+@app.get("/messages/page/", response_model=sch.MessagePage)
+async def read_messages_page(
+    search: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1)] = 100,
+    cursor: Optional[str] = None,
+    sort_by: str = "id",
+    sort_asc: bool = True,
+    session: AnySession = session_dependency,
+    etag: str = messages_etag,
+) -> Response:
+    """Read `limit` messages containing `search` ordered by column `sort_by` in
+    direction `sort_asc`, starting after `cursor`.
+
+    The response contains a `next_cursor` to pass back to fetch the following
+    page, which is null on the last page.
+    """
+    try:
+        messages, next_cursor = await run(
+            session,
+            crud.read_messages_page,
+            search=search,
+            limit=limit,
+            cursor=cursor,
+            sort_by=sort_by,
+            sort_asc=sort_asc,
+        )
+    except InvalidSortColumnError:
+        raise HTTPException(status_code=400, detail="Invalid sort column")
+    except InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    items = [message._asdict() for message in messages]
+    page = {"items": items, "next_cursor": next_cursor}
+    return RowsJSONResponse(page, headers=cache_headers(etag))
+
+
+@app.post("/messages/create/", response_model=sch.CreatedMessage)
+async def create_message(
+    message: sch.CreateMessage,
+    duplicates: DuplicatePolicy = DuplicatePolicy.ALLOW,
+    session: AnySession = session_dependency,
+) -> sch.CreatedMessage:
+    """Create a new message in the database, checking whether it is a near
+    duplicate of existing messages according to the `duplicates` policy.
+    """
+    try:
+        return await run_write(session, crud.create_message, message, duplicates)
+    except DedupUnavailableError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except DuplicateMessageError as e:
+        detail = {"message": "Message is a duplicate", "duplicates": e.args[0]}
+        raise HTTPException(status_code=409, detail=detail)
+
+
+@app.post("/messages/import/", response_model=sch.ImportResult)
+async def import_messages(
+    request: Request,
+    format: ingest.ImportFormat = ingest.ImportFormat.NDJSON,
+    duplicates: DuplicatePolicy = DuplicatePolicy.ALLOW,
+    session: AnySession = session_dependency,
+) -> sch.ImportResult:
+    """Import messages streamed as NDJSON or CSV in the request body.
+
+    Messages are inserted in batches, each in its own transaction, and rows that
+    cannot be parsed or added to their conversation are reported in the response
+    rather than aborting the import.
+    Near duplicates are counted, or skipped if the `duplicates` policy rejects them.
+    """
+    importer = ingest.MessageImporter(format, duplicates=duplicates)
+    lines = ingest.aiter_lines(request.stream())
+    try:
+        async for batch in importer.abatches(lines):
+            found, errors = await run_write(
+                session, crud.create_messages, batch, duplicates
+            )
+            importer.add_duplicates(found)
+            importer.add_batch_errors(errors)
+    except (InvalidImportError, DedupUnavailableError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return importer.result()
 
 
 @app.post("/messages/update/")
-def update_message(
-    message: sch.UpdateMessage, session: Session = session_dependency
+async def update_message(
+    message: sch.UpdateMessage, session: AnySession = session_dependency
 ) -> None:
     """Update the content of a given message from the database."""
-    crud.update_message(session, message)
+    try:
+        await run_write(session, crud.update_message, message)
+    except MessageNotFoundError:
+        raise HTTPException(status_code=404, detail="Message not found")
 
 
 @app.post("/messages/delete/")
-def delete_message(
-    message: sch.DeleteMessage, session: Session = session_dependency
+async def delete_message(
+    message: sch.DeleteMessage, session: AnySession = session_dependency
 ) -> None:
     """Delete a given message from the database."""
-    crud.delete_message(session, message)
+    await run_write(session, crud.delete_message, message)
 
 
 @app.get("/messages/count/", response_model=int)
-def count_messages(session: Session = session_dependency) -> int:
-    """Count the number of messages in the database."""
-    return crud.count_messages(session)
+async def count_messages(
+    search: Optional[str] = None, session: AnySession = session_dependency
+) -> int:
+    """Count the number of messages in the database containing `search`."""
+    return await run(session, crud.count_messages, search)
+
+
+@app.get("/messages/{message_id}/context/", response_model=list[sch.Turn])
+async def read_context(
+    message_id: int,
+    turns: Annotated[int, Query(ge=0)] = 5,
+    session: AnySession = session_dependency,
+    etag: str = messages_etag,
+) -> Response:
+    """Read a given message with up to `turns` turns either side of it in its
+    conversation, in order of turn.
+    """
+    try:
+        messages = await run(session, crud.read_context, message_id, turns)
+    except MessageNotFoundError:
+        raise HTTPException(status_code=404, detail="Message not found")
+    items = [message._asdict() for message in messages]
+    return RowsJSONResponse(items, headers=cache_headers(etag))
+
+
+@app.get("/messages/duplicates/", response_model=list[list[int]])
+async def read_duplicate_clusters(
+    threshold: Annotated[float, Query(gt=0, le=1)] = DEDUP_THRESHOLD,
+    session: AnySession = session_dependency,
+) -> List[List[int]]:
+    """Group the ids of messages into clusters of near duplicates, whose character
+    shingles have an estimated Jaccard similarity of at least `threshold`.
+
+    Messages created before duplicate detection was available are indexed first.
+    """
+    try:
+        return await run_write(session, crud.read_duplicate_clusters, threshold)
+    except DedupUnavailableError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+# -----------------------------------------------------------------------
+# Conversations
+
+
+@app.get("/conversations/", response_model=list[sch.Conversation])
+async def read_conversations(
+    limit: Optional[int] = None,
+    offset: int = 0,
+    session: AnySession = session_dependency,
+) -> Response:
+    """Read `limit` conversations from the database starting from `offset`."""
+    conversations = await run(session, crud.read_conversations, limit, offset)
+    return RowsJSONResponse([c._asdict() for c in conversations])
+
+
+@app.post("/conversations/create/", response_model=sch.Conversation)
+async def create_conversation(
+    conversation: sch.CreateConversation, session: AnySession = session_dependency
+) -> models.Conversation:
+    """Create a new conversation, to which messages can be added as turns."""
+    return await run_write(session, crud.create_conversation, conversation)
 
 
 # -----------------------------------------------------------------------
@@ -99,88 +368,308 @@ def count_messages(session: Session = session_dependency) -> int:
 
 
 @app.get("/codes/", response_model=list[sch.Code])
-def read_codes(
+async def read_codes(
     search: Optional[str] = None,
     sort_by: Optional[str] = None,
     sort_asc: bool = True,
-    session: Session = session_dependency,
-) -> list[models.Code]:
+    session: AnySession = session_dependency,
+    etag: str = codes_etag,
+) -> Response:
     """Read codes from the database."""
-    return crud.read_codes(
-        session=session,
-        search=search,
-        sort_by=sort_by,
-        sort_asc=sort_asc,
-    )
+    try:
+        codes = await run(
+            session,
+            crud.read_codes,
+            search=search,
+            sort_by=sort_by,
+            sort_asc=sort_asc,
+        )
+    except InvalidSortColumnError:
+        raise HTTPException(status_code=400, detail="Invalid sort column")
+    return RowsJSONResponse(codes, headers=cache_headers(etag))
 
 
 @app.post("/codes/create/", response_model=Optional[sch.Code])
-def create_code(
-    code: sch.CreateCode, session: Session = session_dependency
+async def create_code(
+    code: sch.CreateCode, session: AnySession = session_dependency
 ) -> Optional[models.Code]:
     """Create a new code in the database if it does not already exist."""
-    return crud.create_code(session, code)
+    return await run_write(session, crud.create_code, code)
+
+
+@app.post("/codes/import/", response_model=sch.ImportCodesResult)
+async def import_codes(
+    codebook: sch.ImportCodes, session: AnySession = session_dependency
+) -> sch.ImportCodesResult:
+    """Create a list or tree of codes, skipping any that already exist."""
+    return await run_write(session, crud.import_codes, codebook)
 
 
 @app.post("/codes/update/")
-def update_code(code: sch.UpdateCode, session: Session = session_dependency) -> None:
+async def update_code(
+    code: sch.UpdateCode, session: AnySession = session_dependency
+) -> None:
     """Update a code in the database."""
-    crud.update_code(session, code)
+    await run_write(session, crud.update_code, code)
 
 
 @app.post("/codes/delete/")
-def delete_code(code: sch.DeleteCode, session: Session = session_dependency) -> None:
+async def delete_code(
+    code: sch.DeleteCode, session: AnySession = session_dependency
+) -> None:
     """Delete a given code from the database."""
-    crud.delete_code(session, code)
+    await run_write(session, crud.delete_code, code)
 
 
 @app.get("/codes/count/", response_model=int)
-def count_codes(session: Session = session_dependency) -> int:
+async def count_codes(session: AnySession = session_dependency) -> int:
     """Count the number of codes in the database."""
-    return crud.count_codes(session)
+    return await run(session, crud.count_codes)
 
 
 # -----------------------------------------------------------------------
 # Annotations
 
 
-@app.get("/annotations/{message_id}/")
-def read_annotations(
+@app.get("/annotations/", response_model=list[sch.AnnotationResponse])
+async def read_annotations_for_messages(
+    message_ids: Annotated[List[int], Query()],
+    session: AnySession = session_dependency,
+    etag: str = annotations_etag,
+) -> Response:
+    """Read annotations from the database for each of the given messages."""
+    annotations = await run(
+        session, crud.read_annotations_for_messages, message_ids=message_ids
+    )
+    return RowsJSONResponse(annotations, headers=cache_headers(etag))
+
+
+SpanQuery = Annotated[Optional[str], Query(pattern=r"^\d+,\d+$")]
+
+
+def _parse_span(span: Optional[str]) -> Optional[Tuple[int, int]]:
+    if span is None:
+        return None
+    start, end = span.split(",")
+    return int(start), int(end)
+
+
+@app.get("/annotations/{message_id}/", response_model=list[sch.AnnotationResponse])
+async def read_annotations(
     message_id: int,
-    session: Session = session_dependency,
-) -> list[sch.AnnotationResponse]:
-    """Read annotations from the database for a given message."""
+    overlaps: SpanQuery = None,
+    covers: SpanQuery = None,
+    session: AnySession = session_dependency,
+    etag: str = annotations_etag,
+) -> Response:
+    """Read annotations from the database for a given message, optionally only
+    those overlapping or covering a span of its content given as `start,end`.
+    """
     try:
-        return crud.read_annotations(
-            session=session,
+        annotations = await run(
+            session,
+            crud.read_annotations,
             message_id=message_id,
+            overlaps=_parse_span(overlaps),
+            covers=_parse_span(covers),
         )
     except MessageNotFoundError:
         raise HTTPException(status_code=404, detail="Message not found")
+    return RowsJSONResponse(annotations, headers=cache_headers(etag))
+
+
+@app.get(
+    "/annotations/{message_id}/suggestions/",
+    response_model=list[sch.AnnotationSuggestion],
+)
+async def read_suggestions(
+    message_id: int,
+    session: AnySession = session_dependency,
+    etag: str = annotations_etag,
+) -> Response:
+    """Suggest annotations of a given message from the phrases that have already
+    been annotated in any message, ordered by span.
+    """
+    try:
+        suggestions = await run(session, crud.read_suggestions, message_id)
+    except MessageNotFoundError:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return RowsJSONResponse(suggestions, headers=cache_headers(etag))
 
 
 @app.post("/annotations/{message_id}/create/", response_model=sch.Annotation)
-def create_annotation(
-    annotation: sch.CreateAnnotation, session: Session = session_dependency
+async def create_annotation(
+    annotation: sch.CreateAnnotation, session: AnySession = session_dependency
 ) -> models.Annotation:
     """Create a new annotation in the database for a given message."""
     try:
-        return crud.create_annotation(session=session, new_annotation=annotation)
+        return await run_write(
+            session, crud.create_annotation, new_annotation=annotation
+        )
+    except MessageNotFoundError:
+        raise HTTPException(status_code=404, detail="Message not found")
+
+
+@app.post("/annotations/batch/", response_model=sch.AnnotationBatchResult)
+async def apply_annotation_batch(
+    batch: sch.AnnotationBatch, session: AnySession = session_dependency
+) -> sch.AnnotationBatchResult:
+    """Create, update and delete many annotations across messages at once.
+
+    Either every operation in the batch is applied or, if any references a
+    message, code or annotation that does not exist, none are.
+    """
+    try:
+        return await run_write(session, crud.apply_annotation_batch, batch)
     except MessageNotFoundError:
         raise HTTPException(status_code=404, detail="Message not found")
+    except CodeNotFoundError:
+        raise HTTPException(status_code=404, detail="Code not found")
 
 
 @app.post("/annotations/update/")
-def update_annotation(
-    annotation: sch.UpdateAnnotation, session: Session = session_dependency
+async def update_annotation(
+    annotation: sch.UpdateAnnotation, session: AnySession = session_dependency
 ) -> None:
     """Update the content of a given annotation from the database."""
-    crud.update_annotation(session, annotation)
+    await run_write(session, crud.update_annotation, annotation)
 
 
 @app.post("/annotations/delete/")
-def delete_annotation(
-    annotation: sch.DeleteAnnotation, session: Session = session_dependency
+async def delete_annotation(
+    annotation: sch.DeleteAnnotation, session: AnySession = session_dependency
 ) -> None:
     """Delete a given annotation from the database."""
-    crud.delete_annotation(session, annotation)
+    await run_write(session, crud.delete_annotation, annotation)
+
+
+# -----------------------------------------------------------------------
+# Analytics
+
+
+@app.get("/analytics/codes/", response_model=list[sch.CodeFrequency])
+async def read_code_frequencies(session: AnySession = session_dependency) -> Response:
+    """Count how often each code and each subtree of codes is used."""
+    frequencies = await run(session, crud.read_code_frequencies)
+    return RowsJSONResponse(frequencies)
+
+
+@app.get("/analytics/cooccurrences/", response_model=list[sch.CodeCooccurrence])
+async def read_code_cooccurrences(
+    min_count: Annotated[int, Query(ge=1)] = 1,
+    session: AnySession = session_dependency,
+) -> Response:
+    """Count the messages in which each pair of codes co-occur, if at least
+    `min_count`, most frequent first.
+    """
+    cooccurrences = await run(session, crud.read_code_cooccurrences, min_count)
+    return RowsJSONResponse(cooccurrences)
+
+
+@app.get("/analytics/span-lengths/", response_model=list[sch.SpanLengthBin])
+async def read_span_lengths(
+    bin_width: Annotated[int, Query(ge=1)] = 1,
+    code: Optional[str] = None,
+    session: AnySession = session_dependency,
+) -> Response:
+    """Make a histogram of the lengths of annotated spans, optionally only those
+    annotated with codes in the subtree of `code`.
+    """
+    span_lengths = await run(session, crud.read_span_lengths, bin_width, code)
+    return RowsJSONResponse(span_lengths)
+
+
+# -----------------------------------------------------------------------
+# Changes
+
+
+@app.get("/changes/", response_model=sch.ChangeFeed)
+async def read_changes(
+    since: Annotated[Optional[int], Query(ge=0)] = None,
+    limit: Annotated[int, Query(ge=1)] = CHANGE_BUFFER_SIZE,
+    session: AnySession = session_dependency,
+) -> Response:
+    """Read up to `limit` changes committed after the change numbered `since`, to
+    apply to data read before them rather than reading it again, or only the
+    number of the latest change if `since` is not given.
+
+    If the changes can no longer be read, `reload` is set and every table must be
+    read again, continuing from the returned `seq`.
+    """
+    feed = await run(session, crud.read_changes, since, limit)
+    return RowsJSONResponse(feed)
+
+
+async def _read_changes(since: Optional[int], limit: Optional[int]) -> Dict[str, Any]:
+    """Read changes for the change stream, outside of any request."""
+    if DATABASE_ASYNC:
+        async with AsyncSessionLocal() as async_session:
+            return await run(async_session, crud.read_changes, since, limit)
+    with SessionLocal() as session:
+        return await run(session, crud.read_changes, since, limit)
+
+
+change_broadcaster = changes.ChangeBroadcaster(
+    _read_changes, CHANGE_POLL_SECONDS, CHANGE_BUFFER_SIZE
+)
+
+
+@app.get("/changes/stream", response_class=StreamingResponse)
+async def stream_changes(
+    since: Annotated[Optional[int], Query(ge=0)] = None,
+    last_event_id: Annotated[Optional[int], Header()] = None,
+) -> StreamingResponse:
+    """Stream the changes committed after the change numbered `since`, or after
+    the latest change if not given, as server-sent events.
+
+    Clients reconnecting with `EventSource` resume after the last event they
+    received, from the `Last-Event-ID` header that it sends.
+    """
+    events = change_broadcaster.subscribe(
+        last_event_id if since is None else since, CHANGE_KEEPALIVE_SECONDS
+    )
+    return StreamingResponse(
+        (changes.format_events(feed) async for feed in events),
+        media_type="text/event-stream",
+        # Marked as encoded so that events are not buffered to be compressed
+        headers={"Cache-Control": "no-cache", "Content-Encoding": "identity"},
+    )
+
+
+# -----------------------------------------------------------------------
+# Dataset
+
+
+@app.get("/export/", response_class=StreamingResponse)
+def export_dataset(
+    format: export.ExportFormat = export.ExportFormat.NDJSON,
+    code: Optional[str] = None,
+    session: Session = sync_session_dependency,
+) -> StreamingResponse:
+    """Stream every message with its annotations, optionally only those annotated
+    with codes in the subtree of `code`.
+
+    Rows are streamed from a database cursor in constant memory, so exports always
+    use a synchronous session that is iterated in the threadpool.
+    """
+    try:
+        export.check_available(format)
+    except ExportUnavailableError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    rows = crud.read_dataset(session, code)
+    return StreamingResponse(
+        export.export(rows, format), media_type=export.MEDIA_TYPES[format]
+    )
+
+
+# -----------------------------------------------------------------------
+# Monitoring
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics() -> PlainTextResponse:
+    """Expose histograms of the requests served by this process to Prometheus."""
+    return PlainTextResponse(
+        instrumentation.render_metrics(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
@@ -1,4 +1,5 @@
 """Define the SQLAlchemy data model and tables."""
+from itertools import chain
 from typing import List
 
 import sqlalchemy as sa
@@ -9,11 +10,40 @@ class Base(DeclarativeBase):
     pass
 
 
+# The info of indexes created only in SQLite databases
+SQLITE_ONLY = {"dialect": "sqlite"}
+
+
+class Conversation(Base):
+    __tablename__ = "conversations"
+
+    id = sa.Column("id", sa.Integer, primary_key=True)
+    name = sa.Column("name", sa.String)
+
+
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        sa.Index(
+            "ix_messages_conversation_id_turn_idx",
+            "conversation_id",
+            "turn_idx",
+            unique=True,
+        ),
+        # PostgreSQL can't hold long contents in a btree index, and searches
+        # them with its trigram index instead
+        sa.Index("ix_messages_content", "content", info=SQLITE_ONLY).ddl_if(
+            dialect="sqlite"
+        ),
+    )
 
     id = sa.Column("id", sa.Integer, primary_key=True)
     content = sa.Column("content", sa.String)
+    # Messages taken from a conversation are ordered by distinct turns within it
+    conversation_id = sa.Column(
+        "conversation_id", sa.Integer, sa.ForeignKey("conversations.id")
+    )
+    turn_idx = sa.Column("turn_idx", sa.Integer)
     annotations: Mapped[List["Annotation"]] = relationship(
         back_populates="message", cascade="delete, delete-orphan"
     )
@@ -31,15 +61,271 @@ class Code(Base):
 
 class Annotation(Base):
     __tablename__ = "annotations"
+    __table_args__ = (
+        sa.Index(
+            "ix_annotations_message_id_start_idx_end_idx",
+            "message_id",
+            "start_idx",
+            "end_idx",
+        ),
+    )
 
     id = sa.Column("id", sa.Integer, primary_key=True)
     message_id = sa.Column(
-        "message_id", sa.Integer, sa.ForeignKey("messages.id", ondelete="CASCADE")
+        "message_id",
+        sa.Integer,
+        sa.ForeignKey("messages.id", ondelete="CASCADE"),
+        index=True,
     )
     code_id = sa.Column(
-        "code_id", sa.Integer, sa.ForeignKey("codes.id", ondelete="CASCADE")
+        "code_id",
+        sa.Integer,
+        sa.ForeignKey("codes.id", ondelete="CASCADE"),
+        index=True,
     )
     start_idx = sa.Column("start_idx", sa.Integer)
     end_idx = sa.Column("end_idx", sa.Integer)
     message: Mapped["Message"] = relationship(back_populates="annotations")
     code: Mapped["Code"] = relationship(back_populates="annotations")
+
+
+class RowCount(Base):
+    __tablename__ = "row_counts"
+
+    table_name = sa.Column("table_name", sa.String, primary_key=True)
+    count = sa.Column("count", sa.Integer, nullable=False)
+
+
+class MessageSignature(Base):
+    __tablename__ = "message_signatures"
+
+    message_id = sa.Column(
+        "message_id",
+        sa.Integer,
+        sa.ForeignKey("messages.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    signature = sa.Column("signature", sa.LargeBinary, nullable=False)
+    duplicate_of_id = sa.Column(
+        "duplicate_of_id",
+        sa.Integer,
+        sa.ForeignKey("messages.id", ondelete="SET NULL"),
+        index=True,
+    )
+
+
+class MessageBand(Base):
+    """The hash of one band of the MinHash signature of a message."""
+
+    __tablename__ = "message_bands"
+
+    band = sa.Column("band", sa.Integer, primary_key=True)
+    hash = sa.Column("hash", sa.BigInteger, primary_key=True)
+    message_id = sa.Column(
+        "message_id",
+        sa.Integer,
+        sa.ForeignKey("messages.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    )
+
+
+class TableVersion(Base):
+    __tablename__ = "table_versions"
+
+    table_name = sa.Column("table_name", sa.String, primary_key=True)
+    version = sa.Column("version", sa.Integer, nullable=False)
+
+
+class Change(Base):
+    """A write to a row of a table, or to many rows if `row_id` is null, numbered
+    in the order that writes were committed.
+    """
+
+    __tablename__ = "changes"
+    # Sequence numbers of pruned changes must never be reused
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    seq = sa.Column("seq", sa.Integer, primary_key=True)
+    table_name = sa.Column("table_name", sa.String, nullable=False)
+    operation = sa.Column("operation", sa.String, nullable=False)
+    row_id = sa.Column("row_id", sa.Integer)
+    data = sa.Column("data", sa.JSON)  # Values of the columns written
+
+
+# -----------------------------------------------------------------------
+# Full-text search
+
+# SQLite keeps an FTS5 index over message content in sync using triggers. The
+# trigram tokenizer lets substring searches be answered from the index.
+SEARCH_INDEX_DDL = [
+    """
+    CREATE VIRTUAL TABLE messages_fts USING fts5(
+        content, content='messages', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+# The shortest search term the trigram tokenizer can match
+SEARCH_INDEX_MIN_TERM_LENGTH = 3
+
+message_search = sa.table(
+    "messages_fts", sa.column("rowid", sa.Integer), sa.column("rank")
+)
+
+
+def create_search_index(connection: sa.Connection) -> None:
+    """Create and populate the message search index if it does not exist."""
+    if connection.dialect.name != "sqlite":
+        return
+    if sa.inspect(connection).has_table(message_search.name):
+        return
+    for statement in SEARCH_INDEX_DDL:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql(
+        "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"
+    )
+
+
+def drop_search_index(connection: sa.Connection) -> None:
+    """Drop the message search index and its triggers."""
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql("DROP TABLE IF EXISTS messages_fts")
+
+
+sa.event.listen(
+    Message.__table__,
+    "after_create",
+    lambda target, connection, **kw: create_search_index(connection),
+)
+sa.event.listen(
+    Message.__table__,
+    "after_drop",
+    lambda target, connection, **kw: drop_search_index(connection),
+)
+
+
+# -----------------------------------------------------------------------
+# PostgreSQL indexes
+
+# PostgreSQL answers substring searches of messages from a trigram index rather
+# than a full-text index. Prefix searches of the code hierarchy need an index
+# comparing codes character by character, as it compares text by its locale.
+POSTGRES_INDEX_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """
+    CREATE INDEX IF NOT EXISTS ix_messages_content_trgm
+    ON messages USING gin (content gin_trgm_ops)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_codes_code_pattern
+    ON codes (code text_pattern_ops)
+    """,
+]
+
+
+def create_postgres_indexes(connection: sa.Connection) -> None:
+    """Create the indexes specific to PostgreSQL if they do not exist."""
+    if connection.dialect.name != "postgresql":
+        return
+    for statement in POSTGRES_INDEX_DDL:
+        connection.exec_driver_sql(statement)
+
+
+# Indexes are created once all of the tables that they index exist
+sa.event.listen(
+    Base.metadata,
+    "after_create",
+    lambda target, connection, **kw: create_postgres_indexes(connection),
+)
+
+
+# -----------------------------------------------------------------------
+# Row counts
+
+# SQLite has to scan a whole table to count its rows, so the row counts of
+# large tables are maintained by triggers instead.
+COUNTED_TABLES = [Message.__tablename__, Code.__tablename__]
+
+
+def _row_count_ddl(table: str) -> List[str]:
+    return [
+        f"""
+        CREATE TRIGGER {table}_count_insert AFTER INSERT ON {table} BEGIN
+            UPDATE row_counts SET count = count + 1 WHERE table_name = '{table}';
+        END
+        """,
+        f"""
+        CREATE TRIGGER {table}_count_delete AFTER DELETE ON {table} BEGIN
+            UPDATE row_counts SET count = count - 1 WHERE table_name = '{table}';
+        END
+        """,
+        f"""
+        INSERT OR REPLACE INTO row_counts (table_name, count)
+        SELECT '{table}', count(*) FROM {table}
+        """,
+    ]
+
+
+def create_row_counters(connection: sa.Connection) -> None:
+    """Create the triggers maintaining the row counts if they do not exist."""
+    if connection.dialect.name != "sqlite":
+        return
+    get_triggers = sa.text("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+    triggers = set(connection.execute(get_triggers).scalars())
+    missing = [
+        table for table in COUNTED_TABLES if f"{table}_count_insert" not in triggers
+    ]
+    for statement in chain.from_iterable(map(_row_count_ddl, missing)):
+        connection.exec_driver_sql(statement)
+
+
+# Counters are created once all of the tables that they count exist
+sa.event.listen(
+    Base.metadata,
+    "after_create",
+    lambda target, connection, **kw: create_row_counters(connection),
+)
+
+
+# -----------------------------------------------------------------------
+# Table versions
+
+# Every write to a table increases its version, so clients can tell whether data
+# read from it has changed without reading it again.
+VERSIONED_TABLES = [
+    Message.__tablename__,
+    Code.__tablename__,
+    Annotation.__tablename__,
+]
+
+
+def create_table_versions(connection: sa.Connection) -> None:
+    """Start counting the versions of every versioned table from zero."""
+    rows = [{"table_name": table, "version": 0} for table in VERSIONED_TABLES]
+    connection.execute(sa.insert(TableVersion), rows)
+
+
+sa.event.listen(
+    TableVersion.__table__,
+    "after_create",
+    lambda target, connection, **kw: create_table_versions(connection),
+)
@@ -0,0 +1,46 @@
+"""Provide responses for serving rows read from the database."""
+
+import time
+from importlib.util import find_spec
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from .instrumentation import record_serialization
+
+# Serialise with orjson if it is installed, as it is much faster
+_render: Callable[[Any, Any], bytes] = (
+    ORJSONResponse.render if find_spec("orjson") else JSONResponse.render
+)
+
+
+class RowsJSONResponse(JSONResponse):
+    """Serialise rows read from the database.
+
+    Read endpoints return rows as they are, which skips validating them against
+    their response models.
+    """
+
+    def render(self, content: Any) -> bytes:
+        start = time.perf_counter()
+        body = _render(self, content)
+        record_serialization(time.perf_counter() - start)
+        return body
+
+
+def make_etag(versions: List[int]) -> str:
+    """Make a strong ETag for data read from tables at the given `versions`."""
+    return '"' + ".".join(map(str, versions)) + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check whether an `If-None-Match` request header matches `etag`."""
+    if if_none_match is None:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+
+def cache_headers(etag: str) -> Dict[str, str]:
+    """Make headers requiring clients to revalidate their copy using `etag`."""
+    return {"ETag": etag, "Cache-Control": "no-cache"}
@@ -1,5 +1,6 @@
 """Define the Pydantic data schemas."""
-from typing import Tuple
+from enum import Enum
+from typing import Any, Dict, List, Optional, Tuple
 
 from pydantic import BaseModel, ConfigDict
 
@@ -17,8 +18,26 @@ class Message(MessageBase):
     id: int
 
 
+class Turn(Message):
+    conversation_id: Optional[int] = None
+    turn_idx: Optional[int] = None
+
+
+class CreatedMessage(Turn):
+    # Stored messages which the message is a near duplicate of
+    duplicates: List[int] = []
+
+
+class MessagePage(BaseModel):
+    items: List[Message]
+    next_cursor: Optional[str]
+
+
 class CreateMessage(MessageBase):
-    pass
+    # Messages taken from a conversation are appended as its next turn, unless
+    # their turn is given
+    conversation_id: Optional[int] = None
+    turn_idx: Optional[int] = None
 
 
 class UpdateMessage(MessageBase):
@@ -29,6 +48,38 @@ class DeleteMessage(BaseModel):
     id: int
 
 
+class ImportRowError(BaseModel):
+    line: int
+    error: str
+
+
+class ImportResult(BaseModel):
+    inserted: int
+    failed: int
+    duplicates: int = 0
+    errors: List[ImportRowError]
+    seconds: float
+    rows_per_second: float
+
+
+# -----------------------------------------------------------------------
+# Conversations
+
+
+class ConversationBase(BaseModel):
+    name: Optional[str] = None
+
+
+class Conversation(ConversationBase):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+
+
+class CreateConversation(ConversationBase):
+    pass
+
+
 # -----------------------------------------------------------------------
 # Codes
 
@@ -55,6 +106,17 @@ class DeleteCode(CodeBase):
     pass
 
 
+class ImportCodes(BaseModel):
+    codes: List[str] = []
+    # Nested path segments, e.g. {"emotion": {"joy": {}, "anger": {}}}
+    tree: Dict[str, Any] = {}
+
+
+class ImportCodesResult(BaseModel):
+    created: int
+    existing: int
+
+
 # -----------------------------------------------------------------------
 # Annotations
 
@@ -88,3 +150,67 @@ class UpdateAnnotation(AnnotationBase):
 
 class DeleteAnnotation(BaseModel):
     id: int
+
+
+class AnnotationSuggestion(AnnotationBase):
+    code: str
+    count: int  # Annotations of the same phrase with this code
+
+
+class AnnotationBatch(BaseModel):
+    create: List[CreateAnnotation] = []
+    update: List[UpdateAnnotation] = []
+    delete: List[DeleteAnnotation] = []
+
+
+class AnnotationBatchResult(BaseModel):
+    created: List[int]
+    updated: int
+    deleted: int
+
+
+# -----------------------------------------------------------------------
+# Analytics
+
+
+class CodeFrequency(Code):
+    count: int  # Annotations with exactly this code
+    total: int  # Annotations with this code or any of its descendants
+
+
+class CodeCooccurrence(BaseModel):
+    code: str
+    other_code: str
+    count: int  # Messages annotated with both codes
+
+
+class SpanLengthBin(BaseModel):
+    min_length: int
+    max_length: int
+    count: int
+
+
+# -----------------------------------------------------------------------
+# Changes
+
+
+class ChangeOperation(str, Enum):
+    CREATE = "create"
+    UPDATE = "update"
+    DELETE = "delete"
+    RELOAD = "reload"  # Many rows of the table were written at once
+
+
+class Change(BaseModel):
+    seq: int
+    table: str
+    operation: ChangeOperation
+    row_id: Optional[int]
+    data: Optional[Dict[str, Any]]  # Values of the columns written
+
+
+class ChangeFeed(BaseModel):
+    changes: List[Change]
+    seq: int  # Of the last change read, to read the following changes from
+    # Changes were pruned from the log, so every table must be read again
+    reload: bool
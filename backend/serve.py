@@ -0,0 +1,54 @@
+"""Serve the API from several worker processes.
+
+Run with `python -m backend.serve --workers 4`.
+"""
+
+import argparse
+import os
+from typing import List, Optional
+
+import uvicorn
+
+from alembic import command
+from alembic.config import Config
+
+from .config import ROOT_DIR
+from .database import init_database
+
+
+def prepare_database(migrate: bool) -> None:
+    """Create or migrate the database once, before any worker starts."""
+    if migrate:
+        config = Config(str(ROOT_DIR / "alembic.ini"))
+        config.set_main_option("script_location", str(ROOT_DIR / "alembic"))
+        command.upgrade(config, "head")
+    init_database()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Prepare the database and then serve the API from `--workers` processes.
+
+    Workers read from the database concurrently, while writes to SQLite are
+    queued by a lock shared between them so that only one transaction writes at
+    a time.
+    """
+    parser = argparse.ArgumentParser(prog="python -m backend.serve")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--migrate", action="store_true", help="run `alembic upgrade head` first"
+    )
+    args = parser.parse_args(argv)
+    prepare_database(args.migrate)
+    # Workers inherit the environment, so skip preparing the database again and
+    # check for codes written by other workers before using the cache
+    os.environ["DATABASE_INIT"] = "false"
+    os.environ["CODE_CACHE_SHARED"] = "true"
+    uvicorn.run(
+        "backend.main:app", host=args.host, port=args.port, workers=args.workers
+    )
+
+
+if __name__ == "__main__":
+    main()
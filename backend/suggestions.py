@@ -0,0 +1,265 @@
+"""Suggest annotations of messages from the phrases that have already been coded.
+
+Every annotated span is a phrase labelled with a code. An Aho-Corasick automaton
+of these phrases finds every occurrence of all of them in a message in a single
+pass over its content, however many phrases there are.
+"""
+
+import threading
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from .models import Annotation, Message, TableVersion
+
+# Shorter phrases match too often by chance to be worth suggesting, and longer
+# ones are passages rarely repeated exactly, which would bloat the automaton
+MIN_PHRASE_LENGTH = 3
+MAX_PHRASE_LENGTH = 64
+
+# The recent automaton is merged into the base one once it holds this many phrases,
+# or a quarter as many as the base one if more
+MIN_MERGE_SIZE = 256
+
+# The text of the span of each annotation, as a (1-based) SQL substring
+annotation_phrase = sa.func.substr(
+    Message.content, Annotation.start_idx + 1, Annotation.end_idx - Annotation.start_idx
+)
+
+# A span of a message, a code suggested for it and how often it was coded so
+CodedSpan = Tuple[int, int, int, int]
+
+
+def normalize(text: str) -> str:
+    """Lower the case of `text` without changing the index of any character."""
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    return "".join(c if len(c.lower()) != 1 else c.lower() for c in text)
+
+
+class PhraseAutomaton:
+    """An Aho-Corasick automaton finding every occurrence of a set of phrases."""
+
+    def __init__(self, phrases: Iterable[str]) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._outputs: List[Tuple[str, ...]] = [()]
+        self.phrases: Set[str] = set()
+        for phrase in phrases:
+            self._insert(phrase)
+        self._link()
+
+    def _insert(self, phrase: str) -> None:
+        self.phrases.add(phrase)
+        node = 0
+        for character in phrase:
+            child = self._goto[node].get(character)
+            if child is None:
+                child = self._goto[node][character] = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append(())
+            node = child
+        self._outputs[node] = (phrase,)
+
+    def _link(self) -> None:
+        """Link each node to the node of its longest proper suffix, in order of
+        depth, and add the phrases ending at that node to its own.
+        """
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for character, child in self._goto[node].items():
+                fail = self._next(self._fail[node], character)
+                self._fail[child] = fail
+                self._outputs[child] += self._outputs[fail]
+                queue.append(child)
+
+    def _next(self, node: int, character: str) -> int:
+        while node and character not in self._goto[node]:
+            node = self._fail[node]
+        return self._goto[node].get(character, 0)
+
+    def find(self, text: str) -> Iterator[Tuple[int, int, str]]:
+        """Find the start, end and phrase of every occurrence of a phrase."""
+        node = 0
+        for end, character in enumerate(text, start=1):
+            node = self._next(node, character)
+            for phrase in self._outputs[node]:
+                yield end - len(phrase), end, phrase
+
+
+class SuggestionIndex:
+    """Hold automata of the coded phrases of annotations, updated as they change.
+
+    Phrases are added to a small recent automaton, which is cheap to rebuild
+    after each change, and periodically merged into a large base automaton, so
+    that the whole index is not rebuilt on every write. Phrases whose last
+    annotation is removed stay in the automata until the next merge, but are
+    no longer suggested.
+
+    As with `CodeCache`, if `shared` the version of the annotations table is
+    checked on every read, and the index reloaded if another worker process has
+    written to it.
+    """
+
+    def __init__(self, shared: bool = False) -> None:
+        self.shared = shared
+        self._counts: Dict[str, Dict[int, int]] = {}  # Of each code of each phrase
+        self._base = PhraseAutomaton([])
+        self._recent = PhraseAutomaton([])
+        self._recent_phrases: Set[str] = set()  # Added since the last merge
+        self._loaded = False
+        self._version: Optional[int] = None
+        self._generation = 0  # Increased to discard indexes loaded before a write
+        self._lock = threading.Lock()
+
+    def suggest(self, session: Session, content: str) -> List[CodedSpan]:
+        """Find the spans of `content` matching coded phrases, with each code and
+        the number of times the phrase was coded with it.
+
+        The database is only read outside of the lock, as asynchronous sessions
+        hand the event loop to other requests while waiting for it.
+        """
+        version = self._read_version(session) if self.shared else None
+        with self._lock:
+            loaded = self._loaded and version == self._version
+            generation = self._generation
+            counts, automata = self._counts, [self._base, self._recent]
+        if not loaded:
+            counts = _read_counts(session)
+            automata = [PhraseAutomaton(counts)]
+            self._swap(generation, counts, automata[0], version)
+        text = normalize(content)
+        with self._lock:
+            matches = [match for phrases in automata for match in phrases.find(text)]
+            return sorted(
+                (start, end, code_id, count)
+                for start, end, phrase in matches
+                if _at_word_boundaries(text, start, end)
+                for code_id, count in counts.get(phrase, {}).items()
+            )
+
+    def update(
+        self,
+        session: Session,
+        added: Iterable[Tuple[str, int]],
+        removed: Iterable[Tuple[str, int]] = (),
+    ) -> None:
+        """Count the `(phrase, code id)` pairs of annotations that were committed
+        and uncount those of annotations that were changed or deleted.
+        """
+        version = self._read_version(session) if self.shared else None
+        with self._lock:
+            self._generation += 1
+            if not self._loaded or not self._follows_version(version):
+                self._loaded = False  # Reloaded in full on the next read
+                return
+            for phrase, code_id in removed:
+                self._count(phrase, code_id, -1)
+            for phrase, code_id in added:
+                self._count(phrase, code_id, 1)
+            self._rebuild()
+
+    def invalidate(self) -> None:
+        """Discard the index after annotations were written in bulk."""
+        with self._lock:
+            self._generation += 1
+            self._loaded = False
+
+    def _swap(
+        self,
+        generation: int,
+        counts: Dict[str, Dict[int, int]],
+        base: PhraseAutomaton,
+        version: Optional[int],
+    ) -> None:
+        """Replace the index with one loaded in full, unless it was written to
+        while loading.
+        """
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._counts, self._base = counts, base
+            self._recent = PhraseAutomaton([])
+            self._recent_phrases = set()
+            self._loaded = True
+            self._version = version
+
+    def _follows_version(self, version: Optional[int]) -> bool:
+        """Check that no other process has written annotations since the index
+        was loaded, if shared, as each commit increases the version by one.
+        """
+        if not self.shared:
+            return True
+        follows = self._version is not None and version == self._version + 1
+        self._version = version
+        return follows
+
+    def _count(self, phrase: Optional[str], code_id: int, count: int) -> None:
+        counted = _add_count(self._counts, phrase, code_id, count)
+        if counted is not None and counted not in self._base.phrases:
+            self._recent_phrases.add(counted)
+
+    def _rebuild(self) -> None:
+        if len(self._recent_phrases) < max(
+            MIN_MERGE_SIZE, len(self._base.phrases) // 4
+        ):
+            if self._recent_phrases != self._recent.phrases:
+                self._recent = PhraseAutomaton(self._recent_phrases)
+            return
+        self._counts = {
+            phrase: codes for phrase, codes in self._counts.items() if codes
+        }
+        self._base = PhraseAutomaton(self._counts)
+        self._recent = PhraseAutomaton([])
+        self._recent_phrases = set()
+
+    def _read_version(self, session: Session) -> Optional[int]:
+        statement = sa.select(TableVersion.version).where(
+            TableVersion.table_name == Annotation.__tablename__
+        )
+        return session.execute(statement).scalar_one_or_none()
+
+
+def _read_counts(session: Session) -> Dict[str, Dict[int, int]]:
+    """Count the annotations of each code of each coded phrase."""
+    statement = sa.select(annotation_phrase, Annotation.code_id, sa.func.count()).join(
+        Message, Message.id == Annotation.message_id
+    )
+    statement = statement.group_by(annotation_phrase, Annotation.code_id)
+    counts: Dict[str, Dict[int, int]] = {}
+    for phrase, code_id, count in session.execute(statement).tuples():
+        _add_count(counts, phrase, code_id, count)
+    return counts
+
+
+def _add_count(
+    counts: Dict[str, Dict[int, int]], phrase: Optional[str], code_id: int, count: int
+) -> Optional[str]:
+    """Add `count` to the times `phrase` was coded with a code, returning the
+    normalized phrase if it is indexed and still coded so.
+    """
+    phrase = normalize(phrase or "").strip()
+    if not MIN_PHRASE_LENGTH <= len(phrase) <= MAX_PHRASE_LENGTH:
+        return None
+    codes = counts.setdefault(phrase, {})
+    codes[code_id] = codes.get(code_id, 0) + count
+    if codes[code_id] > 0:
+        return phrase
+    del codes[code_id]
+    return None
+
+
+def _at_word_boundaries(text: str, start: int, end: int) -> bool:
+    """Check that a span does not start or end part way through a word."""
+    starts_word = start == 0 or not (
+        text[start - 1].isalnum() and text[start].isalnum()
+    )
+    ends_word = end == len(text) or not (
+        text[end - 1].isalnum() and text[end].isalnum()
+    )
+    return starts_word and ends_word
@@ -0,0 +1,45 @@
+"""Provide a synthetic corpus to the CRUD benchmarks."""
+
+from dataclasses import fields
+from typing import Generator
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from benchmarks.corpus import CorpusShape, create_corpus
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    for field in fields(CorpusShape):
+        parser.addoption(
+            "--corpus-" + field.name.replace("_", "-"),
+            type=int,
+            default=field.default,
+            help=f"{field.name.replace('_', ' ')} of the benchmark corpus",
+        )
+
+
+@pytest.fixture(scope="session")
+def corpus_shape(request: pytest.FixtureRequest) -> CorpusShape:
+    options = {
+        field.name: request.config.getoption("corpus_" + field.name)
+        for field in fields(CorpusShape)
+    }
+    return CorpusShape(**options)
+
+
+@pytest.fixture(scope="session")
+def corpus_engine(
+    corpus_shape: CorpusShape, tmp_path_factory: pytest.TempPathFactory
+) -> Generator[sa.Engine, None, None]:
+    path = tmp_path_factory.mktemp("corpus") / "corpus.db"
+    engine = create_corpus(f"sqlite+pysqlite:///{path}", corpus_shape)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture()
+def session(corpus_engine: sa.Engine) -> Generator[Session, None, None]:
+    with Session(corpus_engine) as session:
+        yield session
@@ -0,0 +1,139 @@
+"""Generate a synthetic corpus of messages, codes and annotations to benchmark.
+
+Run with `python -m benchmarks.corpus --messages 100000` to fill the database
+given by `DATABASE_URL`, or pass `--database-url`.
+"""
+
+import argparse
+import random
+from dataclasses import dataclass, fields
+from itertools import islice
+from typing import Iterator, List
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from backend import crud
+from backend import schemas as sch
+from backend.config import DATABASE_URL, IMPORT_BATCH_SIZE
+from backend.database import create_database_engine
+from backend.models import Base, Code, Conversation, Message
+
+WORDS = (
+    "the a to and of I you it is that was for on my with have this but not are "
+    "so be at they just what can if like feel happy sad angry worried about work "
+    "time really think know today people help need good bad tired again never"
+).split()
+
+
+@dataclass
+class CorpusShape:
+    messages: int = 10000
+    codes: int = 100
+    depth: int = 3  # Levels of the code hierarchy
+    annotations_per_message: int = 3
+    turns_per_conversation: int = 20
+    min_words: int = 5
+    max_words: int = 60
+    seed: int = 0
+
+
+def generate_codes(shape: CorpusShape, rng: random.Random) -> List[str]:
+    """Generate a hierarchy of codes, each the child of an earlier code or a root."""
+    codes: List[str] = []
+    parents = [""]  # Codes above the deepest level
+    for i in range(shape.codes):
+        parent = rng.choice(parents)
+        code = f"{parent}/{rng.choice(WORDS)}{i}"
+        codes.append(code)
+        if code.count("/") < shape.depth:
+            parents.append(code)
+    return codes
+
+
+def generate_messages(shape: CorpusShape, rng: random.Random) -> Iterator[str]:
+    """Generate the content of messages as sequences of random words."""
+    for _ in range(shape.messages):
+        length = rng.randint(shape.min_words, shape.max_words)
+        yield " ".join(rng.choices(WORDS, k=length))
+
+
+def generate_corpus(session: Session, shape: CorpusShape) -> None:
+    """Insert a corpus of the given `shape` using the CRUD operations."""
+    rng = random.Random(shape.seed)
+    crud.import_codes(session, sch.ImportCodes(codes=generate_codes(shape, rng)))
+    conversations = -(-shape.messages // shape.turns_per_conversation)
+    session.execute(
+        sa.insert(Conversation),
+        [{"name": f"Conversation {i}"} for i in range(conversations)],
+    )
+    messages = enumerate(generate_messages(shape, rng))
+    while batch := list(islice(messages, IMPORT_BATCH_SIZE)):
+        crud.create_messages(
+            session,
+            [
+                sch.CreateMessage(
+                    content=content,
+                    conversation_id=i // shape.turns_per_conversation + 1,
+                )
+                for i, content in batch
+            ],
+        )
+    code_ids = list(session.scalars(sa.select(Code.id)))
+    get_lengths = sa.select(Message.id, sa.func.length(Message.content))
+    lengths = iter(session.execute(get_lengths).tuples().all())
+    while rows := list(islice(lengths, IMPORT_BATCH_SIZE)):
+        annotations = [
+            _random_annotation(rng, message_id, length, code_ids)
+            for message_id, length in rows
+            for _ in range(shape.annotations_per_message)
+        ]
+        crud.apply_annotation_batch(session, sch.AnnotationBatch(create=annotations))
+
+
+def _random_annotation(
+    rng: random.Random, message_id: int, length: int, code_ids: List[int]
+) -> sch.CreateAnnotation:
+    start = rng.randrange(length)
+    return sch.CreateAnnotation(
+        message_id=message_id,
+        code_id=rng.choice(code_ids),
+        start_idx=start,
+        end_idx=rng.randint(start + 1, min(length, start + 80)),
+    )
+
+
+def create_corpus(url: str, shape: CorpusShape) -> sa.Engine:
+    """Create the tables of a database and fill it with a corpus."""
+    engine = create_database_engine(url)
+    Base.metadata.create_all(bind=engine)
+    with Session(engine) as session:
+        generate_corpus(session, shape)
+    return engine
+
+
+def add_shape_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add options setting each field of `CorpusShape` to `parser`."""
+    for field in fields(CorpusShape):
+        option = "--" + field.name.replace("_", "-")
+        parser.add_argument(option, type=int, default=field.default)
+
+
+def shape_from_arguments(args: argparse.Namespace) -> CorpusShape:
+    """Read the options added by `add_shape_arguments`."""
+    return CorpusShape(
+        **{field.name: getattr(args, field.name) for field in fields(CorpusShape)}
+    )
+
+
+def main() -> None:
+    """Fill a database with a synthetic corpus."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url", default=DATABASE_URL)
+    add_shape_arguments(parser)
+    args = parser.parse_args()
+    create_corpus(args.database_url, shape_from_arguments(args)).dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Measure the latency and throughput of the API under concurrent load.
+
+Run with `python -m benchmarks.load --messages 10000 --duration 10`, which serves
+`backend.main:app` with uvicorn from a fresh synthetic corpus, or pass `--url` to
+load an API that is already running.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+import httpx
+
+from benchmarks.corpus import add_shape_arguments, create_corpus, shape_from_arguments
+
+SEARCHES = ["happy", "worried about", "tired again", "people"]
+
+# Paths requested by each scenario, given a random number generator and the number
+# of messages in the database
+Scenario = Callable[[random.Random, int], str]
+
+SCENARIOS: Dict[str, Scenario] = {
+    "read_messages": lambda rng, n: f"/messages/?limit=50&offset={rng.randrange(n)}",
+    "read_messages_page": lambda rng, n: "/messages/page/?limit=50&sort_by=content",
+    "search_messages": lambda rng, n: f"/messages/?search={rng.choice(SEARCHES)}",
+    "read_context": lambda rng, n: f"/messages/{rng.randrange(n) + 1}/context/",
+    "count_messages": lambda rng, n: "/messages/count/",
+    "read_codes": lambda rng, n: "/codes/",
+    "read_annotations": lambda rng, n: f"/annotations/{rng.randrange(n) + 1}/",
+    "read_suggestions": lambda rng, n: (
+        f"/annotations/{rng.randrange(n) + 1}/suggestions/"
+    ),
+    "read_code_frequencies": lambda rng, n: "/analytics/codes/",
+    "read_changes": lambda rng, n: "/changes/?since=0",
+}
+
+
+class Results:
+    """Latencies of the requests made by a scenario."""
+
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.errors = 0
+
+    def report(self, name: str, seconds: float) -> str:
+        if len(self.latencies) < 2:
+            return f"{name:<24}{'too few requests':>40}"
+        percentiles = statistics.quantiles(self.latencies, n=100)
+        p50, p99 = percentiles[49] * 1000, percentiles[98] * 1000
+        rate = len(self.latencies) / seconds
+        return (
+            f"{name:<24}{len(self.latencies):>10,}{rate:>12,.0f}"
+            f"{p50:>10.2f}{p99:>10.2f}{self.errors:>8}"
+        )
+
+
+async def _make_requests(
+    client: httpx.AsyncClient,
+    scenario: Scenario,
+    rng: random.Random,
+    messages: int,
+    deadline: float,
+    results: Results,
+) -> None:
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = await client.get(scenario(rng, messages))
+        results.latencies.append(time.perf_counter() - start)
+        results.errors += response.is_error
+
+
+async def run_scenario(
+    url: str, scenario: Scenario, concurrency: int, duration: float, seed: int
+) -> Results:
+    """Make requests from `concurrency` clients at once for `duration` seconds."""
+    results = Results()
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits) as client:
+        messages = int((await client.get("/messages/count/")).json()) or 1
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(
+            *(
+                _make_requests(
+                    client,
+                    scenario,
+                    random.Random(seed + i),
+                    messages,
+                    deadline,
+                    results,
+                )
+                for i in range(concurrency)
+            )
+        )
+    return results
+
+
+@contextmanager
+def serve(database_url: str, port: int, workers: int) -> Iterator[str]:
+    """Serve the API with uvicorn from `database_url` until the context exits."""
+    command = [sys.executable, "-m", "uvicorn", "backend.main:app"]
+    command += ["--port", str(port), "--workers", str(workers), "--log-level", "error"]
+    environment = {**os.environ, "DATABASE_URL": database_url}
+    with subprocess.Popen(command, env=environment) as server:
+        url = f"http://127.0.0.1:{port}"
+        try:
+            _wait_until_ready(url)
+            yield url
+        finally:
+            server.terminate()
+
+
+def _wait_until_ready(url: str, timeout: float = 30) -> None:
+    deadline = time.perf_counter() + timeout
+    while not _is_ready(url):
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"API at {url} did not start")
+        time.sleep(0.1)
+
+
+def _is_ready(url: str) -> bool:
+    try:
+        return httpx.get(url + "/codes/count/").is_success
+    except httpx.TransportError:
+        return False
+
+
+def run(url: str, args: argparse.Namespace) -> None:
+    """Run every scenario selected by `args` against `url` and print the results."""
+    header = f"{'requests':>10}{'requests/s':>12}{'p50 ms':>10}{'p99 ms':>10}"
+    print(f"{'':<24}{header}{'errors':>8}")
+    for name in args.scenarios:
+        results = asyncio.run(
+            run_scenario(
+                url, SCENARIOS[name], args.concurrency, args.duration, args.seed
+            )
+        )
+        print(results.report(name, args.duration))
+
+
+def _load_fresh_corpus(args: argparse.Namespace) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = f"sqlite+pysqlite:///{Path(directory) / 'corpus.db'}"
+        create_corpus(database_url, shape_from_arguments(args)).dispose()
+        with serve(database_url, args.port, args.workers) as url:
+            run(url, args)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Load the API with each scenario in turn."""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load")
+    parser.add_argument("--url", help="API to load instead of serving a new one")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5, help="seconds each")
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS)
+    )
+    add_shape_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.url is None:
+        _load_fresh_corpus(args)
+    else:
+        run(args.url, args)
+
+
+if __name__ == "__main__":
+    main()
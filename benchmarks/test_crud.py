@@ -0,0 +1,176 @@
+"""Benchmark each CRUD operation against a synthetic corpus.
+
+Run with `pytest benchmarks`, after `pdm install -G bench`. Options such as
+`--corpus-messages 100000` change the size of the corpus and
+`--benchmark-compare` compares the results with a previous run saved with
+`--benchmark-autosave`.
+"""
+
+from itertools import count
+from typing import Any, Callable, Dict, Tuple
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from backend import crud
+from backend import schemas as sch
+from backend.models import Annotation, Code, Message
+from benchmarks.corpus import CorpusShape
+
+pytest.importorskip("pytest_benchmark")
+
+Arguments = Tuple[Tuple[Any, ...], Dict[str, Any]]
+
+READS: Dict[str, Tuple[Callable[..., Any], Dict[str, Any]]] = {
+    "count_messages": (crud.count_messages, {}),
+    "count_messages_search": (crud.count_messages, {"search": "happy sad"}),
+    "read_messages": (crud.read_messages, {"limit": 100, "offset": 1000}),
+    "read_messages_search": (crud.read_messages, {"search": "worried", "limit": 100}),
+    "read_messages_sorted": (
+        crud.read_messages,
+        {"limit": 100, "sort_by": "content", "sort_asc": False},
+    ),
+    "read_messages_page": (
+        crud.read_messages_page,
+        {"limit": 100, "sort_by": "content"},
+    ),
+    "read_context": (crud.read_context, {"message_id": 42, "turns": 5}),
+    "count_codes": (crud.count_codes, {}),
+    "read_codes": (crud.read_codes, {}),
+    "read_codes_search": (crud.read_codes, {"search": "happy"}),
+    "read_annotations": (crud.read_annotations, {"message_id": 42}),
+    "read_annotations_overlapping": (
+        crud.read_annotations,
+        {"message_id": 42, "overlaps": (10, 20)},
+    ),
+    "read_annotations_for_messages": (
+        crud.read_annotations_for_messages,
+        {"message_ids": list(range(1, 101))},
+    ),
+    "read_suggestions": (crud.read_suggestions, {"message_id": 42}),
+    "read_code_frequencies": (crud.read_code_frequencies, {}),
+    "read_code_cooccurrences": (crud.read_code_cooccurrences, {}),
+    "read_span_lengths": (crud.read_span_lengths, {"bin_width": 10}),
+    "read_table_versions": (crud.read_table_versions, {"tables": ["messages"]}),
+    "read_changes": (crud.read_changes, {"since": 0, "limit": 1000}),
+}
+
+
+@pytest.mark.parametrize("name", READS)
+def test_read(benchmark: Any, session: Session, name: str) -> None:
+    function, kwargs = READS[name]
+    benchmark(function, session, **kwargs)
+
+
+def test_read_codes_uncached(benchmark: Any, session: Session) -> None:
+    def setup() -> Arguments:
+        crud.code_cache.invalidate()
+        return (session,), {}
+
+    benchmark.pedantic(crud.read_codes, setup=setup, rounds=100)
+
+
+def test_read_dataset_subtree(benchmark: Any, session: Session) -> None:
+    code = session.scalars(sa.select(Code.code).order_by(Code.id)).first()
+    benchmark(lambda: sum(1 for _ in crud.read_dataset(session, code)))
+
+
+def test_create_message(benchmark: Any, session: Session) -> None:
+    message = sch.CreateMessage(content="I feel happy about work today")
+    benchmark(crud.create_message, session, message)
+
+
+def test_create_messages(benchmark: Any, session: Session) -> None:
+    messages = [sch.CreateMessage(content=f"Message {i}") for i in range(1000)]
+    benchmark(crud.create_messages, session, messages)
+
+
+def test_update_message(benchmark: Any, session: Session) -> None:
+    # Extending the content keeps the spans of its annotations within it
+    content = session.execute(sa.select(Message.content).where(Message.id == 42))
+    message = sch.UpdateMessage(id=42, content=f"{content.scalar_one()} again")
+    benchmark(crud.update_message, session, message)
+
+
+def test_delete_message(benchmark: Any, session: Session) -> None:
+    def setup() -> Arguments:
+        message = crud.create_message(session, sch.CreateMessage(content="Deleted"))
+        return (session, sch.DeleteMessage(id=int(message.id))), {}
+
+    benchmark.pedantic(crud.delete_message, setup=setup, rounds=100)
+
+
+def test_create_code(benchmark: Any, session: Session) -> None:
+    ids = count()
+    benchmark(
+        lambda: crud.create_code(session, sch.CreateCode(code=f"/new{next(ids)}"))
+    )
+
+
+def test_import_codes(benchmark: Any, session: Session) -> None:
+    codebook = sch.ImportCodes(codes=[f"/imported/code{i}" for i in range(100)])
+    benchmark(crud.import_codes, session, codebook)
+
+
+def test_update_code(benchmark: Any, session: Session) -> None:
+    code = crud.create_code(session, sch.CreateCode(code="/renamed/child"))
+    assert code is not None
+    ids = count()
+
+    def rename() -> None:
+        crud.update_code(
+            session, sch.UpdateCode(id=int(code.id), code=f"/rename{next(ids)}")
+        )
+
+    benchmark(rename)
+
+
+def test_delete_code(benchmark: Any, session: Session) -> None:
+    ids = count()
+
+    def setup() -> Arguments:
+        code = crud.create_code(session, sch.CreateCode(code=f"/deleted{next(ids)}/a"))
+        assert code is not None
+        return (session, sch.DeleteCode(code=str(code.code))), {}
+
+    benchmark.pedantic(crud.delete_code, setup=setup, rounds=100)
+
+
+def _annotation(session: Session, **values: int) -> Dict[str, int]:
+    code_id = session.scalars(sa.select(Code.id).limit(1)).one()
+    return {"code_id": code_id, "start_idx": 0, "end_idx": 1, **values}
+
+
+def test_create_annotation(benchmark: Any, session: Session) -> None:
+    annotation = sch.CreateAnnotation(**_annotation(session, message_id=42))
+    benchmark(crud.create_annotation, session, annotation)
+
+
+def test_update_annotation(benchmark: Any, session: Session) -> None:
+    annotation_id = session.scalars(sa.select(Annotation.id).limit(1)).one()
+    annotation = sch.UpdateAnnotation(**_annotation(session, id=annotation_id))
+    benchmark(crud.update_annotation, session, annotation)
+
+
+def test_delete_annotation(benchmark: Any, session: Session) -> None:
+    annotation = sch.CreateAnnotation(**_annotation(session, message_id=42))
+
+    def setup() -> Arguments:
+        created = crud.create_annotation(session, annotation)
+        return (session, sch.DeleteAnnotation(id=int(created.id))), {}
+
+    benchmark.pedantic(crud.delete_annotation, setup=setup, rounds=100)
+
+
+def test_apply_annotation_batch(
+    benchmark: Any, session: Session, corpus_shape: CorpusShape
+) -> None:
+    message_ids = range(1, min(corpus_shape.messages, 100) + 1)
+    batch = sch.AnnotationBatch(
+        create=[
+            sch.CreateAnnotation(**_annotation(session, message_id=message_id))
+            for message_id in message_ids
+        ]
+    )
+    benchmark(crud.apply_annotation_batch, session, batch)
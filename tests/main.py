@@ -1,14 +1,47 @@
 """Some example unit tests of the API and database CRUD code."""
 
-from typing import Any, Generator
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+from operator import itemgetter
+from pathlib import Path
+from typing import Any, AsyncGenerator, Generator
 
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import StaticPool, create_engine
+from sqlalchemy import NullPool, StaticPool, create_engine, text, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import Session, sessionmaker
 
+from alembic import command
+from alembic.config import Config
+from backend import crud, dedup, instrumentation, serve
+from backend.cache import CodeCache
+from backend.changes import KEEPALIVE_EVENT, ChangeBroadcaster, format_events
+from backend.config import ROOT_DIR, SQLITE_PRAGMAS
+from backend.crud import code_cache, suggestion_index
+from backend.database import (
+    WriteLock,
+    create_database_engine,
+    find_missing_indexes,
+)
 from backend.main import app, get_session
-from backend.models import Base
+from backend.models import (
+    Annotation,
+    Base,
+    Code,
+    Message,
+    MessageSignature,
+    TableVersion,
+)
+from backend.suggestions import SuggestionIndex
 
 # Set up database in memory
 SQLALCHEMY_DATABASE_URL = "sqlite+pysqlite:///:memory:"
@@ -39,6 +72,8 @@ client = TestClient(app)
 @pytest.fixture()
 def test_db() -> Generator[None, None, None]:
     Base.metadata.create_all(bind=engine)
+    code_cache.invalidate()  # Codes cached from the previous test's database
+    suggestion_index.invalidate()
     yield
     Base.metadata.drop_all(bind=engine)
 
@@ -92,6 +127,11 @@ def test_update_message(test_db: Any) -> None:
     assert data[0]["content"] == "I'm an updated message!"
     assert data[0]["id"] == message_id
 
+    missing = {"id": message_id + 1, "content": "Missing"}
+    response = client.post("/messages/update/", json=missing)
+    assert response.status_code == 404, response.text
+    _create_test_message()  # Not given the id of the missing message's signature
+
 
 def test_delete_message(test_db: Any) -> None:
     data = _create_test_message()
@@ -120,3 +160,1073 @@ def test_creating_annotation_for_nonexistant_message_returns_error(
         },
     )
     assert response.status_code == 404, response.text
+
+
+def _create_messages(*contents: str) -> list[Any]:
+    messages = []
+    for content in contents:
+        response = client.post("/messages/create/", json={"content": content})
+        assert response.status_code == 200, response.text
+        messages.append(response.json())
+    return messages
+
+
+def test_search_messages_uses_substring_matching(test_db: Any) -> None:
+    _create_messages("I feel happy today", "Unhappiness again", "Nothing here")
+
+    response = client.get("/messages/", params={"search": "happ"})
+    assert response.status_code == 200, response.text
+    contents = {message["content"] for message in response.json()}
+    assert contents == {"I feel happy today", "Unhappiness again"}
+
+
+def test_search_messages_with_short_term(test_db: Any) -> None:
+    _create_messages("I am ok", "Fine")
+
+    response = client.get("/messages/", params={"search": "ok"})
+    assert response.status_code == 200, response.text
+    assert [message["content"] for message in response.json()] == ["I am ok"]
+
+
+def test_search_index_follows_updates_and_deletes(test_db: Any) -> None:
+    first, second = _create_messages("A sunny day", "A sunny evening")
+    client.post("/messages/update/", json={"id": first["id"], "content": "Rain"})
+    client.post("/messages/delete/", json={"id": second["id"]})
+
+    response = client.get("/messages/", params={"search": "sunny"})
+    assert response.status_code == 200, response.text
+    assert response.json() == []
+    response = client.get("/messages/", params={"search": "Rain"})
+    assert [message["id"] for message in response.json()] == [first["id"]]
+
+
+def test_read_messages_unsorted_in_order_of_id(test_db: Any) -> None:
+    messages = _create_messages("b", "c", "a")
+    ids = [message["id"] for message in messages]
+    response = client.get("/messages/")
+    assert [message["id"] for message in response.json()] == ids
+    response = client.get("/messages/", params={"limit": 2, "offset": 1})
+    assert [message["id"] for message in response.json()] == ids[1:]
+
+
+def _read_all_pages(**params: Any) -> list[Any]:
+    items: list[Any] = []
+    cursor = None
+    while True:
+        response = client.get("/messages/page/", params={**params, "cursor": cursor})
+        assert response.status_code == 200, response.text
+        page = response.json()
+        items += page["items"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return items
+
+
+def test_read_messages_by_cursor(test_db: Any) -> None:
+    _create_messages("b", "a", "c", "a", "d")
+
+    messages = _read_all_pages(limit=2, sort_by="content", sort_asc=False)
+    assert [message["content"] for message in messages] == ["d", "c", "b", "a", "a"]
+    messages = _read_all_pages(limit=2)
+    assert [message["id"] for message in messages] == [1, 2, 3, 4, 5]
+
+
+def test_read_messages_by_cursor_with_search(test_db: Any) -> None:
+    _create_messages("apple pie", "banana", "apple tart", "apple cake")
+
+    messages = _read_all_pages(limit=1, search="apple", sort_by="content")
+    assert [message["content"] for message in messages] == [
+        "apple cake",
+        "apple pie",
+        "apple tart",
+    ]
+
+
+def test_read_messages_with_invalid_cursor_returns_error(test_db: Any) -> None:
+    response = client.get("/messages/page/", params={"cursor": "not a cursor"})
+    assert response.status_code == 400, response.text
+    cursor = base64.urlsafe_b64encode(b"[[1], 2]").decode()  # Not a column value
+    params = {"cursor": cursor, "sort_by": "content"}
+    response = client.get("/messages/page/", params=params)
+    assert response.status_code == 400, response.text
+    response = client.get("/messages/page/", params={"sort_by": "rowid"})
+    assert response.status_code == 400, response.text
+
+
+def test_import_messages_from_ndjson(test_db: Any) -> None:
+    body = '{"content": "first"}\n\nnot json\n{"text": "bad"}\n{"content": "last"}'
+    response = client.post("/messages/import/", content=body.encode())
+    assert response.status_code == 200, response.text
+    result = response.json()
+    assert result["inserted"] == 2
+    assert result["failed"] == 2
+    assert [error["line"] for error in result["errors"]] == [3, 4]
+    assert [message["content"] for message in _read_messages()] == ["first", "last"]
+
+
+def test_import_messages_with_invalid_utf8(test_db: Any) -> None:
+    body = b'{"content": "first"}\n\xff\xfe\n{"content": "last"}'
+    response = client.post("/messages/import/", content=body)
+    assert response.status_code == 200, response.text
+    result = response.json()
+    assert result["inserted"] == 2
+    assert [error["line"] for error in result["errors"]] == [2]
+
+
+def test_import_messages_from_csv(test_db: Any) -> None:
+    body = 'id,content\n1,plain\n2,"with, comma and\nnewline"\n3\n'
+    response = client.post(
+        "/messages/import/", params={"format": "csv"}, content=body.encode()
+    )
+    assert response.status_code == 200, response.text
+    result = response.json()
+    assert result["inserted"] == 2
+    assert result["errors"] == [{"line": 5, "error": "Missing content column"}]
+    assert [message["content"] for message in _read_messages()] == [
+        "plain",
+        "with, comma and\nnewline",
+    ]
+
+
+def test_import_messages_from_csv_without_content_returns_error(test_db: Any) -> None:
+    response = client.post(
+        "/messages/import/", params={"format": "csv"}, content=b"id,text\n1,a\n"
+    )
+    assert response.status_code == 400, response.text
+
+
+def test_read_context_of_message_in_conversation(test_db: Any) -> None:
+    response = client.post("/conversations/create/", json={"name": "Session 1"})
+    assert response.status_code == 200, response.text
+    conversation = response.json()
+    turns = [
+        {"content": f"Turn {i}", "conversation_id": conversation["id"]}
+        for i in range(3)
+    ]
+    for turn in turns:
+        response = client.post("/messages/create/", json=turn)
+        assert response.status_code == 200, response.text
+    body = "\n".join(json.dumps({**turn, "content": "Imported"}) for turn in turns)
+    response = client.post("/messages/import/", content=body.encode())
+    assert response.status_code == 200, response.text
+    (standalone,) = _create_messages("Not in a conversation")
+
+    def read_context(message_id: int, turns: int) -> list[tuple[str, Any]]:
+        response = client.get(
+            f"/messages/{message_id}/context/", params={"turns": turns}
+        )
+        assert response.status_code == 200, response.text
+        return [(m["content"], m["turn_idx"]) for m in response.json()]
+
+    assert read_context(3, turns=1) == [("Turn 1", 1), ("Turn 2", 2), ("Imported", 3)]
+    assert read_context(1, turns=2) == [("Turn 0", 0), ("Turn 1", 1), ("Turn 2", 2)]
+    assert read_context(standalone["id"], turns=2) == [("Not in a conversation", None)]
+    assert client.get("/messages/42/context/").status_code == 404
+
+    response = client.post(
+        "/messages/create/", json={"content": "Lost", "conversation_id": 42}
+    )
+    assert response.status_code == 404, response.text
+    taken = {"content": "Again", "conversation_id": conversation["id"], "turn_idx": 1}
+    response = client.post("/messages/create/", json=taken)
+    assert response.status_code == 409, response.text
+    response = client.get("/conversations/")
+    assert response.json() == [{"id": conversation["id"], "name": "Session 1"}]
+
+    lines = [
+        {"content": "Lost", "conversation_id": 42},
+        {**taken, "turn_idx": 9},
+        taken,
+        {**taken, "turn_idx": 9},
+        {"content": "Appended", "conversation_id": conversation["id"]},
+    ]
+    body = "\n".join(json.dumps(line) for line in lines)
+    response = client.post("/messages/import/", content=body.encode())
+    assert response.status_code == 200, response.text
+    result = response.json()
+    assert result["inserted"] == 2
+    assert [error["line"] for error in result["errors"]] == [1, 3, 4]
+    assert read_context(3, turns=0) == [("Turn 2", 2)]
+    assert [turn for _, turn in read_context(standalone["id"] + 2, turns=0)] == [10]
+
+
+def test_near_duplicate_messages(test_db: Any) -> None:
+    pytest.importorskip("numpy")
+    content = (
+        "I have been feeling really tired at work lately and I don't know "
+        "whether it is the long hours or just the people I work with"
+    )
+    (original, unrelated) = _create_messages(content, "Something else entirely")
+    scraped_again = content.replace("tired", "tired!").upper()
+
+    response = client.post(
+        "/messages/create/",
+        params={"duplicates": "check"},
+        json={"content": scraped_again},
+    )
+    assert response.status_code == 200, response.text
+    checked = response.json()
+    assert checked["duplicates"] == [original["id"]]
+
+    response = client.post(
+        "/messages/create/", params={"duplicates": "reject"}, json={"content": content}
+    )
+    assert response.status_code == 409, response.text
+    assert response.json()["detail"]["duplicates"] == [original["id"], checked["id"]]
+
+    lines = [content + "!", "A new message about my day", "a new  message about my day"]
+    body = "\n".join(json.dumps({"content": line}) for line in lines)
+    response = client.post(
+        "/messages/import/", params={"duplicates": "reject"}, content=body.encode()
+    )
+    assert response.status_code == 200, response.text
+    result = response.json()
+    assert (result["inserted"], result["duplicates"]) == (1, 2)
+
+    response = client.get("/messages/duplicates/")
+    assert response.status_code == 200, response.text
+    assert response.json() == [[original["id"], checked["id"]]]
+
+    linked = client.post(
+        "/messages/create/", params={"duplicates": "link"}, json={"content": content}
+    ).json()
+    client.post("/messages/update/", json={"id": linked["id"], "content": "Edited"})
+    with TestingSessionLocal() as session:
+        link = session.get(MessageSignature, linked["id"])
+        assert link is not None and link.duplicate_of_id == original["id"]
+    client.post("/messages/delete/", json={"id": linked["id"]})
+    client.post("/messages/delete/", json={"id": checked["id"]})
+    assert client.get("/messages/duplicates/").json() == []
+
+
+def test_minhash_is_independent_of_batching(monkeypatch: pytest.MonkeyPatch) -> None:
+    pytest.importorskip("numpy")
+    contents = ["Short", "", "A somewhat longer message " * 20, "Another one"]
+    signatures = dedup.minhash(contents)
+    monkeypatch.setattr(dedup, "MINHASH_BATCH_CHARACTERS", 10)
+    monkeypatch.setattr(dedup, "MINHASH_CHUNK_SHINGLES", 7)
+    assert (dedup.minhash(contents) == signatures).all()
+    assert (dedup.minhash(contents[2:3]) == signatures[2]).all()
+
+
+def _create_code(code: str) -> Any:
+    response = client.post("/codes/create/", json={"code": code})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def _read_annotations(message_id: int) -> list[Any]:
+    response = client.get(f"/annotations/{message_id}/")
+    assert response.status_code == 200, response.text
+    return [annotation for annotation, _ in (r["result"] for r in response.json())]
+
+
+def test_apply_annotation_batch(test_db: Any) -> None:
+    first, second = _create_messages("First message", "Second message")
+    code = _create_code("/emotion")
+    annotations = [
+        {
+            "message_id": message["id"],
+            "code_id": code["id"],
+            "start_idx": 0,
+            "end_idx": 5,
+        }
+        for message in (first, first, second)
+    ]
+    response = client.post("/annotations/batch/", json={"create": annotations})
+    assert response.status_code == 200, response.text
+    created = response.json()["created"]
+    assert len(created) == 3
+
+    update = {"id": created[0], "code_id": code["id"], "start_idx": 6, "end_idx": 13}
+    response = client.post(
+        "/annotations/batch/",
+        json={"update": [update], "delete": [{"id": created[1]}]},
+    )
+    assert response.status_code == 200, response.text
+    assert response.json() == {"created": [], "updated": 1, "deleted": 1}
+
+    annotations = _read_annotations(first["id"])
+    assert [(a["start_idx"], a["end_idx"]) for a in annotations] == [(6, 13)]
+    assert len(_read_annotations(second["id"])) == 1
+
+
+def test_annotation_batch_with_nonexistant_code_is_not_applied(test_db: Any) -> None:
+    (message,) = _create_messages("A message")
+    code = _create_code("/emotion")
+    annotations = [
+        {"message_id": message["id"], "code_id": code_id, "start_idx": 0, "end_idx": 1}
+        for code_id in (code["id"], 1000)
+    ]
+    response = client.post("/annotations/batch/", json={"create": annotations})
+    assert response.status_code == 404, response.text
+    assert _read_annotations(message["id"]) == []
+
+    unknown = {**annotations[0], "id": 1000}
+    response = client.post("/annotations/batch/", json={"update": [unknown]})
+    assert response.status_code == 404, response.text
+    response = client.post("/annotations/batch/", json={"delete": [{"id": 1000}]})
+    assert response.status_code == 404, response.text
+
+
+def test_read_annotations_for_many_messages(test_db: Any) -> None:
+    first, second, third = _create_messages("First", "Second", "Third")
+    codes = [_create_code("/a"), _create_code("/b")]
+    annotations = [
+        {
+            "message_id": message["id"],
+            "code_id": code["id"],
+            "start_idx": 0,
+            "end_idx": 1,
+        }
+        for message, code in zip((first, second, second, third), codes * 2)
+    ]
+    response = client.post("/annotations/batch/", json={"create": annotations})
+    assert response.status_code == 200, response.text
+
+    response = client.get(
+        "/annotations/", params={"message_ids": [first["id"], second["id"]]}
+    )
+    assert response.status_code == 200, response.text
+    results = [r["result"] for r in response.json()]
+    assert [(a["message_id"], c["code"]) for a, c in results] == [
+        (first["id"], "/a"),
+        (second["id"], "/b"),
+        (second["id"], "/a"),
+    ]
+
+
+def test_endpoints_with_async_session(tmp_path: Path) -> None:
+    pytest.importorskip("aiosqlite")
+    database = tmp_path / "test.db"
+    Base.metadata.create_all(bind=create_engine(f"sqlite+pysqlite:///{database}"))
+    async_engine = create_async_engine(
+        f"sqlite+aiosqlite:///{database}", poolclass=NullPool
+    )
+    AsyncTestingSessionLocal = async_sessionmaker(
+        bind=async_engine, expire_on_commit=False
+    )
+
+    async def override_get_async_session() -> AsyncGenerator[AsyncSession, None]:
+        async with AsyncTestingSessionLocal() as session:
+            yield session
+
+    app.dependency_overrides[get_session] = override_get_async_session
+    try:
+        message = _create_test_message()
+        code = _create_code("/emotion/joy")
+        annotation = {"message_id": message["id"], "code_id": code["id"]}
+        response = client.post(
+            f"/annotations/{message['id']}/create/",
+            json={**annotation, "start_idx": 0, "end_idx": 3},
+        )
+        assert response.status_code == 200, response.text
+        assert len(_read_annotations(message["id"])) == 1
+        response = client.get("/messages/", params={"search": "message"})
+        assert [m["id"] for m in response.json()] == [message["id"]]
+    finally:
+        app.dependency_overrides[get_session] = override_get_session
+
+
+def _postgres_program(name: str) -> str:
+    """Find a PostgreSQL server program on the `PATH` or in `pg_config --bindir`."""
+    bindir = None
+    if shutil.which("pg_config"):
+        command = ["pg_config", "--bindir"]
+        bindir = subprocess.run(command, capture_output=True, text=True).stdout
+    program = shutil.which(name) or shutil.which(name, path=bindir and bindir.strip())
+    if program is None:
+        pytest.skip(f"PostgreSQL's {name} is not installed")
+    return program
+
+
+@pytest.fixture()
+def postgres_url(tmp_path: Path) -> Generator[str, None, None]:
+    """Start a throwaway PostgreSQL cluster in `tmp_path`, listening only on a
+    socket there, unless `TEST_POSTGRES_URL` names a database to use instead."""
+    pytest.importorskip("psycopg")
+    if os.environ.get("TEST_POSTGRES_URL"):
+        yield os.environ["TEST_POSTGRES_URL"]
+        return
+    if os.geteuid() == 0:
+        pytest.skip("PostgreSQL clusters cannot be run by root")
+    initdb, pg_ctl = _postgres_program("initdb"), _postgres_program("pg_ctl")
+    data, log = str(tmp_path / "data"), str(tmp_path / "log")
+    options = f"-k {tmp_path} -c listen_addresses=''"
+    subprocess.run(
+        [initdb, "-D", data, "-U", "postgres", "--auth=trust"],
+        check=True,
+        capture_output=True,
+    )
+    subprocess.run(
+        [pg_ctl, "start", "-w", "-D", data, "-l", log, "-o", options],
+        check=True,
+        capture_output=True,
+    )
+    try:
+        yield f"postgresql+psycopg://postgres@/postgres?host={tmp_path}"
+    finally:
+        stop = [pg_ctl, "stop", "-D", data, "-m", "immediate"]
+        subprocess.run(stop, check=True, capture_output=True)
+
+
+@pytest.fixture()
+def postgres_db(
+    postgres_url: str, monkeypatch: pytest.MonkeyPatch
+) -> Generator[Session, None, None]:
+    """Migrate the PostgreSQL database at `postgres_url` to the latest revision,
+    serve the endpoints from it, and migrate it back down afterwards."""
+    monkeypatch.delenv("DATABASE_URL", raising=False)  # Would replace the URL
+    config = Config()  # Without the ini file, which would reconfigure logging
+    config.set_main_option("script_location", str(ROOT_DIR / "alembic"))
+    config.set_main_option("sqlalchemy.url", postgres_url.replace("%", "%%"))
+    command.upgrade(config, "head")
+    postgres_engine = create_engine(postgres_url, poolclass=NullPool)
+    PostgresSessionLocal = sessionmaker(autoflush=False, bind=postgres_engine)
+
+    def override_get_postgres_session() -> Generator[Session, None, None]:
+        with PostgresSessionLocal() as session:
+            yield session
+
+    app.dependency_overrides[get_session] = override_get_postgres_session
+    code_cache.invalidate()
+    suggestion_index.invalidate()
+    try:
+        with PostgresSessionLocal() as session:
+            yield session
+    finally:
+        app.dependency_overrides[get_session] = override_get_session
+        code_cache.invalidate()
+        suggestion_index.invalidate()
+        command.downgrade(config, "base")
+        postgres_engine.dispose()
+
+
+def test_endpoints_with_postgres(postgres_db: Session) -> None:
+    assert find_missing_indexes(postgres_db.connection()) == []  # Migrated fully
+    response = client.post("/conversations/create/", json={"name": "Session 1"})
+    assert response.status_code == 200, response.text
+    conversation = response.json()
+    contents = [f"Message {i}" for i in range(100)] + ["I feel HAPPY today"]
+    body = "\n".join(
+        json.dumps({"content": content, "conversation_id": conversation["id"]})
+        for content in contents
+    )
+    response = client.post("/messages/import/", content=body.encode())
+    assert response.status_code == 200, response.text
+    assert response.json()["inserted"] == len(contents)  # Copied in one batch
+    response = client.get("/messages/", params={"search": "happy"})
+    (happy,) = response.json()
+    long_content = os.urandom(4096).hex()  # Longer than a btree index entry
+    response = client.post("/messages/create/", json={"content": long_content})
+    assert response.status_code == 200, response.text
+    # Deleted again, as the btree index of older revisions could not hold it
+    client.post("/messages/delete/", json={"id": response.json()["id"]})
+    assert happy["content"] == "I feel HAPPY today"
+    taken = {"content": "Again", "conversation_id": conversation["id"], "turn_idx": 1}
+    response = client.post("/messages/create/", json=taken)
+    assert response.status_code == 409, response.text
+    response = client.get(f"/messages/{happy['id']}/context/", params={"turns": 1})
+    assert [m["turn_idx"] for m in response.json()] == [99, 100]
+
+    for code in ("/joy", "/joy/laughter", "/joyful", "/a_b", "/axb/c"):
+        _create_code(code)
+    joy = next(c for c in client.get("/codes/").json() if c["code"] == "/joy")
+    client.post("/codes/update/", json={"id": joy["id"], "code": "/happy"})
+    client.post("/codes/delete/", json={"code": "/a_b"})  # Not a wildcard
+    assert _read_codes() == ["/axb", "/axb/c", "/happy", "/happy/laughter", "/joyful"]
+
+    postgres_db.execute(text("SET enable_seqscan = off"))
+    for query, index in [
+        ("SELECT id FROM messages WHERE content ILIKE '%happy%'", "content_trgm"),
+        ("SELECT id FROM codes WHERE code LIKE '/happy/%'", "code_pattern"),
+    ]:
+        plan = postgres_db.execute(text(f"EXPLAIN {query}")).scalars()
+        assert any(index in line for line in plan), query
+
+
+def test_sqlite_engine_is_tuned_for_concurrency(tmp_path: Path) -> None:
+    engine = create_database_engine(f"sqlite+pysqlite:///{tmp_path / 'test.db'}")
+    with engine.connect() as connection:
+        journal_mode = connection.exec_driver_sql("PRAGMA journal_mode").scalar()
+        busy_timeout = connection.exec_driver_sql("PRAGMA busy_timeout").scalar()
+    assert journal_mode == "wal"
+    assert busy_timeout == SQLITE_PRAGMAS["busy_timeout"]
+    assert engine.pool.size() > 1  # type: ignore[attr-defined]
+    engine.dispose()
+
+
+def test_find_missing_indexes(tmp_path: Path) -> None:
+    engine = create_engine(f"sqlite+pysqlite:///{tmp_path / 'test.db'}")
+    with engine.begin() as connection:
+        Base.metadata.create_all(bind=connection)
+        assert find_missing_indexes(connection) == []
+        connection.exec_driver_sql("DROP INDEX ix_annotations_code_id")
+        assert find_missing_indexes(connection) == ["ix_annotations_code_id"]
+
+
+def _read_codes() -> list[str]:
+    response = client.get("/codes/")
+    assert response.status_code == 200, response.text
+    return [code["code"] for code in response.json()]
+
+
+def test_read_codes_only_in_descending_order_when_sorted(test_db: Any) -> None:
+    for code in ("/b", "/a", "/c"):
+        _create_code(code)
+    response = client.get("/codes/", params={"sort_asc": False})
+    assert [code["code"] for code in response.json()] == ["/a", "/b", "/c"]
+    response = client.get("/codes/", params={"sort_by": "code", "sort_asc": False})
+    assert [code["code"] for code in response.json()] == ["/c", "/b", "/a"]
+
+
+def test_update_code_renames_only_its_subtree(test_db: Any) -> None:
+    joy = _create_code("/joy")
+    _create_code("/joy/laughter")
+    _create_code("/joyful")
+    _create_code("/emotion/joy")
+
+    response = client.post("/codes/update/", json={"id": joy["id"], "code": "/happy"})
+    assert response.status_code == 200, response.text
+    assert _read_codes() == [
+        "/emotion",
+        "/emotion/joy",
+        "/happy",
+        "/happy/laughter",
+        "/joyful",
+    ]
+
+
+def test_delete_code_deletes_its_subtree_and_annotations(test_db: Any) -> None:
+    (message,) = _create_messages("A message")
+    codes = [_create_code(code) for code in ("/a/b", "/ab", "/x/a")]
+    annotations = [
+        {
+            "message_id": message["id"],
+            "code_id": code["id"],
+            "start_idx": 0,
+            "end_idx": 1,
+        }
+        for code in codes
+    ]
+    client.post("/annotations/batch/", json={"create": annotations})
+
+    response = client.post("/codes/delete/", json={"code": "/a"})
+    assert response.status_code == 200, response.text
+    assert _read_codes() == ["/ab", "/x", "/x/a"]
+    remaining = {a["code_id"] for a in _read_annotations(message["id"])}
+    assert remaining == {codes[1]["id"], codes[2]["id"]}
+
+
+def test_import_codes(test_db: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(crud, "IMPORT_BATCH_SIZE", 2)  # Paths looked up in batches
+    _create_code("/emotion")
+    codebook = {
+        "codes": ["/emotion/joy", "grammar/question"],
+        "tree": {"emotion": {"joy": {}, "anger": {}}, "topic": {}},
+    }
+    response = client.post("/codes/import/", json=codebook)
+    assert response.status_code == 200, response.text
+    assert response.json() == {"created": 5, "existing": 1}
+    assert _read_codes() == [
+        "/emotion",
+        "/emotion/anger",
+        "/emotion/joy",
+        "/grammar",
+        "/grammar/question",
+        "/topic",
+    ]
+
+    response = client.post("/codes/import/", json=codebook)
+    assert response.json() == {"created": 0, "existing": 6}
+
+
+def _count(path: str, **params: Any) -> int:
+    response = client.get(path, params=params)
+    assert response.status_code == 200, response.text
+    return int(response.json())
+
+
+def test_counts_follow_writes(test_db: Any) -> None:
+    first, *_ = _create_messages("apple", "banana", "apple pie")
+    _create_code("/a/b")
+    client.post("/messages/import/", content=b'{"content": "cherry"}\n')
+    client.post("/messages/delete/", json={"id": first["id"]})
+    client.post("/codes/delete/", json={"code": "/a/b"})
+
+    assert _count("/messages/count/") == 3
+    assert _count("/messages/count/", search="apple") == 1
+    assert _count("/messages/count/", search="a") == 2
+    assert _count("/codes/count/") == 1
+
+
+def _export(**params: Any) -> list[Any]:
+    response = client.get("/export/", params=params)
+    assert response.status_code == 200, response.text
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_export_dataset(test_db: Any) -> None:
+    first, second, _ = _create_messages("I feel happy", "So sad", "Nothing")
+    happy, sad = _create_code("/emotion/happy"), _create_code("/emotion/sad")
+    topic = _create_code("/topic")
+    annotations = [
+        {
+            "message_id": message["id"],
+            "code_id": code["id"],
+            "start_idx": s,
+            "end_idx": e,
+        }
+        for message, code, s, e in [
+            (first, happy, 7, 12),
+            (first, topic, 0, 1),
+            (second, sad, 3, 6),
+        ]
+    ]
+    client.post("/annotations/batch/", json={"create": annotations})
+
+    messages = _export()
+    assert [len(message["annotations"]) for message in messages] == [2, 1, 0]
+    assert messages[0]["annotations"][0]["code"] == "/emotion/happy"
+
+    spans = _export(format="spans", code="/emotion")
+    assert [(span["text"], span["code"]) for span in spans] == [
+        ("happy", "/emotion/happy"),
+        ("sad", "/emotion/sad"),
+    ]
+
+
+def test_export_dataset_as_parquet(test_db: Any) -> None:
+    pq = pytest.importorskip("pyarrow.parquet")
+    _create_messages("A message", "Another message")
+
+    response = client.get("/export/", params={"format": "parquet"})
+    assert response.status_code == 200, response.text
+    table = pq.read_table(io.BytesIO(response.content))
+    assert table.column("content").to_pylist() == ["A message", "Another message"]
+
+
+def test_code_analytics(test_db: Any) -> None:
+    first, second = _create_messages("I feel happy and sad", "Happy")
+    happy, sad = _create_code("/emotion/happy"), _create_code("/emotion/sad")
+    annotations = [
+        {
+            "message_id": message["id"],
+            "code_id": code["id"],
+            "start_idx": s,
+            "end_idx": e,
+        }
+        for message, code, s, e in [
+            (first, happy, 7, 12),
+            (first, sad, 17, 20),
+            (first, sad, 0, 1),
+            (second, happy, 0, 5),
+        ]
+    ]
+    client.post("/annotations/batch/", json={"create": annotations})
+
+    response = client.get("/analytics/codes/")
+    assert response.status_code == 200, response.text
+    assert [(c["code"], c["count"], c["total"]) for c in response.json()] == [
+        ("/emotion", 0, 4),
+        ("/emotion/happy", 2, 2),
+        ("/emotion/sad", 2, 2),
+    ]
+
+    response = client.get("/analytics/cooccurrences/")
+    assert response.status_code == 200, response.text
+    assert response.json() == [
+        {"code": "/emotion/happy", "other_code": "/emotion/sad", "count": 1}
+    ]
+
+    response = client.get(
+        "/analytics/span-lengths/", params={"bin_width": 2, "code": "/emotion/sad"}
+    )
+    assert response.status_code == 200, response.text
+    assert response.json() == [
+        {"min_length": 0, "max_length": 1, "count": 1},
+        {"min_length": 2, "max_length": 3, "count": 1},
+    ]
+
+
+def test_conditional_read(test_db: Any) -> None:
+    message = _create_test_message()
+    response = client.get("/messages/")
+    assert response.status_code == 200, response.text
+    etag = response.headers["ETag"]
+
+    response = client.get("/messages/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert not response.content
+
+    # Writes to other tables leave the ETag unchanged
+    _create_code("/emotion")
+    response = client.get("/messages/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    etag = client.get(f"/annotations/{message['id']}/").headers["ETag"]
+    client.post("/messages/update/", json={"id": message["id"], "content": "Updated"})
+    for path in ["/messages/", f"/annotations/{message['id']}/"]:
+        response = client.get(path, headers={"If-None-Match": etag})
+        assert response.status_code == 200, response.text
+
+
+def test_compressed_response(test_db: Any) -> None:
+    _create_messages(*["I'm a message!"] * 100)
+    response = client.get("/messages/", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200, response.text
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(response.json()) == 100
+
+
+def test_code_cache(test_db: Any) -> None:
+    _create_code("/emotion/happy")
+    shared_cache = CodeCache(shared=True)
+    with TestingSessionLocal() as session:
+        assert shared_cache.get(session).subtree("/emotion") == code_cache.get(
+            session
+        ).subtree("/emotion")
+
+        # Another worker process writes a code
+        session.add(Code(code="/emotion/sad"))
+        session.execute(
+            update(TableVersion)
+            .where(TableVersion.table_name == "codes")
+            .values(version=TableVersion.version + 1)
+        )
+        session.commit()
+
+        assert "/emotion/sad" not in code_cache.get(session).codes.values()
+        assert sorted(shared_cache.get(session).subtree("/emotion").values()) == [
+            "/emotion",
+            "/emotion/happy",
+            "/emotion/sad",
+        ]
+        assert shared_cache.get(session).subtree("/emotion/sad/x") == {}
+
+    # Writes in this process invalidate the cache directly
+    _create_code("/emotion/angry")
+    assert [code for code in _read_codes() if "ang" in code] == ["/emotion/angry"]
+
+
+def test_read_annotations_in_span(test_db: Any) -> None:
+    (message,) = _create_messages("I feel happy and sad")
+    code = _create_code("/emotion")
+    spans = [(0, 6), (7, 12), (7, 20), (17, 20)]
+    annotations = [
+        {
+            "message_id": message["id"],
+            "code_id": code["id"],
+            "start_idx": s,
+            "end_idx": e,
+        }
+        for s, e in spans
+    ]
+    client.post("/annotations/batch/", json={"create": annotations})
+
+    def read_spans(**params: str) -> list[tuple[int, int]]:
+        response = client.get(f"/annotations/{message['id']}/", params=params)
+        assert response.status_code == 200, response.text
+        return [
+            (a["start_idx"], a["end_idx"])
+            for a, _ in map(itemgetter("result"), response.json())
+        ]
+
+    assert read_spans(overlaps="5,8") == [(0, 6), (7, 12), (7, 20)]
+    assert read_spans(covers="10,11") == [(7, 12), (7, 20)]
+    assert read_spans(overlaps="12,17", covers="8,18") == [(7, 20)]
+    assert read_spans(overlaps="20,25") == []
+
+    response = client.get(f"/annotations/{message['id']}/", params={"covers": "1"})
+    assert response.status_code == 422, response.text
+
+
+def test_suggestions_follow_annotated_phrases(test_db: Any) -> None:
+    first, second, third = _create_messages(
+        "I feel happy and sad", "So Happy, but unhappy too", "Unhappy and sad"
+    )
+    joy, sadness = _create_code("/emotion/joy"), _create_code("/emotion/sadness")
+
+    def annotate(message: Any, code: Any, start: int, end: int) -> Any:
+        annotation = {"code_id": code["id"], "start_idx": start, "end_idx": end}
+        response = client.post(
+            f"/annotations/{message['id']}/create/",
+            json={"message_id": message["id"], **annotation},
+        )
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    def suggest(message: Any) -> list[tuple[int, int, str, int]]:
+        response = client.get(f"/annotations/{message['id']}/suggestions/")
+        assert response.status_code == 200, response.text
+        return [
+            (s["start_idx"], s["end_idx"], s["code"], s["count"])
+            for s in response.json()
+        ]
+
+    annotate(first, joy, 7, 12)
+    sad = annotate(first, sadness, 17, 20)
+    assert suggest(second) == [(3, 8, "/emotion/joy", 1)]  # Not within "unhappy"
+    assert suggest(third) == [(12, 15, "/emotion/sadness", 1)]
+
+    annotate(second, joy, 3, 8)
+    annotate(second, sadness, 14, 21)
+    assert suggest(second) == []  # Already annotated
+    (fourth,) = _create_messages("Happy")
+    assert suggest(fourth) == [(0, 5, "/emotion/joy", 2)]
+    assert suggest(third) == [
+        (0, 7, "/emotion/sadness", 1),
+        (12, 15, "/emotion/sadness", 1),
+    ]
+
+    client.post("/annotations/batch/", json={"delete": [{"id": sad["id"]}]})
+    assert suggest(third) == [(0, 7, "/emotion/sadness", 1)]
+    response = client.get("/annotations/42/suggestions/")
+    assert response.status_code == 404, response.text
+
+
+def test_shared_suggestions_follow_message_updates(test_db: Any) -> None:
+    (message,) = _create_messages("I feel happy")
+    code = _create_code("/emotion")
+    annotation = {"message_id": message["id"], "code_id": code["id"]}
+    client.post(
+        "/annotations/batch/",
+        json={"create": [{**annotation, "start_idx": 7, "end_idx": 12}]},
+    )
+    other_worker = SuggestionIndex(shared=True)
+    with TestingSessionLocal() as session:
+        assert other_worker.suggest(session, "So happy") == [(3, 8, code["id"], 1)]
+    client.post(
+        "/messages/update/", json={"id": message["id"], "content": "I feel sadly"}
+    )
+    with TestingSessionLocal() as session:
+        assert other_worker.suggest(session, "So happy") == []
+        assert other_worker.suggest(session, "So sadly") == [(3, 8, code["id"], 1)]
+
+
+def test_suggestions_load_concurrently_with_async_sessions(tmp_path: Path) -> None:
+    pytest.importorskip("aiosqlite")
+    database = tmp_path / "test.db"
+    sync_engine = create_engine(f"sqlite+pysqlite:///{database}")
+    Base.metadata.create_all(bind=sync_engine)
+    with Session(sync_engine) as session:
+        message, code = Message(content="I feel happy"), Code(code="/emotion")
+        session.add(Annotation(message=message, code=code, start_idx=7, end_idx=12))
+        session.commit()
+        code_id = code.id
+    async_engine = create_async_engine(
+        f"sqlite+aiosqlite:///{database}", poolclass=NullPool
+    )
+    index = SuggestionIndex(shared=True)  # Read from the database on every call
+
+    async def suggest() -> Any:
+        async with AsyncSession(async_engine) as session:
+            return await session.run_sync(index.suggest, "So happy")
+
+    async def suggest_concurrently() -> list[Any]:
+        return await asyncio.gather(*(suggest() for _ in range(5)))
+
+    # The event loop would deadlock if a query was made while holding the lock
+    suggestions: list[Any] = []
+    loop = threading.Thread(
+        target=lambda: suggestions.extend(asyncio.run(suggest_concurrently())),
+        daemon=True,
+    )
+    loop.start()
+    loop.join(timeout=10)
+    assert suggestions == [[(3, 8, code_id, 1)]] * 5
+
+
+def test_annotation_span_must_be_within_message(test_db: Any) -> None:
+    (message,) = _create_messages("Short")
+    code = _create_code("/emotion")
+    annotation = {"message_id": message["id"], "code_id": code["id"]}
+    response = client.post(
+        f"/annotations/{message['id']}/create/",
+        json={**annotation, "start_idx": 0, "end_idx": 6},
+    )
+    assert response.status_code == 400, response.text
+
+    response = client.post(
+        "/annotations/batch/",
+        json={"create": [{**annotation, "start_idx": 0, "end_idx": 5}]},
+    )
+    (annotation_id,) = response.json()["created"]
+    for start, end in [(3, 2), (-1, 2), (4, 6)]:
+        update = {"id": annotation_id, "code_id": code["id"]}
+        response = client.post(
+            "/annotations/batch/",
+            json={"update": [{**update, "start_idx": start, "end_idx": end}]},
+        )
+        assert response.status_code == 400, response.text
+    assert len(_read_annotations(message["id"])) == 1
+
+    update = {"id": message["id"], "content": "Shor"}  # Cutting off the annotation
+    response = client.post("/messages/update/", json=update)
+    assert response.status_code == 400, response.text
+    assert _read_messages()[0]["content"] == "Short"
+
+
+def _read_changes(**params: Any) -> Any:
+    response = client.get("/changes/", params=params)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_changes_follow_writes(test_db: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    since = _read_changes()["seq"]
+    message = _create_test_message()
+    client.post("/messages/update/", json={"id": message["id"], "content": "Updated"})
+    code = _create_code("/emotion")
+    span = {"start_idx": 0, "end_idx": 3}
+    response = client.post(
+        f"/annotations/{message['id']}/create/",
+        json={"message_id": message["id"], "code_id": code["id"], **span},
+    )
+    assert response.status_code == 200, response.text
+    annotation = response.json()
+    client.post("/messages/delete/", json={"id": message["id"]})
+
+    feed = _read_changes(since=since)
+    assert not feed["reload"]
+    assert [(c["table"], c["operation"], c["row_id"]) for c in feed["changes"]] == [
+        ("messages", "create", message["id"]),
+        ("messages", "update", message["id"]),
+        ("codes", "create", code["id"]),
+        ("annotations", "create", annotation["id"]),
+        ("messages", "delete", message["id"]),
+        ("annotations", "delete", annotation["id"]),
+    ]
+    assert feed["changes"][1]["data"] == {"id": message["id"], "content": "Updated"}
+    assert feed["changes"][-1]["data"] is None
+    assert feed["seq"] == feed["changes"][-1]["seq"]
+    resumed = _read_changes(since=feed["changes"][1]["seq"], limit=2)
+    assert resumed["changes"] == feed["changes"][2:4]
+    assert _read_changes(since=feed["seq"])["changes"] == []
+
+    # Writes to many rows are logged as one change to reload the table
+    monkeypatch.setattr(crud, "CHANGE_LOG_MAX_ROWS", 1)
+    client.post("/codes/import/", json={"codes": ["/topic/work", "/topic/home"]})
+    (change,) = _read_changes(since=feed["seq"])["changes"]
+    assert (change["table"], change["operation"], change["row_id"]) == (
+        "codes",
+        "reload",
+        None,
+    )
+
+    monkeypatch.setattr(crud, "CHANGE_LOG_SIZE", 2)
+    pruned = _read_changes(since=since)
+    assert pruned == {"changes": [], "seq": change["seq"], "reload": True}
+
+
+async def _read_test_changes(since: int | None, limit: int | None) -> Any:
+    with TestingSessionLocal() as session:
+        return crud.read_changes(session, since, limit)
+
+
+async def _read_feeds_until(feeds: AsyncGenerator[Any, None], seq: int) -> list[int]:
+    row_ids: list[int] = []
+    async for feed in feeds:
+        row_ids += [change["row_id"] for change in feed["changes"]] if feed else []
+        if feed is not None and feed["seq"] >= seq:
+            break
+    return row_ids
+
+
+async def _stream_changes(broadcaster: ChangeBroadcaster) -> None:
+    since = (await _read_test_changes(None, None))["seq"]
+    latest = broadcaster.subscribe(None, keepalive=0.05)
+    assert await anext(latest) is None  # Kept alive without changes
+    messages = _create_messages("First", "Second", "Third")
+    ids = [message["id"] for message in messages]
+    seq = (await _read_test_changes(None, None))["seq"]
+    # Clients are sent changes held in memory or, if behind, read from the log
+    behind = broadcaster.subscribe(since, keepalive=0.05)
+    assert await _read_feeds_until(latest, seq) == ids
+    assert await _read_feeds_until(behind, seq) == ids
+    ahead = broadcaster.subscribe(seq + 1, keepalive=0.05)
+    assert await anext(ahead) == {"changes": [], "seq": seq, "reload": True}
+    for feeds in (latest, behind, ahead):
+        await feeds.aclose()
+
+
+def test_change_broadcaster_streams_changes(test_db: Any) -> None:
+    broadcaster = ChangeBroadcaster(_read_test_changes, interval=0.01, buffer_size=2)
+    asyncio.run(_stream_changes(broadcaster))
+
+    feed = _read_changes(since=0)
+    events = format_events(feed).split("\n\n")
+    assert events[0] == f"id: 1\ndata: {json.dumps(feed['changes'][0])}"
+    assert format_events({"changes": [], "seq": 9, "reload": True}).startswith(
+        "event: reload\nid: 9\n"
+    )
+    assert format_events(None) == KEEPALIVE_EVENT
+
+
+def test_metrics(test_db: Any) -> None:
+    message = _create_test_message()
+    _read_annotations(message["id"])
+
+    response = client.get("/metrics")
+    assert response.status_code == 200, response.text
+    metrics = dict(
+        line.rsplit(" ", 1) for line in response.text.splitlines() if line[0] != "#"
+    )
+    labels = 'method="GET",route="/annotations/{message_id}/"'
+    assert float(metrics[f"http_request_duration_seconds_count{{{labels}}}"]) >= 1
+    assert float(metrics[f"http_request_queries_sum{{{labels}}}"]) >= 1
+    assert float(metrics[f"http_request_serialization_seconds_sum{{{labels}}}"]) > 0
+
+
+def test_slow_queries_are_logged_with_plan(
+    test_db: Any, caplog: pytest.LogCaptureFixture, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(instrumentation, "SLOW_QUERY_SECONDS", 0)
+    with caplog.at_level(logging.WARNING, logger=instrumentation.__name__):
+        _read_codes()
+    assert any("SCAN codes" in record.message for record in caplog.records)
+
+
+def test_failed_and_unexplainable_queries_are_instrumented(
+    caplog: pytest.LogCaptureFixture, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(instrumentation, "SLOW_QUERY_SECONDS", 0)
+    with engine.connect() as connection:
+        with pytest.raises(OperationalError):
+            connection.execute(text("SELECT * FROM missing"))
+        assert connection.info["query_start_time"] == []
+        with caplog.at_level(logging.WARNING, logger=instrumentation.__name__):
+            connection.execute(text("CREATE TEMPORARY TABLE unexplained (id INT)"))
+        (record,) = caplog.records
+        assert record.message.endswith("CREATE TEMPORARY TABLE unexplained (id INT)")
+        connection.rollback()
+
+
+def test_write_lock_is_shared_through_lock_file(tmp_path: Path) -> None:
+    path = str(tmp_path / "app.db.write-lock")
+    first, second = WriteLock(path), WriteLock(path)  # As if in two processes
+    writes: list[str] = []
+    with first.hold():
+        writer = threading.Thread(target=second.locked(writes.append), args=["second"])
+        writer.start()
+        writer.join(timeout=0.2)
+        assert writer.is_alive()
+        writes.append("first")
+    writer.join()
+    assert writes == ["first", "second"]
+
+
+def test_serve_prepares_database_before_starting_workers(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setenv("DATABASE_INIT", "true")
+    monkeypatch.setenv("CODE_CACHE_SHARED", "false")
+    started: dict[str, Any] = {}
+    monkeypatch.setattr(
+        "backend.serve.uvicorn.run", lambda app, **options: started.update(options)
+    )
+    serve.main(["--workers", "3"])
+    assert started["workers"] == 3
+    assert os.environ["DATABASE_INIT"] == "false"
+    assert os.environ["CODE_CACHE_SHARED"] == "true"